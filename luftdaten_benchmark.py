@@ -0,0 +1,889 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+####
+# benchmarks of the ingest pipeline
+#
+# encoder: compares the encoding of the csv data into bulk requests
+#   1. legacy: a dict for each row (df.T.to_dict()) + serialization of each dict as done by the elasticsearch helpers
+#   2. columnar: luftdaten_encoder.encode_bulk_documents
+#
+# parse: measures the throughput of the parse stage (reading + encoding of the csv files) with 1..n processes
+#
+# csv: compares the reading of the csv files of a day in a single process (rows per second per core)
+#   1. inferred: pd.read_csv with type inference + pd.to_datetime of the timestamps of each chunk
+#   2. typed_c, typed_pyarrow: luftdaten_csv.iter_csv_chunks with the c and the pyarrow engine
+#
+# ingest: measures each stage of download_and_index on a synthetic archive (no network, no cluster needed)
+#   1. a synthetic archive (day directories with YYYY-MM-DD_<sensor>_sensor_<id>.csv files) is served by a local
+#      http server instead of archive.luftdaten.info
+#   2. the bulk requests are answered by a local stub of the bulk api instead of Elastic Search
+#   3. the stages listing, download, parse, encode, rollup and bulk are timed one after another, then
+#      download_and_index is run end to end
+#   4. the results contain the metrics of the end to end run (see luftdaten_metrics)
+#   the results contain the commit, so the runs of different commits can be compared (--output appends the results
+#   as one json line to a file)
+#
+# queue: measures the throughput of the distributed ingest (see luftdaten_queue) with 1..n worker processes on a
+#   synthetic archive, each worker has its own working directory (like a worker on another machine), the bulk
+#   requests are answered by the local stub after --bulk-latency seconds (the latency of a cluster)
+#
+# mapping: compares the size of a day indexed with the dynamic mapping and with the explicit mapping (see
+#   luftdaten_mapping), requires a cluster (see ELASTICSEARCH_HOST of luftdaten_index, a single node is sufficient)
+#   1. the day is indexed into two temporary indices, both are force merged into one segment
+#   2. the size of the stores and the amount of documents are compared, the indices are deleted afterwards
+#
+# usage:
+#   python luftdaten_benchmark.py encoder [--rows 1000000] [--directory data/luftdaten/2018-05-07]
+#   python luftdaten_benchmark.py parse [--workers 1 2 4 8] [--directory data/luftdaten/2018-05-07]
+#   python luftdaten_benchmark.py csv [--directory data/luftdaten/2018-05-07]
+#   python luftdaten_benchmark.py ingest [--days 2] [--files-per-day 200] [--rows-per-file 500] [--output data/benchmark_ingest.jsonl]
+#   python luftdaten_benchmark.py queue [--workers 1 2 4] [--days 8] [--bulk-latency 0.05]
+#   python luftdaten_benchmark.py mapping [--directory data/luftdaten/2018-05-07]
+###
+
+__author__ = 'Martin Andreas Woerz'
+__email__ = 'm.woerz@ieservices.de'
+__copyright__ = "Copyright 2018, Martin Woerz"
+__version__ = "0.0.7"
+
+import argparse
+import glob
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from functools import partial
+from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, time
+
+import numpy as np
+import pandas as pd
+
+from luftdaten_bulk import iter_file_chunks, iter_file_chunks_parallel, stream_bulk, BULK_MAX_DOCS
+from elasticsearch import Elasticsearch
+
+from luftdaten_csv import get_csv_engine, iter_csv_chunks
+from luftdaten_download import download_files
+from luftdaten_encoder import encode_bulk_documents
+from luftdaten_mapping import get_data_mapping, get_index_settings
+from luftdaten_metrics import get_report, reset_metrics
+from luftdaten_rollup import encode_rollups, select_rollup_columns
+
+es_doc_type = "sensor_data"
+
+# the filenames of the csv files in the archive and after the download
+ARCHIVE_FILENAME_FORMAT = '{0}_{1}_sensor_{2}.csv'
+DOWNLOAD_FILENAME_FORMAT = 'archive.luftdaten.info_{0}_{0}_{1}_sensor_{2}.csv'
+
+
+def generate_sensor_data(rows, sensor_type='SDS011', sensors=1000, date='2018-05-07', seed=0):
+    """
+        generates sensor data looking like the csv files of the archive (sds011: P1/P2, dht22: temperature/humidity)
+    :param rows: int the amount of measurements
+    :param sensor_type: str the sensor type
+    :param sensors: int the amount of different sensors
+    :param date: str the day of the measurements
+    :param seed: int the seed of the random generator
+    :return: pd.DataFrame
+    """
+    random = np.random.RandomState(seed)
+    
+    sensor_ids = random.randint(1, 20000, size=sensors)
+    sensor_index = np.sort(random.randint(0, sensors, size=rows))
+    seconds = random.randint(0, 24 * 60 * 60, size=rows)
+    
+    df = pd.DataFrame({
+        'sensor_id': sensor_ids[sensor_index],
+        'sensor_type': sensor_type,
+        'location': sensor_ids[sensor_index] + 1,
+        'lat': np.round(47 + sensor_ids[sensor_index] % 500 / 100, 3),
+        'lon': np.round(6 + sensor_ids[sensor_index] % 900 / 100, 3),
+        'timestamp': (pd.Timestamp(date) + pd.to_timedelta(seconds, unit='s')).strftime('%Y-%m-%dT%H:%M:%S'),
+    })
+    
+    if sensor_type.lower() in ('dht22', 'bme280'):
+        df['temperature'] = np.round(random.normal(15, 5, size=rows), 2)
+        df['humidity'] = np.round(random.uniform(20, 99, size=rows), 2)
+    else:
+        df['P1'] = np.round(random.gamma(2, 10, size=rows), 2)
+        df['durP1'] = np.nan
+        df['ratioP1'] = np.nan
+        df['P2'] = np.round(random.gamma(2, 5, size=rows), 2)
+        df['durP2'] = np.nan
+        df['ratioP2'] = np.nan
+    
+    return df
+
+
+def read_day_directory(directory):
+    """
+        reads all csv files of a downloaded day directory
+    :param directory: str the directory (data/luftdaten/YYYY-MM-DD)
+    :return: list of pd.DataFrame
+    """
+    return [pd.read_csv(csv_file, sep=';') for csv_file in sorted(glob.glob(os.path.join(directory, '*.csv')))]
+
+
+def generate_day_directory(directory, date='2018-05-07', files=200, rows_per_file=2500, seed=0, filename_format=DOWNLOAD_FILENAME_FORMAT):
+    """
+        writes generated csv files of a day in the original format of the archive
+        (YYYY-MM-DD/archive.luftdaten.info_YYYY-MM-DD_YYYY-MM-DD_<sensor>_sensor_<id>.csv)
+    :param directory: str the data directory
+    :param date: str the day
+    :param files: int the amount of csv files
+    :param rows_per_file: int the amount of measurements per file
+    :param seed: int the seed of the random generator
+    :param filename_format: str the format of the filenames (date, sensor type, sensor id)
+    :return: str the day directory
+    """
+    day_directory = os.path.join(directory, date)
+    os.makedirs(day_directory, exist_ok=True)
+    
+    sensor_types = ['sds011', 'dht22']
+    sensor_ids = set()
+    
+    for file_index in range(files):
+        sensor_type = sensor_types[file_index % len(sensor_types)]
+        df = generate_sensor_data(rows_per_file, sensor_type=sensor_type.upper(), sensors=1, date=date, seed=seed + file_index)
+        df = df.sort_values('timestamp')
+        
+        sensor_id = int(df['sensor_id'].iloc[0]) if len(df) else file_index
+        
+        # the generated ids can collide, each file of a day has its own sensor
+        while sensor_id in sensor_ids:
+            sensor_id += 1
+        sensor_ids.add(sensor_id)
+        
+        df['sensor_id'] = sensor_id
+        df['location'] = sensor_id + 1
+        
+        filename = filename_format.format(date, sensor_type, sensor_id)
+        df.to_csv(os.path.join(day_directory, filename), sep=';', index=False)
+    
+    return day_directory
+
+
+def generate_archive(directory, days=2, files_per_day=200, rows_per_file=500, last_date='2018-05-07', seed=0):
+    """
+        writes a synthetic archive: a directory per day (YYYY-MM-DD/) with the csv files of the sensors
+        (YYYY-MM-DD_<sensor>_sensor_<id>.csv) as served by archive.luftdaten.info
+    :param directory: str the root directory of the archive
+    :param days: int the amount of days (ending with the last date)
+    :param files_per_day: int the amount of csv files per day
+    :param rows_per_file: int the amount of measurements per file
+    :param last_date: str the most recent day
+    :param seed: int the seed of the random generator
+    :return: list of the day directories
+    """
+    last_day = datetime.strptime(last_date, '%Y-%m-%d')
+    
+    day_directories = []
+    for day in range(days):
+        date = (last_day - timedelta(days=day)).strftime('%Y-%m-%d')
+        day_directories.append(generate_day_directory(directory, date, files_per_day, rows_per_file, seed=seed, filename_format=ARCHIVE_FILENAME_FORMAT))
+    
+    return day_directories
+
+
+class QuietArchiveHandler(SimpleHTTPRequestHandler):
+    """
+        serves the synthetic archive (directory listings + csv files) without logging the requests
+    """
+    protocol_version = 'HTTP/1.1'
+    
+    def log_message(self, format, *args):
+        pass
+
+
+class BulkStubHandler(BaseHTTPRequestHandler):
+    """
+        answers the requests of the ingest like Elastic Search does, without storing the documents:
+        the indices are only kept by their names, each document of a bulk request is acknowledged as created
+    """
+    protocol_version = 'HTTP/1.1'
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def send_json(self, status, body=None):
+        payload = json.dumps(body if body is not None else {}).encode('utf-8')
+        
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(payload) if self.command != 'HEAD' else 0))
+        self.end_headers()
+        
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+    
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+    
+    def get_path(self):
+        return [part for part in self.path.split('?')[0].split('/') if part]
+    
+    def do_HEAD(self):
+        path = self.get_path()
+        self.send_json(200 if path and path[0] in self.server.indices else 404)
+    
+    def do_PUT(self):
+        path = self.get_path()
+        self.read_body()
+        
+        if len(path) == 1:
+            self.server.indices.add(path[0])
+        
+        self.send_json(200, {'acknowledged': True})
+    
+    def do_DELETE(self):
+        path = self.get_path()
+        
+        if path:
+            self.server.indices.discard(path[0])
+        
+        self.send_json(200, {'acknowledged': True})
+    
+    def get_response(self, path):
+        endpoint = path[-1] if path else ''
+        
+        if not path:
+            return {'version': {'number': '6.8.0'}}
+        if endpoint == '_settings':
+            return {index_name: {'settings': {}} for index_name in path[0].split(',')}
+        if endpoint == '_count':
+            return {'count': 0}
+        if endpoint == '_search':
+            return {'hits': {'total': 0, 'hits': []}}
+        
+        return {'acknowledged': True}
+    
+    def do_GET(self):
+        self.read_body()
+        self.send_json(200, self.get_response(self.get_path()))
+    
+    def do_POST(self):
+        path = self.get_path()
+        body = self.read_body()
+        
+        if not path or path[-1] != '_bulk':
+            self.send_json(200, self.get_response(path))
+            return
+        
+        lines = body.split(b'\n')
+        
+        items = []
+        for position in range(0, len(lines) - 1, 2):
+            operation, metadata = list(json.loads(lines[position]).items())[0]
+            items.append({operation: {'_index': metadata.get('_index'), '_id': metadata.get('_id'), 'status': 201, 'result': 'created'}})
+        
+        with self.server.lock:
+            self.server.documents += len(items)
+            self.server.bytes += len(body)
+        
+        # the latency of a cluster (see benchmark_queue)
+        if self.server.latency:
+            sleep(self.server.latency)
+        
+        self.send_json(200, {'took': 1, 'errors': False, 'items': items})
+
+
+def start_server(handler):
+    """
+        starts a local http server on a free port in a background thread
+    :param handler: the request handler class
+    :return: ThreadingHTTPServer (the url is http://127.0.0.1:<server.server_port>/)
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    
+    return server
+
+
+def start_archive_server(directory):
+    return start_server(partial(QuietArchiveHandler, directory=directory))
+
+
+def start_bulk_stub(latency=0):
+    server = start_server(BulkStubHandler)
+    server.latency = latency
+    server.indices = set()
+    server.documents = 0
+    server.bytes = 0
+    server.lock = threading.Lock()
+    
+    return server
+
+
+def get_commit():
+    """
+        the commit of the working copy (to compare the results of different commits)
+    :return: str or None if it is not a git repository
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_stage_result(seconds, items=None, bytes_count=None):
+    result = {'seconds': round(seconds, 3)}
+    
+    if items is not None:
+        result['items'] = items
+        result['items_per_second'] = round(items / seconds) if seconds > 0 else 0
+    
+    if bytes_count is not None:
+        result['bytes'] = bytes_count
+        result['mb_per_second'] = round(bytes_count / seconds / 1024 / 1024, 2) if seconds > 0 else 0
+    
+    return result
+
+
+def encode_legacy(df, index_name, file_date, file_id):
+    """
+        the previous encoding of collect_csv_data (a dict per row), serialized like elasticsearch.helpers.bulk does
+    """
+    df = df.copy()
+    df['timestamp'] = pd.to_datetime(df['timestamp'])
+    
+    records = df.where(pd.notnull(df), None).T.to_dict()
+    
+    lines = []
+    for df_index in records:
+        record = records[df_index]
+        record['file_date'] = file_date
+        record['file_id'] = file_id
+        record['geo_location'] = [record['lon'], record['lat']]
+        del record['lat']
+        del record['lon']
+        
+        lines.append(json.dumps({"index": {"_index": index_name, "_type": es_doc_type}}, separators=(',', ':')))
+        lines.append(json.dumps(record, separators=(',', ':'), default=str))
+    
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def encode_columnar(df, index_name, file_date, file_id):
+    return encode_bulk_documents(df, index_name, file_date, file_id)
+
+
+def time_encoder(encode, data_frames, repeat):
+    """
+        measures the best time of an encoder over all data frames
+    :return: tuple (float duration in seconds, int amount of bytes)
+    """
+    durations = []
+    bytes_count = 0
+    
+    for _ in range(repeat):
+        start_time = time()
+        bytes_count = 0
+        for file_id, df in enumerate(data_frames):
+            bytes_count += len(encode(df, 'luftdaten_2018-05', '2018-05-07', file_id))
+        durations.append(time() - start_time)
+    
+    return min(durations), bytes_count
+
+
+def benchmark_encoder(rows=1000000, directory=None, chunk_size=8 * 1024, repeat=3):
+    """
+        compares the legacy and the columnar encoding of a full day
+    :param rows: int the amount of generated measurements (if no directory is given)
+    :param directory: str optional day directory with downloaded csv files
+    :param chunk_size: int the amount of rows encoded at once (as read by collect_csv_data)
+    :param repeat: int the amount of runs (the best run is taken)
+    :return: dict the results
+    """
+    if directory:
+        data_frames = read_day_directory(directory)
+    else:
+        data_frames = [generate_sensor_data(rows)]
+    
+    # split into the chunks of the csv reader
+    chunks = [df.iloc[start:start + chunk_size] for df in data_frames for start in range(0, len(df), chunk_size)]
+    rows = sum(len(chunk) for chunk in chunks)
+    
+    results = {'benchmark': 'encoder', 'rows': rows, 'chunk_size': chunk_size}
+    
+    for name, encode in (('legacy', encode_legacy), ('columnar', encode_columnar)):
+        duration, bytes_count = time_encoder(encode, chunks, repeat)
+        results[name] = {'seconds': round(duration, 3), 'rows_per_second': round(rows / duration), 'bytes': bytes_count}
+        
+        message = "%s: encoded %s rows (%s bytes) in %.3fs. Speed (%s items/s)." % (name, rows, bytes_count, duration, round(rows / duration))
+        print(message)
+    
+    results['speedup'] = round(results['legacy']['seconds'] / results['columnar']['seconds'], 2)
+    print("Speedup: {}x".format(results['speedup']))
+    
+    return results
+
+
+def benchmark_parse(directory=None, workers_list=(1, 2, 4), chunk_size=BULK_MAX_DOCS):
+    """
+        measures the throughput of the parse stage with a different amount of processes
+    :param directory: str optional day directory with downloaded csv files (otherwise a day is generated)
+    :param workers_list: list the amounts of processes
+    :param chunk_size: int the amount of rows per chunk
+    :return: dict the results
+    """
+    temp_directory = None
+    
+    if not directory:
+        temp_directory = tempfile.mkdtemp(prefix='luftdaten_benchmark_')
+        directory = generate_day_directory(temp_directory)
+    
+    csv_files = sorted(glob.glob(os.path.join(directory, '*.csv')), key=lambda name: int(name.split('.')[-2].split('_')[-1]))
+    file_date = os.path.basename(os.path.normpath(directory))
+    files = [('luftdaten_benchmark', csv_file, file_date, int(csv_file.split('.')[-2].split('_')[-1])) for csv_file in csv_files]
+    
+    results = {'benchmark': 'parse', 'files': len(files), 'cpu_count': os.cpu_count(), 'runs': []}
+    
+    try:
+        for workers in workers_list:
+            start_time = time()
+            
+            with redirect_stdout(io.StringIO()):
+                if workers > 1:
+                    with ProcessPoolExecutor(max_workers=workers) as executor:
+                        chunks = list(iter_file_chunks_parallel(files, executor, chunk_size=chunk_size, max_pending=workers * 4))
+                else:
+                    chunks = list(iter_file_chunks(files, chunk_size=chunk_size))
+            
+            duration = time() - start_time
+            rows = sum(chunk[1] for chunk in chunks)
+            
+            run = {'workers': workers, 'rows': rows, 'seconds': round(duration, 3), 'rows_per_second': round(rows / duration)}
+            results['runs'].append(run)
+            
+            message = "%s workers: parsed %s rows of %s files in %.3fs. Speed (%s items/s)." % (workers, rows, len(files), duration, run['rows_per_second'])
+            print(message)
+    finally:
+        if temp_directory:
+            shutil.rmtree(temp_directory)
+    
+    # speedup compared to a single process
+    base = results['runs'][0]['rows_per_second']
+    for run in results['runs']:
+        run['speedup'] = round(run['rows_per_second'] / base, 2)
+    
+    return results
+
+
+def read_csv_inferred(csv_file, chunk_size):
+    """
+        the previous reading of collect_csv_data: the types are inferred and the timestamps are parsed for each chunk
+    """
+    for df in pd.read_csv(csv_file, sep=';', iterator=True, chunksize=chunk_size):
+        df['timestamp'] = pd.to_datetime(df['timestamp'])
+        yield df
+
+
+def benchmark_csv(directory=None, chunk_size=8 * 1024, repeat=3):
+    """
+        compares the inferred and the typed reading of the csv files of a day
+    :param directory: str optional day directory with downloaded csv files (otherwise a day is generated)
+    :param chunk_size: int the amount of rows per chunk
+    :param repeat: int the amount of runs (the best run is taken)
+    :return: dict the results
+    """
+    temp_directory = None
+    
+    if not directory:
+        temp_directory = tempfile.mkdtemp(prefix='luftdaten_benchmark_')
+        directory = generate_day_directory(temp_directory)
+    
+    csv_files = sorted(glob.glob(os.path.join(directory, '*.csv')))
+    
+    readers = [('inferred', read_csv_inferred), ('typed_c', lambda csv_file, size: iter_csv_chunks(csv_file, size, engine='c'))]
+    if get_csv_engine('pyarrow') == 'pyarrow':
+        readers.append(('typed_pyarrow', lambda csv_file, size: iter_csv_chunks(csv_file, size, engine='pyarrow')))
+    
+    results = {'benchmark': 'csv', 'files': len(csv_files), 'chunk_size': chunk_size}
+    
+    try:
+        for name, read in readers:
+            durations = []
+            rows = 0
+            
+            for _ in range(repeat):
+                start_time = time()
+                rows = sum(len(df) for csv_file in csv_files for df in read(csv_file, chunk_size))
+                durations.append(time() - start_time)
+            
+            duration = min(durations)
+            results[name] = {'rows': rows, 'seconds': round(duration, 3), 'rows_per_second': round(rows / duration)}
+            
+            message = "%s: read %s rows of %s files in %.3fs. Speed (%s items/s)." % (name, rows, len(csv_files), duration, round(rows / duration))
+            print(message)
+    finally:
+        if temp_directory:
+            shutil.rmtree(temp_directory)
+    
+    for name, _ in readers[1:]:
+        results[name]['speedup'] = round(results['inferred']['seconds'] / results[name]['seconds'], 2)
+    
+    return results
+
+
+def benchmark_ingest(days=2, files_per_day=200, rows_per_file=500, chunk_size=BULK_MAX_DOCS, output=None):
+    """
+        measures the stages of download_and_index on a synthetic archive served by a local http server, the bulk
+        requests are sent to a local stub of the bulk api
+    :param days: int the amount of days of the archive
+    :param files_per_day: int the amount of csv files per day
+    :param rows_per_file: int the amount of measurements per file
+    :param chunk_size: int the amount of rows per chunk
+    :param output: str optional file, the results are appended as one json line
+    :return: dict the results
+    """
+    import luftdaten_index
+    
+    temp_directory = tempfile.mkdtemp(prefix='luftdaten_benchmark_')
+    archive_directory = os.path.join(temp_directory, 'archive')
+    
+    generate_archive(archive_directory, days, files_per_day, rows_per_file)
+    
+    archive_server = start_archive_server(archive_directory)
+    bulk_stub = start_bulk_stub()
+    
+    archive_url = 'http://127.0.0.1:{}/'.format(archive_server.server_port)
+    es = Elasticsearch('http://127.0.0.1:{}/'.format(bulk_stub.server_port))
+    
+    results = {
+        'benchmark': 'ingest',
+        'commit': get_commit(),
+        'finished_at': None,
+        'cpu_count': os.cpu_count(),
+        'days': days,
+        'files_per_day': files_per_day,
+        'rows_per_file': rows_per_file,
+        'stages': {},
+    }
+    stages = results.get('stages')
+    
+    # the stores of the ingest (listings, checkpoints, sensors, ...) are relative to the working directory
+    previous_directory = os.getcwd()
+    previous_target_url, previous_es = luftdaten_index.target_url, luftdaten_index.es
+    
+    try:
+        luftdaten_index.target_url = archive_url
+        luftdaten_index.es = es
+        
+        with redirect_stdout(io.StringIO()):
+            os.makedirs(os.path.join(temp_directory, 'stages'))
+            os.chdir(os.path.join(temp_directory, 'stages'))
+            luftdaten_index.prepare_data_directory()
+            
+            # 1. listing of the archive (the listings of all days)
+            start_time = time()
+            jobs = list(luftdaten_index.iter_download_jobs(archive_url, luftdaten_index.data_directory, last_days=days))
+            stages['listing'] = get_stage_result(time() - start_time, len(jobs))
+            
+            # 2. download of the csv files
+            start_time = time()
+            download_files(jobs)
+            csv_files = sorted(target_filename for _, target_filename in jobs)
+            stages['download'] = get_stage_result(time() - start_time, len(csv_files), sum(os.path.getsize(csv_file) for csv_file in csv_files))
+            
+            # 3. parsing of the csv files (as read by the encoder)
+            start_time = time()
+            files = [(csv_file, list(iter_csv_chunks(csv_file, chunk_size, parse_dates=False))) for csv_file in csv_files]
+            rows = sum(len(df) for _, data_frames in files for df in data_frames)
+            stages['parse'] = get_stage_result(time() - start_time, rows)
+            
+            # 4. encoding of the bulk requests
+            start_time = time()
+            chunks = []
+            for file_id, (csv_file, data_frames) in enumerate(files):
+                file_date = os.path.basename(os.path.dirname(csv_file))
+                index_name = "luftdaten_benchmark_{}".format(file_date[:7])
+                row_offset = 0
+                
+                for df in data_frames:
+                    chunks.append((encode_bulk_documents(df, index_name, file_date, file_id, row_offset=row_offset), len(df), (file_date, file_id), False))
+                    row_offset += len(df)
+                chunks.append((b'', 0, (file_date, file_id), True))
+            stages['encode'] = get_stage_result(time() - start_time, rows, sum(len(chunk[0]) for chunk in chunks))
+            
+            # 5. hourly and daily rollups of the files (computed once per day, see luftdaten_bulk.iter_rollup_chunks)
+            start_time = time()
+            rollups_count = 0
+            day_files = {}
+            for file_id, (csv_file, data_frames) in enumerate(files):
+                day_files.setdefault(os.path.basename(os.path.dirname(csv_file)), []).extend(
+                    select_rollup_columns(df).assign(file=file_id) for df in data_frames)
+            for file_date, data_frames in day_files.items():
+                if data_frames:
+                    file_rollups = encode_rollups(pd.concat(data_frames, ignore_index=True), "luftdaten_benchmark_rollup_{}".format(file_date[:7]), key='file')
+                    rollups_count += sum(items_count for _, items_count in file_rollups.values())
+            stages['rollup'] = get_stage_result(time() - start_time, rollups_count)
+            
+            # 6. bulk requests (without the rollups)
+            start_time = time()
+            indexed_count, _, _ = stream_bulk(es, chunks)
+            stages['bulk'] = get_stage_result(time() - start_time, indexed_count, bulk_stub.bytes)
+            
+            # download_and_index end to end (with empty stores)
+            os.makedirs(os.path.join(temp_directory, 'end_to_end'))
+            os.chdir(os.path.join(temp_directory, 'end_to_end'))
+            documents_count = bulk_stub.documents
+            
+            # the metrics of the end to end run only (see luftdaten_metrics)
+            reset_metrics()
+            
+            start_time = time()
+            luftdaten_index.download_and_index('luftdaten_benchmark', 0, days)
+            stages['download_and_index'] = get_stage_result(time() - start_time, bulk_stub.documents - documents_count)
+            
+            results['metrics'] = get_report()
+    finally:
+        os.chdir(previous_directory)
+        luftdaten_index.target_url, luftdaten_index.es = previous_target_url, previous_es
+        
+        archive_server.shutdown()
+        bulk_stub.shutdown()
+        shutil.rmtree(temp_directory)
+    
+    results['finished_at'] = datetime.now().isoformat()
+    
+    for stage, result in stages.items():
+        message = "%s: %s items in %.3fs. Speed (%s items/s)." % (stage, result.get('items'), result.get('seconds'), result.get('items_per_second'))
+        print(message)
+    
+    if output:
+        directory = os.path.dirname(output)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        
+        with open(output, 'a') as fp:
+            fp.write(json.dumps(results, sort_keys=True) + '\n')
+    
+    return results
+
+
+def run_queue_worker(archive_url, bulk_url, database, working_directory, worker):
+    """
+        a worker process of benchmark_queue (the worker uses the synthetic archive and the bulk stub)
+    """
+    import luftdaten_index
+    from luftdaten_queue import run_worker
+    
+    os.makedirs(working_directory)
+    os.chdir(working_directory)
+    
+    luftdaten_index.target_url = archive_url
+    luftdaten_index.es = Elasticsearch(bulk_url)
+    
+    with redirect_stdout(io.StringIO()):
+        luftdaten_index.prepare_data_directory()
+        run_worker([luftdaten_index.create_ingest_job('luftdaten_benchmark')], database, worker=worker, poll_seconds=0.1)
+
+
+def benchmark_queue(workers_list=(1, 2, 4), days=8, files_per_day=50, rows_per_file=500, bulk_latency=0.05):
+    """
+        measures the throughput of the distributed ingest with a different amount of worker processes
+    :param workers_list: list the amounts of workers
+    :param days: int the amount of days of the archive (the work items)
+    :param files_per_day: int the amount of csv files per day
+    :param rows_per_file: int the amount of measurements per file
+    :param bulk_latency: float the latency of the bulk requests in seconds
+    :return: dict the results
+    """
+    from luftdaten_queue import connect as connect_queue, enqueue_items
+    
+    temp_directory = tempfile.mkdtemp(prefix='luftdaten_benchmark_')
+    archive_directory = os.path.join(temp_directory, 'archive')
+    
+    generate_archive(archive_directory, days, files_per_day, rows_per_file)
+    dates = sorted(os.listdir(archive_directory), reverse=True)
+    
+    archive_server = start_archive_server(archive_directory)
+    bulk_stub = start_bulk_stub(bulk_latency)
+    
+    archive_url = 'http://127.0.0.1:{}/'.format(archive_server.server_port)
+    bulk_url = 'http://127.0.0.1:{}/'.format(bulk_stub.server_port)
+    
+    results = {'benchmark': 'queue', 'commit': get_commit(), 'cpu_count': os.cpu_count(), 'days': days, 'files_per_day': files_per_day,
+               'rows_per_file': rows_per_file, 'bulk_latency': bulk_latency, 'runs': []}
+    
+    # the workers are forked (they take over the imported modules)
+    context = multiprocessing.get_context('fork')
+    
+    try:
+        for workers in workers_list:
+            run_directory = os.path.join(temp_directory, 'workers_{}'.format(workers))
+            database = os.path.join(run_directory, 'queue.sqlite')
+            
+            os.makedirs(run_directory)
+            enqueue_items(connect_queue(database), dates)
+            
+            documents_count = bulk_stub.documents
+            start_time = time()
+            
+            processes = [context.Process(target=run_queue_worker, args=(archive_url, bulk_url, database, os.path.join(run_directory, 'worker_{}'.format(number)),
+                                                                        'worker_{}'.format(number))) for number in range(workers)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            
+            duration = time() - start_time
+            documents_count = bulk_stub.documents - documents_count
+            
+            run = {'workers': workers, 'documents': documents_count, 'seconds': round(duration, 3), 'docs_per_second': round(documents_count / duration)}
+            results['runs'].append(run)
+            
+            message = "%s workers: %s documents of %s days in %.3fs. Speed (%s items/s)." % (workers, documents_count, days, duration, run['docs_per_second'])
+            print(message)
+    finally:
+        archive_server.shutdown()
+        bulk_stub.shutdown()
+        shutil.rmtree(temp_directory)
+    
+    for run in results['runs']:
+        run['speedup'] = round(run['docs_per_second'] / results['runs'][0]['docs_per_second'], 2)
+    
+    return results
+
+
+def benchmark_mapping(directory=None, chunk_size=BULK_MAX_DOCS):
+    """
+        compares the size of a day indexed with the dynamic mapping and with the explicit mapping on a cluster
+    :param directory: str optional day directory with downloaded csv files (otherwise a day is generated)
+    :param chunk_size: int the amount of rows per chunk
+    :return: dict the results
+    """
+    from luftdaten_index import es
+    
+    temp_directory = None
+    
+    if not directory:
+        temp_directory = tempfile.mkdtemp(prefix='luftdaten_benchmark_')
+        directory = generate_day_directory(temp_directory)
+    
+    csv_files = sorted(glob.glob(os.path.join(directory, '*.csv')), key=lambda name: int(name.split('.')[-2].split('_')[-1]))
+    file_date = os.path.basename(os.path.normpath(directory))
+    
+    mappings = [
+        ('dynamic', {"settings": {"number_of_shards": 1, "number_of_replicas": 0}}),
+        ('explicit', {"settings": get_index_settings({"number_of_shards": 1, "number_of_replicas": 0}),
+                      "mappings": {es_doc_type: get_data_mapping()}}),
+    ]
+    
+    results = {'benchmark': 'mapping', 'files': len(csv_files), 'commit': get_commit()}
+    
+    try:
+        for name, body in mappings:
+            index_name = 'luftdaten_benchmark_mapping_' + name
+            
+            es.indices.delete(index=index_name, ignore=404)
+            es.indices.create(index=index_name, body=body)
+            
+            files = [(index_name, csv_file, file_date, int(csv_file.split('.')[-2].split('_')[-1])) for csv_file in csv_files]
+            
+            try:
+                start_time = time()
+                
+                with redirect_stdout(io.StringIO()):
+                    indexed_count, failed_count, _ = stream_bulk(es, iter_file_chunks(files, chunk_size=chunk_size))
+                
+                duration = time() - start_time
+                
+                es.indices.refresh(index=index_name)
+                es.indices.forcemerge(index=index_name, max_num_segments=1, request_timeout=3600)
+                
+                stats = es.indices.stats(index=index_name, metric='store,docs').get('indices').get(index_name).get('primaries')
+                
+                results[name] = {
+                    'documents': indexed_count,
+                    'failed': failed_count,
+                    'seconds': round(duration, 3),
+                    'store_bytes': stats.get('store').get('size_in_bytes'),
+                    'bytes_per_document': round(stats.get('store').get('size_in_bytes') / max(stats.get('docs').get('count'), 1), 1),
+                }
+            finally:
+                es.indices.delete(index=index_name, ignore=404)
+            
+            message = "%s: %s documents, %s bytes (%s bytes per document)." % (name, results[name]['documents'], results[name]['store_bytes'], results[name]['bytes_per_document'])
+            print(message)
+    finally:
+        if temp_directory:
+            shutil.rmtree(temp_directory)
+    
+    results['size_ratio'] = round(results['explicit']['store_bytes'] / max(results['dynamic']['store_bytes'], 1), 3)
+    
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the luftdaten.info ingest pipeline')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+    
+    parser_encoder = subparsers.add_parser('encoder', help='legacy vs. columnar encoding of the bulk requests')
+    parser_encoder.add_argument('--rows', type=int, default=1000000, help='amount of generated measurements')
+    parser_encoder.add_argument('--directory', help='day directory with downloaded csv files (instead of generated data)')
+    parser_encoder.add_argument('--chunk-size', type=int, default=8 * 1024)
+    parser_encoder.add_argument('--repeat', type=int, default=3)
+    
+    parser_parse = subparsers.add_parser('parse', help='throughput of the parse stage with 1..n processes')
+    parser_parse.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser_parse.add_argument('--directory', help='day directory with downloaded csv files (instead of generated data)')
+    parser_parse.add_argument('--chunk-size', type=int, default=BULK_MAX_DOCS)
+    
+    parser_csv = subparsers.add_parser('csv', help='inferred vs. typed reading of the csv files')
+    parser_csv.add_argument('--directory', help='day directory with downloaded csv files (instead of generated data)')
+    parser_csv.add_argument('--chunk-size', type=int, default=8 * 1024)
+    parser_csv.add_argument('--repeat', type=int, default=3)
+    
+    parser_ingest = subparsers.add_parser('ingest', help='the stages of download_and_index on a synthetic archive')
+    parser_ingest.add_argument('--days', type=int, default=2)
+    parser_ingest.add_argument('--files-per-day', type=int, default=200)
+    parser_ingest.add_argument('--rows-per-file', type=int, default=500)
+    parser_ingest.add_argument('--chunk-size', type=int, default=BULK_MAX_DOCS)
+    parser_ingest.add_argument('--output', help='file the results are appended to (one json line per run)')
+    
+    parser_queue = subparsers.add_parser('queue', help='throughput of the distributed ingest with 1..n workers')
+    parser_queue.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser_queue.add_argument('--days', type=int, default=8)
+    parser_queue.add_argument('--files-per-day', type=int, default=50)
+    parser_queue.add_argument('--rows-per-file', type=int, default=500)
+    parser_queue.add_argument('--bulk-latency', type=float, default=0.05, help='latency of the bulk requests in seconds')
+    
+    parser_mapping = subparsers.add_parser('mapping', help='dynamic vs. explicit mapping: size of a day on a cluster')
+    parser_mapping.add_argument('--directory', help='day directory with downloaded csv files (instead of generated data)')
+    parser_mapping.add_argument('--chunk-size', type=int, default=BULK_MAX_DOCS)
+    
+    args = parser.parse_args()
+    
+    if args.benchmark == 'encoder':
+        results = benchmark_encoder(args.rows, args.directory, args.chunk_size, args.repeat)
+    elif args.benchmark == 'parse':
+        results = benchmark_parse(args.directory, args.workers, args.chunk_size)
+    elif args.benchmark == 'csv':
+        results = benchmark_csv(args.directory, args.chunk_size, args.repeat)
+    elif args.benchmark == 'ingest':
+        results = benchmark_ingest(args.days, args.files_per_day, args.rows_per_file, args.chunk_size, args.output)
+    elif args.benchmark == 'queue':
+        results = benchmark_queue(args.workers, args.days, args.files_per_day, args.rows_per_file, args.bulk_latency)
+    elif args.benchmark == 'mapping':
+        results = benchmark_mapping(args.directory, args.chunk_size)
+    
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
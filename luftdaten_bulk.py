@@ -0,0 +1,531 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+####
+# streaming bulk indexing of the csv files into Elastic Search
+#
+# 1. the csv files are read in chunks, each chunk is encoded into the body of a bulk request (see luftdaten_encoder)
+# 2. the chunks are collected into batches, which are limited by their size in bytes and their amount of documents
+# 3. a file is only reported as done, once all of its documents have been acknowledged by Elastic Search
+#
+# only a bounded amount of batches is held in memory, independent of the size and the amount of the csv files
+#
+# optionally the csv files are read and encoded by a pool of processes (PARSE_WORKERS) and the batches are sent by
+# multiple threads (INDEX_WORKERS), the files are still reported as done in the order of their file ids
+#
+# optionally the hourly and daily rollups of the files are computed (see luftdaten_rollup), the rollups of all files
+# of a call (a day) are computed at once after the files have been read, the files are only ended after their rollups
+#
+# the size of the batches adapts to the cluster: it grows while the bulk requests are answered faster than
+# BULK_TARGET_SECONDS and shrinks when they are slower or the cluster rejects documents (429), only the rejected
+# documents are sent again (with an exponential backoff)
+###
+
+__author__ = 'Martin Andreas Woerz'
+__email__ = 'm.woerz@ieservices.de'
+__copyright__ = "Copyright 2018, Martin Woerz"
+__version__ = "0.0.7"
+
+import os
+import queue
+import random
+import threading
+from collections import deque
+from time import sleep, time
+
+import numpy as np
+import pandas as pd
+from elasticsearch import TransportError
+
+from luftdaten_encoder import iter_csv_documents, retarget_bulk_documents
+from luftdaten_metrics import increment, observe, merge_metrics, reset_metrics, snapshot_metrics
+from luftdaten_rollup import encode_rollups, get_rollup_index_name, select_rollup_columns
+
+# the limits of a single bulk request
+BULK_MAX_BYTES = int(os.environ.get("BULK_MAX_BYTES")) if 'BULK_MAX_BYTES' in os.environ else 10 * 1024 * 1024
+BULK_MAX_DOCS = int(os.environ.get("BULK_MAX_DOCS")) if 'BULK_MAX_DOCS' in os.environ else 5000
+
+# the amount of processes reading and encoding the csv files and the amount of threads sending the bulk requests
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS")) if 'PARSE_WORKERS' in os.environ else os.cpu_count() or 1
+INDEX_WORKERS = int(os.environ.get("INDEX_WORKERS")) if 'INDEX_WORKERS' in os.environ else 1
+
+# the size of the csv files, which are parsed ahead by the processes (the encoded files are held in memory until
+# they are sent), at least one file is parsed
+PARSE_MAX_PENDING_BYTES = int(os.environ.get("PARSE_MAX_PENDING_BYTES")) if 'PARSE_MAX_PENDING_BYTES' in os.environ else 64 * 1024 * 1024
+
+# adaptive size of the bulk requests (set env: BULK_ADAPTIVE=0 to always use BULK_MAX_BYTES)
+BULK_ADAPTIVE = not os.environ.get("BULK_ADAPTIVE") == "0" if 'BULK_ADAPTIVE' in os.environ else True
+BULK_MIN_BYTES = int(os.environ.get("BULK_MIN_BYTES")) if 'BULK_MIN_BYTES' in os.environ else 512 * 1024
+BULK_TARGET_SECONDS = float(os.environ.get("BULK_TARGET_SECONDS")) if 'BULK_TARGET_SECONDS' in os.environ else 1.0
+
+# the retries of the documents rejected by the cluster (429) and the backoff between them in seconds
+BULK_RETRIES = int(os.environ.get("BULK_RETRIES")) if 'BULK_RETRIES' in os.environ else 8
+BULK_BACKOFF = float(os.environ.get("BULK_BACKOFF")) if 'BULK_BACKOFF' in os.environ else 0.5
+
+
+def iter_file_chunks(csv_files, chunk_size=BULK_MAX_DOCS, rollups=False):
+    """
+        reads the csv files one after another and yields their encoded chunks
+    :param csv_files: iterable of (index name, csv file, file date, file id) tuples, which is consumed lazily
+    :param chunk_size: int the amount of rows per chunk
+    :param rollups: bool also yield the rollups of the files (indexed into the rollup index of the index, see iter_rollup_chunks)
+    :return: generator of (bytes the body of the bulk request, int the amount of documents, tuple (file date, file id), bool the last chunk of the file)
+    """
+    rollup_files = []
+    
+    for index_name, csv_file, file_date, file_id in csv_files:
+        message = "Reading file '{}'".format(csv_file)
+        print("      " + message)
+        
+        file_key = (file_date, file_id)
+        
+        rollup_data_frames = []
+        on_chunk = (lambda df: rollup_data_frames.append(select_rollup_columns(df))) if rollups else None
+        
+        try:
+            for payload, items_count in iter_csv_documents(index_name, csv_file, file_id, chunk_size, on_chunk):
+                yield payload, items_count, file_key, False
+        except Exception as e:
+            # the file is not ended (the chunks sent so far are overwritten, when the file is indexed again)
+            report_parse_error(csv_file, e)
+            continue
+        
+        if rollups:
+            # the file is ended after its rollups
+            rollup_files.append((get_rollup_index_name(index_name), file_key, rollup_data_frames))
+        else:
+            # marks the end of the file (also for empty files)
+            yield b'', 0, file_key, True
+    
+    if rollup_files:
+        yield from iter_rollup_chunks(rollup_files)
+
+
+def report_parse_error(csv_file, error):
+    """
+        reports a csv file, which can not be read (the file is skipped and is indexed again by the next run)
+    """
+    increment('files_parse_failed_total')
+    message = "Error in reading the file '{}'. Details:\n  {}".format(csv_file, error)
+    print("      " + message)
+
+
+def iter_rollup_chunks(rollup_files):
+    """
+        computes the rollups of the files at once (one aggregation per rollup index instead of one per file) and yields
+        the rollups of each file followed by the end of the file
+    :param rollup_files: list of (str the rollup index, tuple the file key, list of pd.DataFrame the rollup columns of the chunks of the file)
+    :return: generator of chunks (see iter_file_chunks)
+    """
+    index_positions = {}
+    for position, (rollup_index_name, _, _) in enumerate(rollup_files):
+        index_positions.setdefault(rollup_index_name, []).append(position)
+    
+    file_rollups = {}
+    
+    try:
+        for rollup_index_name, positions in index_positions.items():
+            data_frames = [df for position in positions for df in rollup_files[position][2]]
+            
+            if not data_frames:
+                continue
+            
+            # the rows are assigned to their files, the rollups are encoded per file
+            data = pd.concat(data_frames, ignore_index=True, sort=False)
+            data['file'] = np.repeat(positions, [sum(len(df) for df in rollup_files[position][2]) for position in positions])
+            
+            file_rollups.update(encode_rollups(data, rollup_index_name, key='file'))
+    except Exception as e:
+        # none of the files is ended, they are indexed again by the next run
+        increment('files_parse_failed_total', len(rollup_files))
+        message = "Error in computing the rollups of {} files. Details:\n  {}".format(len(rollup_files), e)
+        print("      " + message)
+        return
+    
+    for position, (_, file_key, _) in enumerate(rollup_files):
+        payload, items_count = file_rollups.get(position, (b'', 0))
+        
+        if items_count > 0:
+            increment('rollup_documents_total', items_count)
+            increment('encoded_bytes_total', len(payload))
+            
+            yield payload, items_count, file_key, False
+        
+        yield b'', 0, file_key, True
+
+
+def create_bulk_limits(max_bytes=BULK_MAX_BYTES, min_bytes=BULK_MIN_BYTES, target_seconds=BULK_TARGET_SECONDS):
+    """
+        creates the adaptive limit of the size of the bulk requests, it starts at a quarter of the maximum size
+    :param max_bytes: int the maximum size of a bulk request in bytes
+    :param min_bytes: int the minimum size of a bulk request in bytes
+    :param target_seconds: float the target duration of a bulk request
+    :return: dict the limits
+    """
+    min_bytes = min(min_bytes, max_bytes)
+    
+    return {
+        'bytes': max(min_bytes, max_bytes // 4),
+        'min_bytes': min_bytes,
+        'max_bytes': max_bytes,
+        'target_seconds': target_seconds,
+        'lock': threading.Lock(),
+    }
+
+
+def adapt_bulk_limits(limits, batch_bytes, duration, rejected):
+    """
+        grows the size of the bulk requests while the cluster keeps up, shrinks it when it is overloaded
+    :param limits: dict the limits (see create_bulk_limits)
+    :param batch_bytes: int the size of the sent bulk request
+    :param duration: float the duration of the bulk request
+    :param rejected: bool documents have been rejected by the cluster
+    """
+    with limits.get('lock'):
+        current_bytes = limits.get('bytes')
+        
+        if rejected or duration > limits.get('target_seconds'):
+            current_bytes = current_bytes // 2
+        elif duration < limits.get('target_seconds') / 2 and batch_bytes >= current_bytes / 2:
+            # only grow, if the request has been filled (the last request of a file can be small)
+            current_bytes = int(current_bytes * 1.5)
+        
+        limits['bytes'] = min(max(current_bytes, limits.get('min_bytes')), limits.get('max_bytes'))
+
+
+def iter_batches(chunks, max_bytes=BULK_MAX_BYTES, max_docs=BULK_MAX_DOCS, limits=None):
+    """
+        collects the chunks into batches, a batch is closed before it would exceed one of the limits
+    :param chunks: iterable of chunks (see iter_file_chunks)
+    :param max_bytes: int the maximum size of a batch in bytes
+    :param max_docs: int the maximum amount of documents of a batch
+    :param limits: dict optional adaptive limit of the size of a batch (see create_bulk_limits)
+    :return: generator of lists of chunks
+    """
+    batch = []
+    batch_bytes = 0
+    batch_docs = 0
+    
+    for chunk in chunks:
+        payload, items_count = chunk[0], chunk[1]
+        
+        if limits is not None:
+            max_bytes = limits.get('bytes')
+        
+        if batch and (batch_bytes + len(payload) > max_bytes or batch_docs + items_count > max_docs):
+            yield batch
+            batch = []
+            batch_bytes = 0
+            batch_docs = 0
+        
+        batch.append(chunk)
+        batch_bytes += len(payload)
+        batch_docs += items_count
+    
+    if batch:
+        yield batch
+
+
+def is_rejected(item):
+    """
+        checks if a document has been rejected by the cluster because of its load (it can be sent again)
+    :param item: dict the result of a document of a bulk response
+    :return: bool
+    """
+    result = list(item.values())[0]
+    error = result.get('error')
+    
+    return result.get('status') == 429 or (isinstance(error, dict) and error.get('type') == 'es_rejected_execution_exception')
+
+
+def send_batch(es, batch, retries=BULK_RETRIES, backoff=BULK_BACKOFF, limits=None):
+    """
+        sends a batch as one bulk request, the documents rejected by the cluster (429) are sent again
+    :param es: Elasticsearch the client
+    :param batch: list of chunks
+    :param retries: int the amount of retries of the rejected documents
+    :param backoff: float the backoff in seconds before the first retry (doubled for each retry)
+    :param limits: dict optional adaptive limit of the size of the bulk requests (see create_bulk_limits)
+    :return: tuple (int the amount of indexed documents, list of the errors of the failed documents, set of the files of the failed documents)
+    """
+    items_count = sum(chunk[1] for chunk in batch)
+    
+    if items_count == 0:
+        return 0, [], set()
+    
+    # each document consists of two lines (action + source), the documents are mapped back to their files
+    lines = b''.join(chunk[0] for chunk in batch).split(b'\n')
+    documents = [lines[position] + b'\n' + lines[position + 1] + b'\n' for position in range(0, items_count * 2, 2)]
+    document_files = [chunk[2] for chunk in batch for _ in range(chunk[1])]
+    
+    pending = list(range(items_count))
+    errors = []
+    failed_files = set()
+    
+    for attempt in range(retries + 1):
+        payload = b''.join(documents[position] for position in pending)
+        
+        start_time = time()
+        
+        try:
+            response = es.bulk(body=payload)
+        except TransportError as e:
+            if e.status_code != 429:
+                raise
+            
+            # the whole request has been rejected
+            response = {'errors': True, 'items': [{'index': {'status': 429, 'error': str(e)}}] * len(pending)}
+        
+        duration = time() - start_time
+        rejected = []
+        
+        if response.get('errors'):
+            for position, item in zip(pending, response.get('items')):
+                if is_rejected(item):
+                    rejected.append(position)
+                elif 'error' in list(item.values())[0]:
+                    errors.append(item)
+                    failed_files.add(document_files[position])
+        
+        increment('bulk_requests_total')
+        increment('bulk_bytes_total', len(payload))
+        increment('documents_sent_total', len(pending))
+        increment('documents_rejected_total', len(rejected))
+        observe('bulk_request_seconds', duration)
+        
+        if limits is not None:
+            adapt_bulk_limits(limits, len(payload), duration, len(rejected) > 0)
+        
+        pending = rejected
+        
+        if not pending:
+            break
+        
+        if attempt < retries:
+            delay = backoff * 2 ** attempt
+            
+            message = "{} items have been rejected by the cluster, retrying in {:.1f}s".format(len(pending), delay)
+            print("    " + message)
+            
+            sleep(delay + random.uniform(0, delay / 2))
+    
+    # the documents, which are still rejected after the last retry
+    for position in pending:
+        errors.append({'index': {'status': 429, 'error': 'rejected after {} retries'.format(retries)}})
+        failed_files.add(document_files[position])
+    
+    return items_count - len(errors), errors, failed_files
+
+
+def encode_csv_file(index_name, csv_file, file_date, file_id, chunk_size=BULK_MAX_DOCS, rollups=False):
+    """
+        reads and encodes a complete csv file (runs in the processes of the parse stage)
+    :return: tuple (list of (bytes the body of the bulk request, int the amount of documents), list of pd.DataFrame the
+             rollup columns of the chunks (empty without rollups), dict the metrics of the file)
+    """
+    # the metrics of the file are returned to the main process (see iter_file_chunks_parallel)
+    metrics = reset_metrics()
+    
+    rollup_data_frames = []
+    on_chunk = (lambda df: rollup_data_frames.append(select_rollup_columns(df))) if rollups else None
+    
+    chunks = list(iter_csv_documents(index_name, csv_file, file_id, chunk_size, on_chunk))
+    
+    return chunks, rollup_data_frames, snapshot_metrics(metrics)
+
+
+def iter_file_chunks_parallel(csv_files, executor, chunk_size=BULK_MAX_DOCS, max_pending=None, rollups=False, max_pending_bytes=PARSE_MAX_PENDING_BYTES,
+                              parse_workers=PARSE_WORKERS):
+    """
+        reads and encodes the csv files in parallel in a process pool, the chunks are yielded in the order of the files
+        (the file index relies on the order of the file ids to continue the import)
+    :param csv_files: iterable of (index name, csv file, file date, file id) tuples, which is consumed lazily
+    :param executor: concurrent.futures.ProcessPoolExecutor the parse stage
+    :param chunk_size: int the amount of rows per chunk
+    :param max_pending: int the maximum amount of files which are parsed ahead (default: 4 files per process of the executor)
+    :param rollups: bool also yield the rollups of the files (see iter_rollup_chunks)
+    :param max_pending_bytes: int the maximum size of the csv files which are parsed ahead (limits the memory usage)
+    :param parse_workers: int the amount of processes of the executor
+    :return: generator of chunks (see iter_file_chunks)
+    """
+    if max_pending is None:
+        max_pending = 4 * parse_workers
+    
+    pending = deque()
+    pending_bytes = 0
+    csv_files = iter(csv_files)
+    rollup_files = []
+    
+    while True:
+        # keep the parse stage busy
+        while len(pending) < max_pending and (not pending or pending_bytes < max_pending_bytes):
+            csv_file_job = next(csv_files, None)
+            
+            if csv_file_job is None:
+                break
+            
+            index_name, csv_file, file_date, file_id = csv_file_job
+            file_size = os.path.getsize(csv_file) if os.path.exists(csv_file) else 0
+            
+            future = executor.submit(encode_csv_file, index_name, csv_file, file_date, file_id, chunk_size, rollups)
+            pending.append((future, index_name, csv_file, (file_date, file_id), file_size))
+            pending_bytes += file_size
+        
+        if not pending:
+            break
+        
+        future, index_name, csv_file, file_key, file_size = pending.popleft()
+        pending_bytes -= file_size
+        
+        try:
+            file_chunks, rollup_data_frames, file_metrics = future.result()
+        except Exception as e:
+            report_parse_error(csv_file, e)
+            continue
+        
+        merge_metrics(file_metrics)
+        
+        for payload, items_count in file_chunks:
+            yield payload, items_count, file_key, False
+        
+        if rollups:
+            rollup_files.append((get_rollup_index_name(index_name), file_key, rollup_data_frames))
+        else:
+            yield b'', 0, file_key, True
+    
+    if rollup_files:
+        yield from iter_rollup_chunks(rollup_files)
+
+
+def iter_routed_chunks(chunks, file_routes, rollups=False):
+    """
+        sends the chunks of each file to all of its target indices (a file is read and encoded only once, see
+        luftdaten_index.index_jobs)
+    :param chunks: iterable of chunks (see iter_file_chunks) encoded for the first target of their file
+    :param file_routes: dict (file date, file id) => list of (job name, index name) the targets of the file
+    :param rollups: bool the chunks contain the rollups of the files
+    :return: generator of chunks, the file of a chunk is (job name, file date, file id)
+    """
+    for payload, items_count, file_key, last_chunk in chunks:
+        targets = file_routes.get(file_key)
+        index_name = targets[0][1]
+        
+        for job_name, target_index_name in targets:
+            target_payload = retarget_bulk_documents(payload, index_name, target_index_name)
+            
+            if rollups:
+                target_payload = retarget_bulk_documents(target_payload, get_rollup_index_name(index_name), get_rollup_index_name(target_index_name))
+            
+            yield target_payload, items_count, (job_name,) + file_key, last_chunk
+
+
+def stream_bulk(es, chunks, max_bytes=BULK_MAX_BYTES, max_docs=BULK_MAX_DOCS, on_file_done=None, index_workers=INDEX_WORKERS, adaptive=BULK_ADAPTIVE):
+    """
+        indexes the chunks batch by batch
+    :param es: Elasticsearch the client
+    :param chunks: iterable of chunks (see iter_file_chunks), which is consumed lazily
+    :param max_bytes: int the maximum size of a bulk request in bytes
+    :param max_docs: int the maximum amount of documents of a bulk request
+    :param on_file_done: function optional callback, which is called with (file date, file id) once all documents of a file have been indexed
+    :param index_workers: int the amount of threads sending bulk requests in parallel
+    :param adaptive: bool adapt the size of the bulk requests (up to max_bytes) to the latency of the cluster
+    :return: tuple (int the amount of indexed documents, int the amount of failed documents, list of the failed files)
+    """
+    start_time = time()
+    
+    limits = create_bulk_limits(max_bytes) if adaptive else None
+    
+    stats = {'indexed': 0, 'failed': 0}
+    failed_files = set()
+    
+    # the batches are acknowledged in the order they have been created (the files are reported as done in their order)
+    sent_batches = {}
+    next_batch = [0]
+    lock = threading.Lock()
+    
+    def send(batch):
+        batch_start_time = time()
+        batch_items_count = sum(chunk[1] for chunk in batch)
+        
+        try:
+            batch_indexed_count, errors, batch_failed_files = send_batch(es, batch, limits=limits)
+        except Exception as e:
+            batch_indexed_count, errors = 0, [e]
+            batch_failed_files = set(chunk[2] for chunk in batch if chunk[1] > 0)
+            message = "Error in indexing. Details:\n  {}".format(e)
+            print("  " + message)
+        
+        if errors:
+            message = "{} items have not been indexed. First error:\n  {}".format(batch_items_count - batch_indexed_count, errors[0])
+            print("  " + message)
+        
+        duration = time() - batch_start_time
+        speed = batch_items_count / duration if duration > 0 else 0
+        message = "Indexing of batch done. Wrote %s items (%s bytes) in %.3fs. Speed (%s items/s)." % (batch_indexed_count, sum(len(chunk[0]) for chunk in batch), duration, round(speed, 2))
+        print("    " + message)
+        
+        return batch_indexed_count, errors, batch_failed_files
+    
+    def acknowledge(batch_number, batch, batch_indexed_count, errors, batch_failed_files):
+        with lock:
+            sent_batches[batch_number] = (batch, batch_indexed_count, errors, batch_failed_files)
+            
+            while next_batch[0] in sent_batches:
+                batch, batch_indexed_count, errors, batch_failed_files = sent_batches.pop(next_batch[0])
+                next_batch[0] += 1
+                
+                if errors:
+                    # only the files of the failed documents are failed (and are not reported as done)
+                    failed_files.update(batch_failed_files)
+                    batch_failed_count = sum(chunk[1] for chunk in batch) - batch_indexed_count
+                    stats['failed'] += batch_failed_count
+                    increment('documents_failed_total', batch_failed_count)
+                
+                stats['indexed'] += batch_indexed_count
+                increment('documents_indexed_total', batch_indexed_count)
+                
+                # all chunks of a file have been sent in this or in a previous batch
+                for payload, items_count, file_key, last_chunk in batch:
+                    if last_chunk and file_key not in failed_files and on_file_done is not None:
+                        on_file_done(*file_key)
+    
+    if index_workers > 1:
+        # the batches are handed over to the indexing workers by a bounded queue
+        batch_queue = queue.Queue(maxsize=index_workers * 2)
+        
+        def index_worker():
+            while True:
+                item = batch_queue.get()
+                
+                if item is None:
+                    break
+                
+                try:
+                    acknowledge(item[0], item[1], *send(item[1]))
+                except Exception as e:
+                    message = "Error in acknowledging the indexed batch. Details:\n  {}".format(e)
+                    print("  " + message)
+        
+        workers = [threading.Thread(target=index_worker, daemon=True) for _ in range(index_workers)]
+        for worker in workers:
+            worker.start()
+        
+        try:
+            for batch_number, batch in enumerate(iter_batches(chunks, max_bytes, max_docs, limits)):
+                batch_queue.put((batch_number, batch))
+        finally:
+            for _ in workers:
+                batch_queue.put(None)
+            for worker in workers:
+                worker.join()
+    else:
+        for batch_number, batch in enumerate(iter_batches(chunks, max_bytes, max_docs, limits)):
+            acknowledge(batch_number, batch, *send(batch))
+    
+    duration = time() - start_time
+    speed = stats['indexed'] / duration if duration > 0 else 0
+    message = "Overall speed: Wrote %s items in %.3fs (%s failed). Speed (%s items/s)." % (stats['indexed'], duration, stats['failed'], round(speed, 2))
+    print("  " + message)
+    
+    return stats['indexed'], stats['failed'], sorted(failed_files)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+####
+# bulk load mode of the indices filled by an ingest run
+#
+# 1. before an index is filled, its settings are saved and replaced by settings for bulk loading: no refreshes,
+#    asynchronous translog and no replicas
+# 2. after the run the original settings are restored, the index is refreshed and optionally force merged
+# 3. the original settings are kept in a local state file until they have been restored, after a crash they are
+#    restored by the recovery command:
+#   python luftdaten_bulk_load.py restore [--force-merge]
+#
+# each ingest run is recorded with its throughput (docs/s), with and without the bulk load mode:
+#   python luftdaten_bulk_load.py runs
+###
+
+__author__ = 'Martin Andreas Woerz'
+__email__ = 'm.woerz@ieservices.de'
+__copyright__ = "Copyright 2018, Martin Woerz"
+__version__ = "0.0.7"
+
+import argparse
+import json
+import os
+from datetime import datetime
+
+# enable the bulk load mode for the ingest runs (set env: BULK_LOAD=1)
+BULK_LOAD = os.environ.get("BULK_LOAD") == "1" if 'BULK_LOAD' in os.environ else False
+
+BULK_LOAD_STATE = os.environ.get("BULK_LOAD_STATE") if 'BULK_LOAD_STATE' in os.environ else 'data/luftdaten_bulk_load.json'
+BULK_LOAD_RUNS = os.environ.get("BULK_LOAD_RUNS") if 'BULK_LOAD_RUNS' in os.environ else 'data/luftdaten_bulk_load_runs.jsonl'
+
+BULK_LOAD_SETTINGS = {
+    "index.refresh_interval": "-1",
+    "index.translog.durability": "async",
+    "index.number_of_replicas": 0,
+}
+
+
+def read_state(state_file=BULK_LOAD_STATE):
+    """
+        the original settings of the indices in bulk load mode
+    :return: dict index name => dict the original settings
+    """
+    if not os.path.exists(state_file):
+        return {}
+    
+    with open(state_file) as fp:
+        return json.load(fp)
+
+
+def write_state(state, state_file=BULK_LOAD_STATE):
+    directory = os.path.dirname(state_file)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    
+    temp_filename = state_file + '.part'
+    
+    with open(temp_filename, 'w') as fp:
+        json.dump(state, fp, indent=1, sort_keys=True)
+    os.replace(temp_filename, state_file)
+
+
+def begin_bulk_load(es, index_name, state_file=BULK_LOAD_STATE):
+    """
+        saves the settings of the index and switches it into the bulk load mode
+    :param es: Elasticsearch the client
+    :param index_name: str the index name
+    :param state_file: str the local state file
+    """
+    state = read_state(state_file)
+    
+    # the settings saved by a crashed run are the original ones
+    if index_name not in state:
+        response = es.indices.get_settings(index=index_name, name=",".join(BULK_LOAD_SETTINGS.keys()), flat_settings=True)
+        settings = response.get(index_name, {}).get('settings', {})
+        
+        # settings, which are not set explicitly, are reset to their defaults (None)
+        state[index_name] = {name: settings.get(name) for name in BULK_LOAD_SETTINGS}
+        write_state(state, state_file)
+    
+    es.indices.put_settings(index=index_name, body={"index": {name[len("index."):]: value for name, value in BULK_LOAD_SETTINGS.items()}})
+    
+    message = "Index '{}' has been switched into bulk load mode".format(index_name)
+    print("    " + message)
+
+
+def end_bulk_load(es, index_names=None, state_file=BULK_LOAD_STATE, force_merge=False, max_num_segments=1):
+    """
+        restores the original settings of the indices, refreshes and optionally force merges them
+    :param es: Elasticsearch the client
+    :param index_names: list the index names (None=all indices of the state file)
+    :param state_file: str the local state file
+    :param force_merge: bool force merge the indices
+    :param max_num_segments: int the amount of segments of the force merge
+    :return: list of the restored indices
+    """
+    state = read_state(state_file)
+    
+    if index_names is None:
+        index_names = sorted(state.keys())
+    
+    restored = []
+    
+    for index_name in index_names:
+        if index_name not in state:
+            continue
+        
+        if es.indices.exists(index_name):
+            settings = state.get(index_name)
+            es.indices.put_settings(index=index_name, body={"index": {name[len("index."):]: value for name, value in settings.items()}})
+            es.indices.refresh(index=index_name)
+            
+            if force_merge:
+                es.indices.forcemerge(index=index_name, max_num_segments=max_num_segments, request_timeout=3600)
+            
+            message = "Settings of index '{}' have been restored{}".format(index_name, " (force merged)" if force_merge else "")
+            print("    " + message)
+        
+        del state[index_name]
+        write_state(state, state_file)
+        restored.append(index_name)
+    
+    return restored
+
+
+def record_run(index_names, documents, seconds, bulk_load, runs_file=BULK_LOAD_RUNS):
+    """
+        records the throughput of an ingest run
+    :param index_names: list the filled indices
+    :param documents: int the amount of indexed documents
+    :param seconds: float the duration of the run
+    :param bulk_load: bool the bulk load mode has been enabled
+    :param runs_file: str the file of the records (one json document per line)
+    :return: dict the record
+    """
+    run = {
+        'finished_at': datetime.now().isoformat(),
+        'indices': sorted(index_names),
+        'bulk_load': bulk_load,
+        'documents': documents,
+        'seconds': round(seconds, 3),
+        'docs_per_second': round(documents / seconds, 2) if seconds > 0 else 0,
+    }
+    
+    directory = os.path.dirname(runs_file)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    
+    with open(runs_file, 'a') as fp:
+        fp.write(json.dumps(run, sort_keys=True) + '\n')
+    
+    message = "Ingest run: {} documents in {}s ({} docs/s, bulk load mode: {})".format(documents, run['seconds'], run['docs_per_second'], bulk_load)
+    print(message)
+    
+    return run
+
+
+def read_runs(runs_file=BULK_LOAD_RUNS):
+    if not os.path.exists(runs_file):
+        return []
+    
+    with open(runs_file) as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk load mode of the luftdaten.info indices')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    
+    parser_restore = subparsers.add_parser('restore', help='restore the settings of the indices left in bulk load mode')
+    parser_restore.add_argument('--force-merge', action='store_true')
+    parser_restore.add_argument('--max-num-segments', type=int, default=1)
+    
+    subparsers.add_parser('runs', help='throughput of the recorded ingest runs')
+    
+    args = parser.parse_args()
+    
+    if args.command == 'restore':
+        from luftdaten_index import es
+        
+        restored = end_bulk_load(es, force_merge=args.force_merge, max_num_segments=args.max_num_segments)
+        
+        message = "{} indices have been restored".format(len(restored))
+        print(message)
+    else:
+        for run in read_runs():
+            print(json.dumps(run, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
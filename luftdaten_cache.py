@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+####
+# result cache of the search requests of the research scripts
+#
+# 1. the responses are cached by the normalized body of the request, the indices and the document type
+# 2. the cache is limited by the amount of entries and their size, the least recently used entries are evicted first
+# 3. the entries of the sealed monthly indices (recorded by the ingest, see luftdaten_seal) never expire, the entries
+#    of all other indices expire after CACHE_TTL, the ones of the current month after CACHE_TTL_RECENT (a month, which
+#    is still backfilled or indexed again after a truncate, is not sealed), the seals are part of the keys, so the
+#    entries of an index, which is sealed again, are not reused
+#    (the seals are read again only when the state file has been changed)
+# 4. the entries are kept serialized, each lookup returns its own copy of the response, which can be changed by the
+#    caller
+# 5. optionally the entries are also kept on disk (SQLite), so they are shared by repeated runs of the scripts:
+#    set env: CACHE_DATABASE=data/luftdaten_query_cache.sqlite
+###
+
+__author__ = 'Martin Andreas Woerz'
+__email__ = 'm.woerz@ieservices.de'
+__copyright__ = "Copyright 2018, Martin Woerz"
+__version__ = "0.0.7"
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import date
+from time import time
+
+from luftdaten_seal import read_state, SEAL_STATE
+
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES")) if 'CACHE_MAX_ENTRIES' in os.environ else 1000
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES")) if 'CACHE_MAX_BYTES' in os.environ else 256 * 1024 * 1024
+
+# the time to live in seconds of the entries of the current month and of all indices, which are not sealed
+CACHE_TTL_RECENT = int(os.environ.get("CACHE_TTL_RECENT")) if 'CACHE_TTL_RECENT' in os.environ else 60
+CACHE_TTL = int(os.environ.get("CACHE_TTL")) if 'CACHE_TTL' in os.environ else 300
+
+# the optional disk tier (disabled if not set)
+CACHE_DATABASE = os.environ.get("CACHE_DATABASE") if 'CACHE_DATABASE' in os.environ else None
+
+# the monthly indices: <index name>_YYYY-MM
+MONTHLY_INDEX_PATTERN = re.compile(r'_(\d{4})-(\d{2})$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS query_cache (
+    key TEXT PRIMARY KEY,
+    expires_at REAL,
+    accessed_at REAL NOT NULL,
+    response TEXT NOT NULL
+)
+"""
+
+# the cache used by cached_search if no cache is passed
+default_cache = None
+
+
+def create_cache(max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES, database=CACHE_DATABASE, state_file=SEAL_STATE):
+    """
+        creates a result cache
+    :param max_entries: int the maximum amount of entries (in memory and on disk)
+    :param max_bytes: int the maximum size of the entries in memory (the size of the serialized responses)
+    :param database: str optional SQLite database file of the disk tier
+    :param state_file: str the state file of the sealed indices (see luftdaten_seal)
+    :return: dict the cache
+    """
+    connection = None
+    
+    if database:
+        directory = os.path.dirname(database)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        
+        connection = sqlite3.connect(database, check_same_thread=False)
+        connection.execute(SCHEMA)
+        connection.commit()
+    
+    return {
+        'entries': OrderedDict(),
+        'bytes': 0,
+        'max_entries': max_entries,
+        'max_bytes': max_bytes,
+        'connection': connection,
+        'lock': threading.Lock(),
+        'hits': 0,
+        'misses': 0,
+        'state_file': state_file,
+        'sealed_indices': {},
+        'sealed_mtime': None,
+    }
+
+
+def get_default_cache():
+    global default_cache
+    
+    if default_cache is None:
+        default_cache = create_cache()
+    
+    return default_cache
+
+
+def get_sealed_indices(cache):
+    """
+        the sealed indices (see luftdaten_seal.read_state), the state file is only read again if it has been changed
+    :param cache: dict the cache
+    :return: dict
+    """
+    state_file = cache.get('state_file')
+    
+    try:
+        mtime = os.stat(state_file).st_mtime_ns
+    except OSError:
+        mtime = None
+    
+    with cache.get('lock'):
+        if mtime != cache.get('sealed_mtime'):
+            cache['sealed_indices'] = read_state(state_file) if mtime is not None else {}
+            cache['sealed_mtime'] = mtime
+        
+        return cache.get('sealed_indices')
+
+
+def get_indices(index):
+    return index.split(',') if isinstance(index, str) else list(index)
+
+
+def get_cache_key(index, body, doc_type=None, sealed_indices=None):
+    """
+        the key of a search request: the same query with a different order of the keys gets the same key
+    :param sealed_indices: dict optional sealed indices (see luftdaten_seal.read_state), the seals of the indices are
+                           part of the key
+    :return: str
+    """
+    indices = sorted(get_indices(index))
+    request = {'index': indices, 'doc_type': doc_type, 'body': body}
+    
+    seals = {index_name: sealed_indices.get(index_name).get('sealed_at') for index_name in indices if index_name in sealed_indices} if sealed_indices else None
+    
+    if seals:
+        request['seals'] = seals
+    
+    normalized = json.dumps(request, sort_keys=True, separators=(',', ':'), default=str)
+    
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+def is_current_month_index(index_name, today=None):
+    """
+        checks if a monthly index is the index of the current month (or of a later month)
+    :param index_name: str the index name
+    :param today: date the current day
+    :return: bool
+    """
+    match = MONTHLY_INDEX_PATTERN.search(index_name)
+    
+    if match is None:
+        return False
+    
+    if today is None:
+        today = date.today()
+    
+    return (int(match.group(1)), int(match.group(2))) >= (today.year, today.month)
+
+
+def get_ttl(index, sealed_indices=None, today=None):
+    """
+        the time to live of the entries of the indices
+    :param index: str the index (or indices separated by ',')
+    :param sealed_indices: dict the sealed indices (see luftdaten_seal.read_state)
+    :param today: date the current day
+    :return: int seconds or None if the entries never expire
+    """
+    indices = get_indices(index)
+    
+    if sealed_indices and all(index_name in sealed_indices for index_name in indices):
+        return None
+    
+    if any(is_current_month_index(index_name, today) for index_name in indices):
+        return CACHE_TTL_RECENT
+    
+    return CACHE_TTL
+
+
+def evict(cache):
+    entries = cache.get('entries')
+    
+    while entries and (len(entries) > cache.get('max_entries') or cache.get('bytes') > cache.get('max_bytes')):
+        _, (serialized, _) = entries.popitem(last=False)
+        cache['bytes'] -= len(serialized)
+
+
+def get_serialized_entry(cache, key, now):
+    """
+        looks up the serialized response of an entry in memory and on disk (the lock of the cache is held)
+    :return: str the serialized response or None if it is not cached or has expired
+    """
+    entries = cache.get('entries')
+    
+    if key in entries:
+        serialized, expires_at = entries.get(key)
+        
+        if expires_at is None or expires_at > now:
+            entries.move_to_end(key)
+            return serialized
+        
+        del entries[key]
+        cache['bytes'] -= len(serialized)
+    
+    connection = cache.get('connection')
+    
+    if connection is None:
+        return None
+    
+    row = connection.execute('SELECT expires_at, response FROM query_cache WHERE key = ?', (key,)).fetchone()
+    
+    if row is None:
+        return None
+    
+    expires_at, serialized = row
+    
+    if expires_at is not None and expires_at <= now:
+        with connection:
+            connection.execute('DELETE FROM query_cache WHERE key = ?', (key,))
+        return None
+    
+    with connection:
+        connection.execute('UPDATE query_cache SET accessed_at = ? WHERE key = ?', (now, key))
+    
+    # take the entry over into memory
+    entries[key] = (serialized, expires_at)
+    cache['bytes'] += len(serialized)
+    evict(cache)
+    
+    return serialized
+
+
+def get_entry(cache, key):
+    """
+        looks up an entry in memory and on disk (the hits and misses of the cache are counted)
+    :return: the response (a copy of the entry) or None if it is not cached or has expired
+    """
+    with cache.get('lock'):
+        serialized = get_serialized_entry(cache, key, time())
+        
+        if serialized is None:
+            cache['misses'] += 1
+            return None
+        
+        cache['hits'] += 1
+    
+    # decoded outside of the lock, every caller gets its own response
+    return json.loads(serialized)
+
+
+def set_entry(cache, key, response, ttl=None):
+    """
+        saves an entry in memory and on disk
+    :param ttl: int seconds or None if the entry never expires
+    """
+    now = time()
+    expires_at = now + ttl if ttl is not None else None
+    serialized = json.dumps(response, separators=(',', ':'))
+    
+    with cache.get('lock'):
+        entries = cache.get('entries')
+        
+        if key in entries:
+            cache['bytes'] -= len(entries.pop(key)[0])
+        
+        entries[key] = (serialized, expires_at)
+        cache['bytes'] += len(serialized)
+        evict(cache)
+        
+        connection = cache.get('connection')
+        
+        if connection is not None:
+            with connection:
+                connection.execute('INSERT OR REPLACE INTO query_cache (key, expires_at, accessed_at, response) VALUES (?, ?, ?, ?)',
+                                   (key, expires_at, now, serialized))
+                
+                # the least recently used entries on disk are evicted as well
+                connection.execute('DELETE FROM query_cache WHERE key IN (SELECT key FROM query_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                                   (cache.get('max_entries'),))
+
+
+def clear_cache(cache=None):
+    if cache is None:
+        cache = get_default_cache()
+    
+    with cache.get('lock'):
+        cache.get('entries').clear()
+        cache['bytes'] = 0
+        
+        connection = cache.get('connection')
+        if connection is not None:
+            with connection:
+                connection.execute('DELETE FROM query_cache')
+
+
+def cached_search(es, index, body, doc_type=None, cache=None):
+    """
+        sends a search request, unless its response is cached
+    :param es: Elasticsearch the client
+    :param index: str the index (or indices separated by ',')
+    :param body: dict the body of the search request
+    :param doc_type: str the document type
+    :param cache: dict the cache (default: the cache of the module)
+    :return: dict the response
+    """
+    if cache is None:
+        cache = get_default_cache()
+    
+    sealed_indices = get_sealed_indices(cache)
+    
+    key = get_cache_key(index, body, doc_type, sealed_indices)
+    response = get_entry(cache, key)
+    
+    if response is not None:
+        return response
+    
+    response = es.search(index=index, doc_type=doc_type, body=body)
+    set_entry(cache, key, response, get_ttl(index, sealed_indices))
+    
+    return response
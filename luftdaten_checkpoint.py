@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+####
+# local checkpoint store of the indexing process (replaces the Elastic Search index <index>_file_index)
+#
+# the completely indexed csv files are stored in a SQLite database with the key (index name, file date, file id),
+# the files are written in batches (one transaction) and all indexed files of an index are fetched with one query
+#
+# existing deployments can import the Elastic Search file index into the store and export the store back (the
+# file index is imported only once per index, an index which has been truncated is never imported again):
+#   python luftdaten_checkpoint.py import <index name>
+#   python luftdaten_checkpoint.py export <index name>
+###
+
+__author__ = 'Martin Andreas Woerz'
+__email__ = 'm.woerz@ieservices.de'
+__copyright__ = "Copyright 2018, Martin Woerz"
+__version__ = "0.0.7"
+
+import os
+import sqlite3
+import sys
+from datetime import datetime
+
+from elasticsearch.helpers import bulk, scan
+
+CHECKPOINT_DATABASE = os.environ.get("CHECKPOINT_DATABASE") if 'CHECKPOINT_DATABASE' in os.environ else 'data/luftdaten_checkpoints.sqlite'
+
+# the amount of indexed files, which are written at once
+CHECKPOINT_BATCH_SIZE = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS indexed_files (
+    index_name TEXT NOT NULL,
+    file_date TEXT NOT NULL,
+    file_id INTEGER NOT NULL,
+    indexed_at TEXT NOT NULL,
+    PRIMARY KEY (index_name, file_date, file_id)
+)
+"""
+
+# the indices, whose Elastic Search file index has been imported or is outdated (truncated index)
+IMPORTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_index_imports (
+    index_name TEXT PRIMARY KEY,
+    imported_at TEXT NOT NULL
+)
+"""
+
+
+def connect(database=CHECKPOINT_DATABASE):
+    """
+        opens (and creates) the checkpoint store
+    :param database: str the SQLite database file
+    :return: sqlite3.Connection
+    """
+    directory = os.path.dirname(database)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    
+    # the connection is shared with the indexing threads (the writes are serialized by the bulk pipeline)
+    connection = sqlite3.connect(database, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute(SCHEMA)
+    connection.execute(IMPORTS_SCHEMA)
+    connection.commit()
+    
+    return connection
+
+
+def get_indexed_files(connection, index_name):
+    """
+        fetches all indexed files of an index
+    :param connection: sqlite3.Connection the checkpoint store
+    :param index_name: str the index name
+    :return: dict file date => set of file ids
+    """
+    indexed_files = {}
+    
+    for file_date, file_id in connection.execute('SELECT file_date, file_id FROM indexed_files WHERE index_name = ?', (index_name,)):
+        indexed_files.setdefault(file_date, set()).add(file_id)
+    
+    return indexed_files
+
+
+def mark_files_indexed(connection, index_name, files):
+    """
+        saves the import status of completely indexed files (in one transaction)
+    :param connection: sqlite3.Connection the checkpoint store
+    :param index_name: str the index name
+    :param files: list of (file date, file id) tuples
+    """
+    if not files:
+        return
+    
+    indexed_at = datetime.now().isoformat()
+    
+    with connection:
+        connection.executemany('INSERT OR REPLACE INTO indexed_files (index_name, file_date, file_id, indexed_at) VALUES (?, ?, ?, ?)',
+                               [(index_name, file_date, int(file_id), indexed_at) for file_date, file_id in files])
+
+
+def delete_indexed_files(connection, index_name):
+    """
+        deletes the import status of all files of an index (when the index is truncated), the file index of Elastic
+        Search is outdated and is not imported anymore
+    """
+    with connection:
+        connection.execute('DELETE FROM indexed_files WHERE index_name = ?', (index_name,))
+        connection.execute('INSERT OR REPLACE INTO file_index_imports (index_name, imported_at) VALUES (?, ?)', (index_name, datetime.now().isoformat()))
+
+
+def count_indexed_files(connection, index_name):
+    return connection.execute('SELECT COUNT(*) FROM indexed_files WHERE index_name = ?', (index_name,)).fetchone()[0]
+
+
+def is_file_index_imported(connection, index_name):
+    """
+        checks if the file index of an index has already been imported (or has been outdated by a truncate)
+    :param connection: sqlite3.Connection the checkpoint store
+    :param index_name: str the index name
+    :return: bool
+    """
+    return connection.execute('SELECT COUNT(*) FROM file_index_imports WHERE index_name = ?', (index_name,)).fetchone()[0] > 0
+
+
+def import_file_index(connection, es, index_name, index_files_name=None):
+    """
+        imports the import status of the files from the Elastic Search file index
+    :param connection: sqlite3.Connection the checkpoint store
+    :param es: Elasticsearch the client
+    :param index_name: str the index name
+    :param index_files_name: str the file index (default: <index name>_file_index)
+    :return: int the amount of imported files
+    """
+    if index_files_name is None:
+        index_files_name = "{}_file_index".format(index_name)
+    
+    if not es.indices.exists(index_files_name):
+        return 0
+    
+    files = []
+    imported_count = 0
+    
+    for hit in scan(es, index=index_files_name, doc_type="indexed", query={"_source": ["file_date", "file_id"]}):
+        source = hit.get('_source')
+        files.append((source.get('file_date'), source.get('file_id')))
+        
+        if len(files) >= 10000:
+            mark_files_indexed(connection, index_name, files)
+            imported_count += len(files)
+            files = []
+    
+    mark_files_indexed(connection, index_name, files)
+    imported_count += len(files)
+    
+    with connection:
+        connection.execute('INSERT OR REPLACE INTO file_index_imports (index_name, imported_at) VALUES (?, ?)', (index_name, datetime.now().isoformat()))
+    
+    message = "Imported {} indexed files of '{}' into the checkpoint store".format(imported_count, index_files_name)
+    print("    " + message)
+    
+    return imported_count
+
+
+def export_file_index(connection, es, index_name, index_files_name=None):
+    """
+        exports the import status of the files into the Elastic Search file index
+        (the documents get the id <file date>_<file id>, a repeated export does not create duplicates)
+    :param connection: sqlite3.Connection the checkpoint store
+    :param es: Elasticsearch the client
+    :param index_name: str the index name
+    :param index_files_name: str the file index (default: <index name>_file_index)
+    :return: int the amount of exported files
+    """
+    if index_files_name is None:
+        index_files_name = "{}_file_index".format(index_name)
+    
+    rows = connection.execute('SELECT file_date, file_id, indexed_at FROM indexed_files WHERE index_name = ?', (index_name,))
+    
+    actions = ({
+        "_index": index_files_name,
+        "_type": "indexed",
+        "_id": "{}_{}".format(file_date, file_id),
+        "_source": {"file_id": file_id, "file_date": file_date, "timestamp": indexed_at},
+    } for file_date, file_id, indexed_at in rows)
+    
+    exported_count, _ = bulk(es, actions)
+    
+    message = "Exported {} indexed files into '{}'".format(exported_count, index_files_name)
+    print("    " + message)
+    
+    return exported_count
+
+
+def main():
+    if len(sys.argv) != 3 or sys.argv[1] not in ('import', 'export'):
+        print("usage: python luftdaten_checkpoint.py import|export <index name>")
+        sys.exit(1)
+    
+    from luftdaten_index import es, prepare_file_index
+    
+    action, index_name = sys.argv[1:]
+    connection = connect()
+    
+    if action == 'import':
+        import_file_index(connection, es, index_name)
+    else:
+        prepare_file_index("{}_file_index".format(index_name))
+        export_file_index(connection, es, index_name)
+
+
+if __name__ == "__main__":
+    main()
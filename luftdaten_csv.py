@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+####
+# typed reader of the csv files of the archive
+#
+# 1. the columns of a csv file are known by its sensor type (see CSV_SENSOR_TYPE_COLUMNS), only those columns are
+#    read (usecols) with explicit types instead of inferring the types of each chunk
+# 2. the empty columns of a sensor type (e.g. durP1, ratioP1 of the sds011) are not read at all
+# 3. the timestamps are parsed with a fixed format, only the values not matching the format are parsed as ISO 8601
+#    (the indexing keeps the timestamps as strings, they are written into the documents as they are)
+# 4. the csv files of unknown sensor types are read with all columns (the known columns are typed)
+#
+# optionally the csv files are parsed by the pyarrow csv engine (set env: CSV_ENGINE=pyarrow, requires pyarrow)
+###
+
+__author__ = 'Martin Andreas Woerz'
+__email__ = 'm.woerz@ieservices.de'
+__copyright__ = "Copyright 2018, Martin Woerz"
+__version__ = "0.0.7"
+
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from luftdaten_sensors import parse_csv_filename
+
+# the csv engine of pandas: c or pyarrow
+CSV_ENGINE = os.environ.get("CSV_ENGINE") if 'CSV_ENGINE' in os.environ else 'c'
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# the types of the numeric columns (the strings are read as objects without a conversion)
+# numpy types instead of their names, the names would be looked up for each column of each file
+CSV_DTYPES = {
+    'sensor_id': np.dtype('int32'),
+    'location': np.dtype('int32'),
+    'lat': np.dtype('float64'),
+    'lon': np.dtype('float64'),
+    'P1': np.dtype('float64'),
+    'durP1': np.dtype('float64'),
+    'ratioP1': np.dtype('float64'),
+    'P2': np.dtype('float64'),
+    'durP2': np.dtype('float64'),
+    'ratioP2': np.dtype('float64'),
+    'temperature': np.dtype('float64'),
+    'humidity': np.dtype('float64'),
+    'pressure': np.dtype('float64'),
+    'altitude': np.dtype('float64'),
+    'pressure_sealevel': np.dtype('float64'),
+}
+
+# the ids are read as nullable integers, if a file contains rows without ids (slower than int32)
+CSV_NULLABLE_DTYPES = {'sensor_id': pd.Int32Dtype(), 'location': pd.Int32Dtype()}
+
+CSV_COMMON_COLUMNS = ['sensor_id', 'sensor_type', 'location', 'lat', 'lon', 'timestamp']
+
+# the columns with values of the csv files of the sensor types
+CSV_SENSOR_TYPE_COLUMNS = {
+    'sds011': CSV_COMMON_COLUMNS + ['P1', 'P2'],
+    'pms3003': CSV_COMMON_COLUMNS + ['P1', 'P2'],
+    'pms5003': CSV_COMMON_COLUMNS + ['P1', 'P2'],
+    'pms7003': CSV_COMMON_COLUMNS + ['P1', 'P2'],
+    'hpm': CSV_COMMON_COLUMNS + ['P1', 'P2'],
+    'ppd42ns': CSV_COMMON_COLUMNS + ['P1', 'durP1', 'ratioP1', 'P2', 'durP2', 'ratioP2'],
+    'dht22': CSV_COMMON_COLUMNS + ['temperature', 'humidity'],
+    'bme280': CSV_COMMON_COLUMNS + ['pressure', 'altitude', 'pressure_sealevel', 'temperature', 'humidity'],
+    'bmp180': CSV_COMMON_COLUMNS + ['pressure', 'altitude', 'pressure_sealevel', 'temperature'],
+    'bmp280': CSV_COMMON_COLUMNS + ['pressure', 'altitude', 'pressure_sealevel', 'temperature'],
+}
+
+
+def get_csv_engine(engine=CSV_ENGINE):
+    """
+        the csv engine, the pyarrow engine is only used if pyarrow is installed
+    :param engine: str c or pyarrow
+    :return: str
+    """
+    if engine == 'pyarrow':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            return 'c'
+    
+    return engine
+
+
+def get_csv_columns(csv_file):
+    """
+        the columns with values of a csv file (the sensor type is taken of the filename)
+    :param csv_file: str the csv file
+    :return: set of the columns or None if the sensor type is unknown (all columns are read)
+    """
+    sensor = parse_csv_filename(csv_file)
+    
+    if sensor is None or sensor[1] not in CSV_SENSOR_TYPE_COLUMNS:
+        return None
+    
+    return set(CSV_SENSOR_TYPE_COLUMNS.get(sensor[1]))
+
+
+def parse_timestamps(series):
+    """
+        parses the timestamps of the csv files (YYYY-MM-DDTHH:MM:SS)
+    :param series: pd.Series of str the timestamps
+    :return: pd.Series of datetime64 (the values, which can not be parsed, are NaT)
+    """
+    try:
+        return pd.to_datetime(series, format=TIMESTAMP_FORMAT)
+    except ValueError:
+        pass
+    
+    timestamps = pd.to_datetime(series, format=TIMESTAMP_FORMAT, errors='coerce')
+    
+    # the values with another format (e.g. with a time zone) are converted to UTC
+    failed = timestamps.isna() & series.notna()
+    if failed.any():
+        timestamps[failed] = pd.to_datetime(series[failed], format='ISO8601', errors='coerce', utc=True).dt.tz_localize(None)
+    
+    return timestamps
+
+
+def read_csv_header(csv_file):
+    with open(csv_file, encoding='utf-8') as fp:
+        return fp.readline().strip().split(';')
+
+
+def iter_csv_chunks(csv_file, chunk_size=8 * 1024, engine=CSV_ENGINE, parse_dates=True):
+    """
+        reads a csv file of the archive in chunks
+    :param csv_file: str the csv file (stored in the original format of the archive)
+    :param chunk_size: int the amount of rows per chunk
+    :param engine: str the csv engine: c or pyarrow (the pyarrow engine reads the whole file at once)
+    :param parse_dates: bool parse the timestamps (otherwise they are kept as strings)
+    :return: generator of pd.DataFrame
+    """
+    engine = get_csv_engine(engine)
+    dtypes = dict(CSV_DTYPES)
+    
+    row_offset = 0
+    
+    try:
+        for df in read_csv_chunks(csv_file, dtypes, chunk_size, engine, parse_dates):
+            row_offset += len(df)
+            yield df
+    except ValueError:
+        # the integer columns contain empty values, the rest of the file is read with nullable integers
+        dtypes.update(CSV_NULLABLE_DTYPES)
+        
+        for df in read_csv_chunks(csv_file, dtypes, chunk_size, engine, parse_dates, skip_rows=row_offset):
+            yield df
+
+
+def read_csv_chunks(csv_file, dtypes, chunk_size, engine, parse_dates=True, skip_rows=0):
+    columns = get_csv_columns(csv_file)
+    skip_rows = range(1, skip_rows + 1) if skip_rows else None
+    
+    try:
+        if engine == 'pyarrow':
+            header = read_csv_header(csv_file)
+            
+            # the pyarrow engine fails on empty files and only takes a list of columns
+            if header == ['']:
+                return
+            
+            use_columns = [column for column in header if column in columns] if columns is not None else None
+            
+            data_frames = [pd.read_csv(csv_file, sep=';', usecols=use_columns, dtype=dtypes, skiprows=skip_rows, engine='pyarrow')]
+        else:
+            use_columns = columns.__contains__ if columns is not None else None
+            
+            data_frames = pd.read_csv(csv_file, sep=';', usecols=use_columns, dtype=dtypes, skiprows=skip_rows, engine='c', chunksize=chunk_size)
+    except pd.errors.EmptyDataError:
+        return
+    
+    data_frames = iter(data_frames)
+    
+    while True:
+        # the cast of empty values into the integer columns warns before it fails (see iter_csv_chunks)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            df = next(data_frames, None)
+        
+        if df is None:
+            break
+        
+        if parse_dates and 'timestamp' in df.columns:
+            df['timestamp'] = parse_timestamps(df['timestamp'])
+        
+        if len(df) <= chunk_size:
+            yield df
+        else:
+            # the pyarrow engine reads the whole file at once
+            for start in range(0, len(df), chunk_size):
+                yield df.iloc[start:start + chunk_size]
+
+
+def read_csv_file(csv_file, engine=CSV_ENGINE):
+    """
+        reads a csv file of the archive at once
+    :param csv_file: str the csv file
+    :param engine: str the csv engine: c or pyarrow
+    :return: pd.DataFrame
+    """
+    data_frames = list(iter_csv_chunks(csv_file, chunk_size=1024 * 1024, engine=engine))
+    
+    if not data_frames:
+        return pd.DataFrame()
+    
+    return pd.concat(data_frames, ignore_index=True) if len(data_frames) > 1 else data_frames[0]
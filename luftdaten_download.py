@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+####
+# concurrent download engine for the csv files of the archive of luftdaten.info
+#
+# 1. a bounded pool of worker threads downloads the files
+# 2. each worker keeps its keep-alive connection to the archive host open and reuses it for the next file
+# 3. the amount of parallel requests per host is limited, failed requests are retried with an exponential backoff
+# 4. the files are streamed as they are (no parsing) into a temporary file and only renamed to the target file once complete
+###
+
+__author__ = 'Martin Andreas Woerz'
+__email__ = 'm.woerz@ieservices.de'
+__copyright__ = "Copyright 2018, Martin Woerz"
+__version__ = "0.0.7"
+
+import csv
+import glob
+import http.client
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import sleep, time
+from urllib.parse import urlsplit, urljoin
+
+from luftdaten_metrics import increment, observe
+
+# the amount of download threads
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS")) if 'DOWNLOAD_WORKERS' in os.environ else 16
+
+# the amount of parallel requests to the same host
+DOWNLOAD_MAX_PER_HOST = int(os.environ.get("DOWNLOAD_MAX_PER_HOST")) if 'DOWNLOAD_MAX_PER_HOST' in os.environ else 8
+
+# the amount of retries of a failed request and the initial backoff (in seconds), which is doubled on each retry
+DOWNLOAD_RETRIES = int(os.environ.get("DOWNLOAD_RETRIES")) if 'DOWNLOAD_RETRIES' in os.environ else 5
+DOWNLOAD_BACKOFF = float(os.environ.get("DOWNLOAD_BACKOFF")) if 'DOWNLOAD_BACKOFF' in os.environ else 0.5
+
+DOWNLOAD_TIMEOUT = float(os.environ.get("DOWNLOAD_TIMEOUT")) if 'DOWNLOAD_TIMEOUT' in os.environ else 30
+
+# the size of the chunks the downloaded files are streamed to the disk
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# http status codes which are worth to be retried
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+REDIRECT_STATUS_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+# the csv files are stored in the original format of the archive (separated by ';'),
+# the marker file tells that a data directory of the legacy format (separated by ',' + index column) has been migrated
+CSV_FORMAT = 'raw'
+CSV_FORMAT_MARKER = '.csv_format'
+
+# each worker thread holds its own connections (http.client connections are not thread safe)
+_thread_data = threading.local()
+
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+
+class DownloadError(Exception):
+    pass
+
+
+def get_connection(scheme, netloc, timeout=DOWNLOAD_TIMEOUT):
+    """
+        returns the keep-alive connection of the current thread to the given host
+    :param scheme: str http or https
+    :param netloc: str the host (and port)
+    :param timeout: float the socket timeout in seconds
+    :return: http.client.HTTPConnection
+    """
+    connections = getattr(_thread_data, 'connections', None)
+    
+    if connections is None:
+        connections = _thread_data.connections = {}
+    
+    connection = connections.get((scheme, netloc))
+    
+    if connection is None:
+        if scheme == 'https':
+            connection = http.client.HTTPSConnection(netloc, timeout=timeout)
+        else:
+            connection = http.client.HTTPConnection(netloc, timeout=timeout)
+        connections[(scheme, netloc)] = connection
+    
+    return connection
+
+
+def close_connection(scheme, netloc):
+    connections = getattr(_thread_data, 'connections', {})
+    connection = connections.pop((scheme, netloc), None)
+    
+    if connection is not None:
+        connection.close()
+
+
+def get_host_semaphore(netloc, max_per_host=DOWNLOAD_MAX_PER_HOST):
+    with _host_semaphores_lock:
+        if netloc not in _host_semaphores:
+            _host_semaphores[netloc] = threading.BoundedSemaphore(max_per_host)
+        return _host_semaphores[netloc]
+
+
+def fetch_url(uri, fp=None, chunk_size=DOWNLOAD_CHUNK_SIZE, retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF, max_per_host=DOWNLOAD_MAX_PER_HOST):
+    """
+        fetches the content of an url over the keep-alive connection of the current thread
+    :param uri: str the url
+    :param fp: file optional binary file the response body is streamed into (in chunks, without keeping it in memory)
+    :param chunk_size: int the size of the chunks which are streamed into the file
+    :param retries: int the amount of retries of failed requests
+    :param backoff: float the initial waiting time in seconds before a retry (doubled on each retry)
+    :param max_per_host: int the amount of parallel requests to the same host
+    :return: bytes the response body or int the amount of bytes written into the file
+    """
+    attempt = 0
+    redirects = 0
+    
+    while True:
+        parts = urlsplit(uri)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        
+        error = None
+        
+        with get_host_semaphore(parts.netloc, max_per_host):
+            connection = get_connection(parts.scheme, parts.netloc)
+            
+            try:
+                connection.request('GET', path, headers={'Connection': 'keep-alive'})
+                response = connection.getresponse()
+                
+                if response.status == 200 and fp is not None:
+                    # start over, if a previous attempt was aborted in the middle of the file
+                    fp.seek(0)
+                    fp.truncate()
+                    
+                    bytes_count = 0
+                    chunk = response.read(chunk_size)
+                    while chunk:
+                        fp.write(chunk)
+                        bytes_count += len(chunk)
+                        chunk = response.read(chunk_size)
+                    body = bytes_count
+                else:
+                    # the body has to be read completely before the connection can be reused
+                    body = response.read()
+                
+                if response.will_close:
+                    close_connection(parts.scheme, parts.netloc)
+                
+                if response.status in REDIRECT_STATUS_CODES and redirects < MAX_REDIRECTS:
+                    uri = urljoin(uri, response.getheader('Location'))
+                    redirects += 1
+                    continue
+                
+                if response.status == 200:
+                    return body
+                
+                error = DownloadError("HTTP {} {} for {}".format(response.status, response.reason, uri))
+                
+                if response.status not in RETRY_STATUS_CODES:
+                    raise error
+            
+            except (OSError, http.client.HTTPException) as e:
+                # the connection could have been closed by the server in the meanwhile, reconnect on the next attempt
+                close_connection(parts.scheme, parts.netloc)
+                error = e
+        
+        if attempt >= retries:
+            raise DownloadError("Giving up after {} retries of {}. Details:\n  {}".format(retries, uri, error))
+        
+        increment('download_retries_total')
+        
+        # exponential backoff with some jitter (to not let all workers hit the server at the same time again)
+        sleep(backoff * (2 ** attempt) * (1 + random.random()))
+        attempt += 1
+
+
+def get_temp_filename(target_filename):
+    return "{}.{}.part".format(target_filename, threading.get_ident())
+
+
+def download_file(uri, target_filename):
+    """
+        downloads a single file as it is (no parsing), the response body is streamed in chunks into a temporary file,
+        which is renamed to the target file once complete (aborted downloads never leave an incomplete csv file behind)
+    :param uri: str the url
+    :param target_filename: str the local file
+    :return: int the amount of written bytes
+    """
+    temp_filename = get_temp_filename(target_filename)
+    start_time = time()
+    
+    try:
+        with open(temp_filename, 'wb') as fp:
+            bytes_count = fetch_url(uri, fp)
+        os.replace(temp_filename, target_filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+    
+    observe('download_seconds', time() - start_time)
+    
+    return bytes_count
+
+
+def is_legacy_csv_file(csv_file):
+    """
+        checks if the csv file has been stored in the legacy format (re-serialized by pandas: separated by ','
+        with an additional unnamed index column) instead of the original format of the archive (separated by ';')
+    :param csv_file: str the local csv file
+    :return: bool
+    """
+    with open(csv_file, newline='') as fp:
+        header = fp.readline()
+    
+    return header.startswith(',') and ';' not in header
+
+
+def migrate_csv_file(csv_file):
+    """
+        converts a csv file of the legacy format into the original format of the archive
+    :param csv_file: str the local csv file
+    """
+    temp_filename = get_temp_filename(csv_file)
+    
+    try:
+        with open(csv_file, newline='') as fp_in, open(temp_filename, 'w', newline='') as fp_out:
+            reader = csv.reader(fp_in, delimiter=',')
+            writer = csv.writer(fp_out, delimiter=';', lineterminator='\n')
+            
+            # drop the unnamed index column
+            for row in reader:
+                writer.writerow(row[1:])
+        os.replace(temp_filename, csv_file)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
+def migrate_csv_directory(directory):
+    """
+        one time migration of the downloaded csv files of the legacy format into the original format of the archive
+        (once done, a marker file is written into the directory and the migration is skipped)
+    :param directory: str the directory containing the date directories (YYYY-MM-DD)
+    :return: int the amount of migrated files
+    """
+    marker_filename = os.path.join(directory, CSV_FORMAT_MARKER)
+    
+    if os.path.exists(marker_filename) or not os.path.isdir(directory):
+        return 0
+    
+    message = "Migrating the csv files in '{}' into the original format of the archive (separated by ';')".format(directory)
+    print(message)
+    
+    migrated_count = 0
+    for csv_file in glob.iglob(os.path.join(directory, '*', '*.csv')):
+        if is_legacy_csv_file(csv_file):
+            migrate_csv_file(csv_file)
+            migrated_count += 1
+            
+            if migrated_count % 1000 == 0:
+                message = "{} csv files have been migrated".format(migrated_count)
+                print("  " + message)
+    
+    with open(marker_filename, 'w') as fp:
+        fp.write(CSV_FORMAT + "\n")
+    
+    message = "Migration done. {} csv files have been migrated".format(migrated_count)
+    print("  " + message)
+    
+    return migrated_count
+
+
+def download_files(jobs, workers=DOWNLOAD_WORKERS):
+    """
+        downloads the files with a pool of worker threads
+    :param jobs: iterable of (url, target filename) tuples, which is consumed lazily (can be a generator)
+    :param workers: int the amount of download threads
+    :return: tuple (amount of downloaded files, amount of failed files, amount of bytes)
+    """
+    start_time = time()
+    
+    downloaded_count = 0
+    failed_count = 0
+    bytes_count = 0
+    
+    # limit the amount of queued downloads, so that the jobs generator is not consumed completely at once
+    max_pending = workers * 4
+    pending = set()
+    pending_uris = {}
+    
+    def collect(futures):
+        nonlocal downloaded_count, failed_count, bytes_count
+        
+        for future in futures:
+            uri = pending_uris.pop(future)
+            try:
+                file_bytes_count = future.result()
+                bytes_count += file_bytes_count
+                downloaded_count += 1
+                increment('files_downloaded_total')
+                increment('download_bytes_total', file_bytes_count)
+                message = 'Downloaded csv file: {} | Files {}'.format(uri, downloaded_count)
+                print('    ' + message)
+            except Exception as e:
+                failed_count += 1
+                increment('files_download_failed_total')
+                message = 'Error in downloading the csv file: {}. Details:\n  {}'.format(uri, e)
+                print('    ' + message)
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for uri, target_filename in jobs:
+            
+            if len(pending) >= max_pending:
+                done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+                pending = not_done
+            
+            future = executor.submit(download_file, uri, target_filename)
+            pending_uris[future] = uri
+            pending.add(future)
+        
+        done, _ = wait(pending)
+        collect(done)
+    
+    duration = time() - start_time
+    message = "Download done. Downloaded %s files (%s failed, %s bytes) in %.3fs." % (downloaded_count, failed_count, bytes_count, duration)
+    print('  ' + message)
+    
+    return downloaded_count, failed_count, bytes_count
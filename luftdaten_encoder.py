@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+####
+# encodes the csv data of the sensors into bulk requests (NDJSON) for Elastic Search
+#
+# instead of creating a dict for each row, each column of the data frame is converted at once into its json
+# representation, then the columns are concatenated into the documents (empty values are skipped)
+###
+
+__author__ = 'Martin Andreas Woerz'
+__email__ = 'm.woerz@ieservices.de'
+__copyright__ = "Copyright 2018, Martin Woerz"
+__version__ = "0.0.7"
+
+import json
+import os
+import re
+from time import time
+
+import numpy as np
+import pandas as pd
+
+from luftdaten_csv import iter_csv_chunks
+from luftdaten_metrics import increment, is_detailed, observe
+
+es_doc_type = "sensor_data"
+
+# the columns which are combined into the geo_location field
+GEO_COLUMNS = ('lat', 'lon')
+
+# strings containing those characters have to be escaped for json
+JSON_ESCAPE_PATTERN = re.compile(r'["\\\x00-\x1f]')
+
+
+def encode_json_values(series):
+    """
+        converts all values of a column into their json representation
+    :param series: pd.Series the column
+    :return: tuple (np.array of str the json values, np.array of bool the mask of the non empty values)
+    """
+    if pd.api.types.is_bool_dtype(series):
+        mask = series.notna().values
+        values = np.where(series.values, 'true', 'false')
+    
+    elif pd.api.types.is_extension_array_dtype(series) and pd.api.types.is_integer_dtype(series):
+        # nullable integers (see luftdaten_csv), the missing values are masked
+        mask = series.notna().values
+        values = series.fillna(0).to_numpy(dtype=series.dtype.numpy_dtype).astype(str)
+    
+    elif pd.api.types.is_numeric_dtype(series):
+        values = series.values
+        mask = np.isfinite(values) if pd.api.types.is_float_dtype(series) else np.ones(len(values), dtype=bool)
+        values = values.astype(str)
+    
+    elif pd.api.types.is_datetime64_any_dtype(series):
+        mask = series.notna().values
+        
+        if getattr(series.dt, 'tz', None) is not None:
+            values = np.datetime_as_string(series.dt.tz_convert('UTC').dt.tz_localize(None).values, unit='s').astype(object) + 'Z'
+        else:
+            values = np.datetime_as_string(series.values, unit='s').astype(object)
+        
+        # concatenated as objects (np.char.add is much slower)
+        values = '"' + values + '"'
+    
+    else:
+        mask = series.notna().values
+        strings = series.where(mask, '').astype(str)
+        
+        # only escape the values if needed (the sensor data hardly contains special characters)
+        if JSON_ESCAPE_PATTERN.search(''.join(strings.tolist())):
+            values = strings.map(json.dumps).values
+        else:
+            values = ('"' + strings + '"').values
+    
+    return values.astype(object), mask
+
+
+def encode_documents(df, constant_fields=None, row_fields=None):
+    """
+        encodes the rows of a data frame into json documents
+    :param df: pd.DataFrame the sensor data
+    :param constant_fields: dict fields which are added with the same value to all documents
+    :param row_fields: dict field => np.array of str the json values of the rows (without empty values), which are
+                       added as the first fields of the documents
+    :return: np.array of str the json documents
+    """
+    # every (non empty) field ends with a ',', the constant fields close the document
+    documents = np.full(len(df), '', dtype=object)
+    
+    for field, values in (row_fields or {}).items():
+        documents = documents + (json.dumps(field) + ':') + values + ','
+    
+    for column in df.columns:
+        if column in GEO_COLUMNS:
+            continue
+        
+        values, mask = encode_json_values(df[column])
+        
+        # columns without any value (e.g. altitude) are not part of the documents
+        if not mask.any():
+            continue
+        
+        fields = json.dumps(str(column)) + ':' + values + ','
+        documents = documents + np.where(mask, fields, '')
+    
+    # prepare the geo data (array representation with [lon,lat])
+    # see @url https://www.elastic.co/guide/en/elasticsearch/guide/current/lat-lon-formats.html
+    if all(column in df.columns for column in GEO_COLUMNS):
+        lat, lat_mask = encode_json_values(df['lat'])
+        lon, lon_mask = encode_json_values(df['lon'])
+        fields = '"geo_location":[' + lon + ',' + lat + '],'
+        documents = documents + np.where(lat_mask & lon_mask, fields, '')
+    
+    if not constant_fields:
+        # remove the trailing ',' of the last field (values never end with a ',', strings are quoted)
+        return '{' + pd.Series(documents).str.rstrip(',').values.astype(object) + '}'
+    
+    return '{' + documents + json.dumps(constant_fields, separators=(',', ':'))[1:]
+
+
+def encode_row_numbers(rows, row_offset=0):
+    """
+        the row numbers of the rows of a chunk in its file
+    :param rows: int the amount of rows
+    :param row_offset: int the row number of the first row (of the chunk) in the file
+    :return: np.array of str the row numbers
+    """
+    return np.arange(row_offset, row_offset + rows).astype(str).astype(object)
+
+
+def encode_document_ids(file_date, file_id, rows, row_offset=0, row_numbers=None):
+    """
+        creates the ids of the documents out of the file and the row number in the file: <file date>_<file id>_<row>
+        (a file which is indexed again overwrites its documents instead of creating duplicates)
+    :param file_date: str the related import directory (date)
+    :param file_id: int the related import file
+    :param rows: int the amount of rows
+    :param row_offset: int the row number of the first row (of the chunk) in the file
+    :param row_numbers: np.array of str the row numbers, if already encoded (see encode_row_numbers)
+    :return: np.array of str the ids
+    """
+    if row_numbers is None:
+        row_numbers = encode_row_numbers(rows, row_offset)
+    
+    return "{}_{}_".format(file_date, file_id) + row_numbers
+
+
+def encode_bulk_documents(df, index_name, file_date, file_id, doc_type=es_doc_type, row_offset=0):
+    """
+        encodes the sensor data of a csv file into the body of a bulk request (NDJSON)
+    :param df: pd.DataFrame the sensor data (one chunk of the csv file)
+    :param index_name: str the index name
+    :param file_date: str the related import directory (date)
+    :param file_id: int the related import file
+    :param doc_type: str the document type
+    :param row_offset: int the row number of the first row of the chunk in the csv file
+    :return: bytes the body of the bulk request
+    """
+    if len(df) == 0:
+        return b''
+    
+    row_numbers = encode_row_numbers(len(df), row_offset)
+    
+    # the row is stored as well, with the file it is the tiebreaker of the sort order (see luftdaten_search_geo_data)
+    documents = encode_documents(df, {'file_date': file_date, 'file_id': file_id}, {'row': row_numbers})
+    
+    document_ids = encode_document_ids(file_date, file_id, len(df), row_numbers=row_numbers)
+    
+    action = json.dumps({"index": {"_index": index_name, "_type": doc_type}}, separators=(',', ':'))
+    
+    # {"index":{"_index":"...","_type":"...","_id":"..."}}
+    actions = action[:-2] + ',"_id":"' + document_ids + '"}}'
+    
+    lines = actions + '\n' + documents + '\n'
+    
+    return ''.join(lines.tolist()).encode('utf-8')
+
+
+def retarget_bulk_documents(payload, index_name, target_index_name):
+    """
+        replaces the index of the actions of a bulk request (the documents are sent to another index without encoding
+        them again)
+    :param payload: bytes the body of the bulk request (see encode_bulk_documents and luftdaten_rollup)
+    :param index_name: str the index of the actions
+    :param target_index_name: str the new index of the actions
+    :return: bytes the body of the bulk request
+    """
+    if index_name == target_index_name or not payload:
+        return payload
+    
+    # only the action lines start with {"index":{"_index": (the documents start with their first field)
+    source = ('\n{"index":{"_index":' + json.dumps(index_name) + ',').encode('utf-8')
+    target = ('\n{"index":{"_index":' + json.dumps(target_index_name) + ',').encode('utf-8')
+    
+    if payload.startswith(source[1:]):
+        payload = target[1:] + payload[len(source) - 1:]
+    
+    return payload.replace(source, target)
+
+
+def iter_csv_documents(index_name, csv_file, file_id, chunk_size=8 * 1024, on_chunk=None):
+    """
+        reads a csv file in chunks and encodes each chunk into the body of a bulk request
+    :param index_name: str the index name
+    :param csv_file: str the csv file (stored in the original format of the archive, read by luftdaten_csv)
+    :param file_id: int the related import file
+    :param chunk_size: int the amount of rows per chunk
+    :param on_chunk: function optional callback, which is called with each chunk (pd.DataFrame) of the file (e.g. to
+                     keep the columns of the rollups, see luftdaten_bulk)
+    :return: generator of (bytes the body of the bulk request, int the amount of documents)
+    """
+    file_date = os.path.split(csv_file)[0].split(os.path.sep)[-1]
+    
+    row_offset = 0
+    
+    # in the full metrics mode the time spent in this generator is measured (without the time of the consumer)
+    detailed = is_detailed()
+    start_time = time() if detailed else 0
+    parse_seconds = 0
+    
+    # the timestamps are indexed as they are (see the format of the timestamp in luftdaten_mapping)
+    for df in iter_csv_chunks(csv_file, chunk_size, parse_dates=False):
+        payload = encode_bulk_documents(df, index_name, file_date, file_id, row_offset=row_offset)
+        row_offset += len(df)
+        
+        if on_chunk is not None:
+            on_chunk(df)
+        
+        increment('rows_parsed_total', len(df))
+        increment('encoded_bytes_total', len(payload))
+        
+        if detailed:
+            parse_seconds += time() - start_time
+        
+        yield payload, len(df)
+        
+        if detailed:
+            start_time = time()
+    
+    increment('files_parsed_total')
+    
+    if detailed:
+        observe('parse_seconds', parse_seconds + time() - start_time)
@@ -13,6 +13,11 @@
 # 1. it will index all downloaded csv files into Elastic Search
 # 2. it will keep track of the most recent indexed file and continue on that progress
 #
+# several ingest jobs (target index + filters, see create_ingest_job) share a single walk through the archive and the
+# local data: each csv file is downloaded and read once, its documents are sent to the indices of all matching jobs
+#
+# the monthly indices of the completely indexed months are sealed after a run (read-only, force merged, see
+# luftdaten_seal), the following runs skip the sealed months
 ###
 
 __author__ = 'Martin Andreas Woerz'
@@ -20,15 +25,24 @@ __email__ = 'm.woerz@ieservices.de'
 __copyright__ = "Copyright 2018, Martin Woerz"
 __version__ = "0.0.7"
 
+import calendar
 import glob
 import os
-from datetime import datetime
+from datetime import date
 from time import time
-import urllib.request
-import pandas as pd
-from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+
+from luftdaten_listing import connect as connect_listings, get_cached_listing, get_links, is_final_listing, is_immutable_listing
+from luftdaten_download import download_files, migrate_csv_directory, DOWNLOAD_WORKERS
+from luftdaten_checkpoint import connect as connect_checkpoints, count_indexed_files, delete_indexed_files, get_indexed_files, import_file_index, is_file_index_imported, mark_files_indexed, CHECKPOINT_BATCH_SIZE
+from luftdaten_bulk_load import begin_bulk_load, end_bulk_load, record_run, BULK_LOAD
+from luftdaten_bulk import iter_file_chunks, iter_file_chunks_parallel, iter_routed_chunks, stream_bulk, BULK_MAX_BYTES, BULK_MAX_DOCS, PARSE_WORKERS, INDEX_WORKERS
+from luftdaten_metrics import flush_metrics, increment, start_metrics_server, METRICS_PORT
+from luftdaten_mapping import get_data_mapping, get_index_settings, get_rollup_mapping, SENSOR_TYPE_FIELDS
+from luftdaten_rollup import get_rollup_index_name, INDEX_ROLLUPS
+from luftdaten_seal import read_state as read_sealed_indices, seal_index, unseal_indices, SEAL_INDICES, SEAL_SHRINK
+from luftdaten_sensors import connect as connect_sensors, register_csv_files, register_listing
 
 # define the initial values
 target_url = "http://archive.luftdaten.info/"
@@ -62,22 +76,24 @@ def prepare_data_directory():
         os.makedirs(data_directory)
 
 
-def fetch_links(resource_url, only_directories=False):
+def fetch_links(resource_url, only_directories=False, listings=None, pickle_path=None):
     """
-        fetches all links on an HTML document
+        fetches all links on an HTML document (the listings of the archive are cached in the listing store)
     :param resource_url: str url of the HTML document
+    :param only_directories: bool only return the links of directories
+    :param listings: sqlite3.Connection the listing store
+    :param pickle_path: str optional listing cached by previous versions
     :return: list of urls
     """
     urls = []
     
+    if listings is None:
+        listings = connect_listings()
+    
     try:
-        resp = urllib.request.urlopen(resource_url)
-        
-        soup = BeautifulSoup(resp, "html5lib", from_encoding=resp.info().get_param('charset'))
-        
-        for link in soup.find_all('a', href=True):
-            if not only_directories or link['href'][-1] == '/':
-                urls.append(link['href'])
+        for link in get_links(listings, resource_url, pickle_path):
+            if not only_directories or link[-1] == '/':
+                urls.append(link)
     
     except Exception as e:
         print("Error occurred in fetching the data from: {}. Details:\n  {}".format(resource_url, e))
@@ -85,27 +101,138 @@ def fetch_links(resource_url, only_directories=False):
     return urls
 
 
-def download_resources(resource_url, sub_directory, last_days=0, max_files_per_day=0, file_filters=None, sensor_ids_filter=None):
+def filter_csv_urls(csv_urls, max_files_per_day=0, file_filters=None, sensor_ids_filter=None, verbose=True):
     """
-        downloads all csv files
-    :param resource_url: string
-    :param sub_directory: string the target directory, where the csv files are stored
-    :param last_days: int the amount of days back the files should be fetched
-    :param max_files_per_day: int the amount of files which are fetched for each day
+        filters the csv files of a day
+    :param csv_urls: list the csv files of the day
+    :param max_files_per_day: int the amount of files which are accepted for each day
     :param file_filters: list the file containing the list values are accepted
     :param sensor_ids_filter: list the file containing the list of sensor ids
+    :param verbose: bool print the applied filters
+    :return: list the accepted csv files
     """
-    if file_filters is None:
-        file_filters = []
+    if file_filters and len(file_filters) > 0:
+        
+        message = 'File filter for downloads has been set. ' \
+                  'Only accepting files containing: {}'.format(", ".join(file_filters))
+        if verbose:
+            print('  ' + message)
+        
+        file_limit_reached = False
+        csv_urls_filtered = []
+        
+        # first iterate over the filter
+        for file_filter in file_filters:
+            
+            # then iterate over the csv files to get all files matching the filter
+            for csv_url in csv_urls:
+                if csv_url.find(file_filter) > -1:
+                    csv_urls_filtered.append(csv_url)
+                
+                if 0 < max_files_per_day < len(csv_urls_filtered) + 1:
+                    message = 'More files found then accepted. Limiting the files to be downloaded to: {}'.format(max_files_per_day)
+                    if verbose:
+                        print('  ' + message)
+                    file_limit_reached = True
+                    break
+            
+            if file_limit_reached:
+                break
+        
+        csv_urls = csv_urls_filtered
     
-    if sensor_ids_filter is None:
-        sensor_ids_filter = []
+    if sensor_ids_filter and len(sensor_ids_filter) > 0:
+        
+        message = 'File filter for downloads has been set. ' \
+                  'Only accepting files containing: {}'.format(", ".join([str(id) for id in sensor_ids_filter]))
+        if verbose:
+            print('  ' + message)
+        
+        csv_urls_filtered = []
+        
+        # iterate over the files
+        for csv_url in csv_urls:
+            file_id = int(csv_url.split('.')[-2].split('_')[-1])
+            if file_id in sensor_ids_filter:
+                csv_urls_filtered.append(csv_url)
+            
+            if 0 < max_files_per_day < len(csv_urls_filtered) + 1:
+                message = 'More files found then accepted. Limiting the files to be downloaded to: {}'.format(max_files_per_day)
+                if verbose:
+                    print('  ' + message)
+                break
+        
+        csv_urls = csv_urls_filtered
     
-    # create the data directories
-    prepare_data_directory()
+    elif 0 < max_files_per_day < len(csv_urls):
+        message = 'More files found then accepted. Limiting the files to be downloaded to: {}'.format(max_files_per_day)
+        if verbose:
+            print('  ' + message)
+        csv_urls = csv_urls[:max_files_per_day]
     
+    return csv_urls
+
+
+def create_ingest_job(index_name, max_files_per_day=0, file_filters=None, sensor_ids_filter=None, truncate_index=False):
+    """
+        the specification of an ingest job: the csv files accepted by its filters are indexed into <index_name>_YYYY-MM
+        (the jobs of a run share the walk through the archive and the local data, see download_and_index_jobs)
+    :param index_name: str the index name
+    :param max_files_per_day: int the amount of files which are downloaded and indexed for each day (0=no limit)
+    :param file_filters: list only accept files with the matching string pattern
+    :param sensor_ids_filter: list only accept the files of the sensor ids
+    :param truncate_index: bool WARNING: if set to True it will delete all indices data of the job!
+    :return: dict
+    """
+    return {
+        'index_name': index_name,
+        'max_files_per_day': max_files_per_day,
+        'file_filters': file_filters if file_filters is not None else [],
+        'sensor_ids_filter': sensor_ids_filter if sensor_ids_filter is not None else [],
+        'truncate_index': truncate_index,
+    }
+
+
+def filter_csv_urls_of_jobs(csv_urls, ingest_jobs):
+    """
+        the csv files of a day, which are accepted by any of the ingest jobs
+    :param csv_urls: list the csv files of the day
+    :param ingest_jobs: list of the ingest jobs (see create_ingest_job)
+    :return: list the accepted csv files (each file only once)
+    """
+    accepted_urls = []
+    accepted = set()
+    
+    for ingest_job in ingest_jobs:
+        for csv_url in filter_csv_urls(csv_urls, ingest_job['max_files_per_day'], ingest_job['file_filters'], ingest_job['sensor_ids_filter']):
+            if csv_url not in accepted:
+                accepted.add(csv_url)
+                accepted_urls.append(csv_url)
+    
+    return accepted_urls
+
+
+def get_unsealed_jobs(ingest_jobs, file_date, sealed_indices):
+    """
+        the ingest jobs, whose index of the month of a day has not been sealed yet (see luftdaten_seal)
+    :param ingest_jobs: list of the ingest jobs
+    :param file_date: str the day (YYYY-MM-DD)
+    :param sealed_indices: dict the sealed indices (the local state of luftdaten_seal)
+    :return: list of the ingest jobs (the jobs truncating their indices are never skipped)
+    """
+    return [ingest_job for ingest_job in ingest_jobs
+            if ingest_job['truncate_index'] or "{}_{}".format(ingest_job['index_name'], file_date[:7]) not in sealed_indices]
+
+
+def fetch_date_directories(last_days=0, listings=None):
+    """
+        fetches the day directories of the archive, the newest first
+    :param last_days: int the amount of days back (0=all days)
+    :param listings: sqlite3.Connection the listing store
+    :return: list of the day directories (YYYY-MM-DD/)
+    """
     # get all directories where are the .csv files stored (the directories are in the format: YYYY-MM-DD)
-    date_directory_urls = fetch_links(target_url, True)
+    date_directory_urls = fetch_links(target_url, True, listings=listings)
     
     # order by the newest to get the newest items first
     date_directory_urls.reverse()
@@ -118,7 +245,45 @@ def download_resources(resource_url, sub_directory, last_days=0, max_files_per_d
         print('  ' + message)
         date_directory_urls = date_directory_urls[:last_days]
     
+    return date_directory_urls
+
+
+def iter_download_jobs(resource_url, sub_directory, last_days=0, max_files_per_day=0, file_filters=None, sensor_ids_filter=None, ingest_jobs=None, dates=None):
+    """
+        walks through the day directories of the archive and yields the csv files, which have not been downloaded yet
+    :param resource_url: string
+    :param sub_directory: string the target directory, where the csv files are stored
+    :param last_days: int the amount of days back the files should be fetched
+    :param max_files_per_day: int the amount of files which are fetched for each day
+    :param file_filters: list the file containing the list values are accepted
+    :param sensor_ids_filter: list the file containing the list of sensor ids
+    :param ingest_jobs: list of ingest jobs (see create_ingest_job), the files of all jobs are downloaded with a single
+                        walk through the archive (the filters above are ignored)
+    :param dates: list optional days (YYYY-MM-DD), only their files are downloaded (without fetching the list of days)
+    :return: generator of (url, target filename) tuples
+    """
+    listings = connect_listings()
+    sensors = connect_sensors()
+    
+    if dates is not None:
+        date_directory_urls = [date + '/' for date in dates]
+    else:
+        date_directory_urls = fetch_date_directories(last_days, listings)
+    
+    # the days of the sealed months are skipped (no listing, no download)
+    sealed_indices = read_sealed_indices() if ingest_jobs is not None else {}
+    
     for date_directory_url in date_directory_urls:
+        day_ingest_jobs = ingest_jobs
+        
+        if ingest_jobs is not None:
+            day_ingest_jobs = get_unsealed_jobs(ingest_jobs, date_directory_url.rstrip('/'), sealed_indices)
+            
+            if not day_ingest_jobs:
+                message = 'The indices of day {} have been sealed, skipping the day'.format(date_directory_url.rstrip('/'))
+                print('  ' + message)
+                continue
+        
         target_directory = os.path.join(sub_directory, date_directory_url)
         
         # create the target directory if not existing
@@ -127,41 +292,14 @@ def download_resources(resource_url, sub_directory, last_days=0, max_files_per_d
         
         date_url_absolute = resource_url + date_directory_url
         
+        # listing cached by previous versions
         url_df_path = data_directory + os.path.sep + date_directory_url + 'urls.pickle'
         
         message = 'Fetch the file list of day {}...'.format(date_directory_url.rstrip('/'))
         print('  ' + message)
         
-        # cache the response of the directory content (fetch_links could take a while)
-        if not os.path.exists(url_df_path):
-            
-            # fetch the sub directory of the date 2018-05-09
-            message = "Fetch the directory structure of the day {}".format(date_directory_url[:-1])
-            print('  ' + message)
-            file_urls = fetch_links(date_url_absolute)
-            
-            df_file_urls = pd.DataFrame({'url': file_urls})
-            
-            # extract the date, the sensor type, file type and location id
-            df_file_urls = df_file_urls['url'].str.extract('(?P<url>(?P<date>[^_]+)_(?P<sensor>[^_]+)_(?P<type>[^_]+)_(?P<id>[^_.]+).*)', expand=True)
-            
-            # parse the date
-            df_file_urls['date'] = pd.to_datetime(df_file_urls['date'], format="%Y-%m-%d", errors="ignore")
-            
-            # drop the items which are not matching the regex pattern above
-            df_file_urls = df_file_urls.dropna().reset_index().drop('index', axis=1)
-            
-            df_file_urls.to_pickle(url_df_path)
-            
-            message = "{} unique measurements found for the day".format(len(df_file_urls))
-            print('  ' + message)
-        
-        # read the directory content if it was cached before
-        else:
-            df_file_urls = pd.read_pickle(url_df_path)
-            file_urls = list(df_file_urls['url'])
-        
-        file_index = 1
+        # the listings of past days are only fetched once, the listing of the recent days are revalidated
+        file_urls = fetch_links(date_url_absolute, listings=listings, pickle_path=url_df_path)
         
         # get only the links which habe the .csv extension
         csv_urls = []
@@ -173,64 +311,18 @@ def download_resources(resource_url, sub_directory, last_days=0, max_files_per_d
         message = 'For date {} tracking {} files have found'.format(date_directory_url.rstrip('/'), len(csv_urls))
         print('  ' + message)
         
-        if file_filters and len(file_filters) > 0:
-            
-            message = 'File filter for downloads has been set. ' \
-                      'Only accepting files containing: {}'.format(", ".join(file_filters))
-            print('  ' + message)
-            
-            file_limit_reached = False
-            csv_urls_filtered = []
-            
-            # first iterate over the filter
-            for file_filter in file_filters:
-                
-                # then iterate over the csv files to get all files matching the filter
-                for csv_url in csv_urls:
-                    if csv_url.find(file_filter) > -1:
-                        csv_urls_filtered.append(csv_url)
-                    
-                    if 0 < max_files_per_day < len(csv_urls_filtered) + 1:
-                        message = 'More files found then accepted. Limiting the files to be downloaded to: {}'.format(max_files_per_day)
-                        print('  ' + message)
-                        file_limit_reached = True
-                        break
-                
-                if file_limit_reached:
-                    break
-            
-            csv_urls = csv_urls_filtered
+        increment('listing_days_total')
+        increment('files_listed_total', len(csv_urls))
         
-        if sensor_ids_filter and len(sensor_ids_filter) > 0:
-            
-            message = 'File filter for downloads has been set. ' \
-                      'Only accepting files containing: {}'.format(", ".join([str(id) for id in sensor_ids_filter]))
-            print('  ' + message)
-            
-            file_limit_reached = False
-            csv_urls_filtered = []
-            
-            # iterate over the files
-            for csv_url in csv_urls:
-                file_id = int(csv_url.split('.')[-2].split('_')[-1])
-                if file_id in sensor_ids_filter:
-                    csv_urls_filtered.append(csv_url)
-                
-                if 0 < max_files_per_day < len(csv_urls_filtered) + 1:
-                    message = 'More files found then accepted. Limiting the files to be downloaded to: {}'.format(max_files_per_day)
-                    print('  ' + message)
-                    break
-                
-                if file_limit_reached:
-                    break
-            
-            csv_urls = csv_urls_filtered
+        # all sensors of the day are registered (also the ones, which are not downloaded)
+        register_listing(sensors, date_directory_url.rstrip('/'), csv_urls, immutable=is_immutable_listing(date_url_absolute))
         
-        elif 0 < max_files_per_day < len(csv_urls):
-            message = 'More files found then accepted. Limiting the files to be downloaded to: {}'.format(max_files_per_day)
-            print('  ' + message)
-            csv_urls = csv_urls[:max_files_per_day]
+        if day_ingest_jobs is not None:
+            csv_urls = filter_csv_urls_of_jobs(csv_urls, day_ingest_jobs)
+        else:
+            csv_urls = filter_csv_urls(csv_urls, max_files_per_day, file_filters, sensor_ids_filter)
         
+        files_queued = 0
         for file_url in csv_urls:
             uri = date_url_absolute + file_url
             
@@ -239,117 +331,101 @@ def download_resources(resource_url, sub_directory, last_days=0, max_files_per_d
             target_filename = os.path.join(target_directory, local_filename)
             
             if not os.path.exists(target_filename):
-                progress = round((file_index / len(csv_urls) * 100), 2)
-                message = 'Progress: {}% | Download csv file: {} | File {}/{}'.format(progress, uri, file_index, len(csv_urls))
-                print('    ' + message)
-                df = pd.read_csv(uri, sep=';')
-                df.to_csv(target_filename)
-            file_index += 1
+                files_queued += 1
+                yield uri, target_filename
         
+        message = 'Queued {}/{} csv files of day {} for downloading'.format(files_queued, len(csv_urls), date_directory_url.rstrip('/'))
+        print('  ' + message)
         print("")
 
 
-def collect_csv_data(index_name, csv_file, current_id, chunk_size=8 * 1024):
-    # open csv file
-    fp = open(csv_file)  # read csv
+def download_resources(resource_url, sub_directory, last_days=0, max_files_per_day=0, file_filters=None, sensor_ids_filter=None, workers=DOWNLOAD_WORKERS, ingest_jobs=None,
+                       dates=None):
+    """
+        downloads all csv files
+    :param resource_url: string
+    :param sub_directory: string the target directory, where the csv files are stored
+    :param last_days: int the amount of days back the files should be fetched
+    :param max_files_per_day: int the amount of files which are fetched for each day
+    :param file_filters: list the file containing the list values are accepted
+    :param sensor_ids_filter: list the file containing the list of sensor ids
+    :param workers: int the amount of parallel downloads
+    :param ingest_jobs: list of ingest jobs (see create_ingest_job), the files of all jobs are downloaded at once
+    :param dates: list optional days (YYYY-MM-DD), only their files are downloaded
+    """
+    if file_filters is None:
+        file_filters = []
     
-    # parse csv with pandas # todo add: parse_dates=True, index_col='DateTime',
-    csv_data = pd.read_csv(fp, iterator=True, chunksize=chunk_size, parse_dates=True)
+    if sensor_ids_filter is None:
+        sensor_ids_filter = []
     
-    # start indexing
-    message = "Collecting csv data for bucket list. Reading file '{}'".format(csv_file)
-    print("      " + message)
+    # create the data directories
+    prepare_data_directory()
     
-    file_date = os.path.split(csv_file)[0].split(os.path.sep)[-1]
+    # the listing of the next days continues, while the files of the previous days are being downloaded
+    jobs = iter_download_jobs(resource_url, sub_directory, last_days=last_days, max_files_per_day=max_files_per_day,
+                              file_filters=file_filters, sensor_ids_filter=sensor_ids_filter, ingest_jobs=ingest_jobs, dates=dates)
     
-    list_records = []
-    for i, df in enumerate(csv_data):
-        df['timestamp'] = pd.to_datetime(df['timestamp'])
-        df.drop('Unnamed: 0', axis=1, inplace=True)
-        
-        # fetch the data frame records
-        records = df.where(pd.notnull(df), None).T.to_dict()
-        
-        # enrich index entry with meta data
-        for df_index in records:
-            record = records[df_index]
-            
-            # related import directory (date)
-            record['file_date'] = file_date
-            
-            # related import file
-            record['file_id'] = current_id
-            
-            # prepare the geo data (array representation with [lon,lat])
-            # see @url https://www.elastic.co/guide/en/elasticsearch/guide/current/lat-lon-formats.html
-            record['geo_location'] = [record['lon'], record['lat']]
-            
-            del record['lat']
-            del record['lon']
-            
-            record.update({
-                "_index": index_name,
-                "_type": es_doc_type,
-            })
-            
-            list_records.append(record)
-    
-    return list_records
-
-
-def prepare_and_cleanup_index(index_name, file_id, file_date):
-    # delete all partially indexed entries (when the import process has been aborted)
+    download_files(jobs, workers=workers)
     
-    try:
-        if es.count(index_name, doc_type=es_doc_type).get('count') > 0:
-            
-            match_query = {"bool": {"must":
-                [
-                    {"match": {"file_date": file_date}},
-                    {"match": {"file_id": file_id}},
-                ]
-            }}
-            
-            # fetches all index items which are matching the same file date and id
-            result = es.delete_by_query(index_name, doc_type=es_doc_type, body={"query": match_query})
-            
-            if result.get('deleted') > 0:
-                import_message = "Deleted {} partially imported indexes.".format(result.get('deleted'))
-                print("      " + import_message)
-    except Exception as e:
-        message = "Error in performing elasticsearch action. Details\n  '{}'".format(e)
-        print(message)
+    # the run report and the Prometheus text file (see luftdaten_metrics)
+    flush_metrics(force=True)
 
 
-def index_csv_data(index_name, index_files, records, collection_data):
+def iter_csv_files_to_index(index_name, csv_files, indexed_file_ids=None, max_csv_file_index_per_day=0, file_filters=None, sensor_ids_filter=None):
     """
-        indexes a given csv file into ElasticSearch
+        yields the csv files of a day, which are accepted by the filters and have not been imported yet
     :param index_name: str the index name
-    :param index_files: str the index files
-    :param records: list the data to index
-    :param collection_data: list the related meta information about the records
+    :param csv_files: list the csv files of the day ordered by the file id
+    :param indexed_file_ids: set the ids of the files of the day, which have already been imported
+    :param max_csv_file_index_per_day: int the amount of files which are indexed for each day (0=no limit)
+    :param file_filters: list only index files with the matching string pattern
+    :param sensor_ids_filter: list the file containing the list of sensor ids
+    :return: generator of (index name of the month, csv file, file date, file id) tuples
     """
-    start_time = time()
+    if indexed_file_ids is None:
+        indexed_file_ids = set()
     
-    # index the records
-    try:
-        bulk(es, records)
-    except Exception as e:
-        import_message = "Error in indexing. Used [index:'{}'] [doc_type:{}]. Details:\n  {}".format(index_name, es_doc_type, e)
-        print("  " + import_message)
-    
-    # once all items of a file have been indexed, save the import status to the file index
-    for bucket_collection_item in collection_data:
-        file_id = bucket_collection_item.get('file_id')
-        file_date = bucket_collection_item.get('file_date')
-        file_index_data = {"file_id": file_id, "file_date": file_date, 'timestamp': datetime.now()}
-        es.index(index_files, doc_type="indexed", body=file_index_data)
-    
-    duration = time() - start_time
-    items = len(records)
-    speed = items / duration
-    message = "Indexing of bucket done. Wrote %s items into %s in %.3fs. Speed (%s items/s)." % (items, index_name, duration, round(speed, 2))
-    print("    " + message)
+    files_indexed_day_count = len(indexed_file_ids)
+    
+    # iterate over all csv files and check
+    for csv_file in csv_files:
+        
+        accept_file = True
+        if file_filters:
+            accept_file = False
+            for file_filter in file_filters:
+                if csv_file.find(file_filter) > -1:
+                    accept_file = True
+        
+        if sensor_ids_filter:
+            accept_file = False
+            
+            file_id = int(csv_file.split('.')[-2].split('_')[-1])
+            if file_id in sensor_ids_filter:
+                accept_file = True
+        
+        if accept_file:
+            
+            if max_csv_file_index_per_day == 0 or files_indexed_day_count < max_csv_file_index_per_day:
+                file_id = int(csv_file.split('.')[-2].split('_')[-1])
+                file_date = csv_file.split('.')[-2].split('_')[1]
+                
+                # create a unique index for each month in the format YYYY-MM (2018-01)
+                date_year_month = "-".join(file_date.split('-')[:2])
+                index_data_name = "{}_{}".format(index_name, date_year_month)
+                
+                if file_id not in indexed_file_ids:
+                    
+                    if files_indexed_day_count > 0:
+                        if max_csv_file_index_per_day > 0:
+                            message = '{}/{} (limited) files have been queued for indexing'.format(files_indexed_day_count, max_csv_file_index_per_day)
+                        else:
+                            message = '{}/{} files have been queued for indexing'.format(files_indexed_day_count, len(csv_files))
+                        print("    " + message)
+                    
+                    files_indexed_day_count += 1
+                    yield index_data_name, csv_file, file_date, file_id
 
 
 def prepare_file_index(index_files_name, truncate_index=False):
@@ -391,7 +467,13 @@ def prepare_file_index(index_files_name, truncate_index=False):
         es.indices.create(index_files_name, body=mapping)
 
 
-def prepare_data_index(index_name, truncate_index=False):
+def prepare_data_index(index_name, truncate_index=False, document_mapping=None):
+    """
+        creates the index of the sensor data (if not existing)
+    :param index_name: str the index name
+    :param truncate_index: bool WARNING: if set to True it will delete all indices data!
+    :param document_mapping: dict the mapping of the document type (default: the mapping of all sensor types)
+    """
     empty_index = False
     
     # check the status of the indices
@@ -418,23 +500,21 @@ def prepare_data_index(index_name, truncate_index=False):
             "mappings": {}
         }
         
-        # added the mapping
-        mapping["mappings"][es_doc_type] = {
-            "properties": {
-                "geo_location": {
-                    "type": "geo_point",
-                }
-            }
-        }
+        # added the mapping (typed fields, see luftdaten_mapping)
+        mapping["mappings"][es_doc_type] = document_mapping if document_mapping is not None else get_data_mapping()
         
         if ELASTICSEARCH_SINGLE_HOST:
             # if this is a once node cluster only create 1 shard and no replicas
-            mapping["settings"] = {"number_of_replicas": 0}
+            mapping["settings"] = get_index_settings({"number_of_replicas": 0})
+        else:
+            mapping["settings"] = get_index_settings()
         
         es.indices.create(index_name, body=mapping)
 
 
-def index_csv_files(index_name, directory, truncate_index=False, max_csv_file_index_per_day=0, file_filters=None, sensor_ids_filter=None, max_bucket_size=100):
+def index_csv_files(index_name, directory, truncate_index=False, max_csv_file_index_per_day=0, file_filters=None, sensor_ids_filter=None,
+                    max_bulk_bytes=BULK_MAX_BYTES, max_bulk_docs=BULK_MAX_DOCS, chunk_size=8 * 1024, parse_workers=PARSE_WORKERS, index_workers=INDEX_WORKERS, rollups=INDEX_ROLLUPS,
+                    bulk_load=BULK_LOAD, force_merge=False):
     """
     Indexes all csv files to the ELASTICSEARCH server.
     Also it will keep track of the most recent indexed file and continue on that progress.
@@ -443,180 +523,403 @@ def index_csv_files(index_name, directory, truncate_index=False, max_csv_file_in
     :param max_csv_file_index_per_day: int the amount of files which are indexed for each day (0=no limit)
     :param file_filters: list only index files with the matching string pattern
     :param sensor_ids_filter: list the file containing the list of sensor ids
-    :param max_bucket_size: int the amount of files which are collected to be indexed (before they are actually being bulk indexed)
+    :param max_bulk_bytes: int the maximum size of a bulk request in bytes
+    :param max_bulk_docs: int the maximum amount of documents of a bulk request
+    :param chunk_size: int the amount of rows which are read from a csv file at once
+    :param parse_workers: int the amount of processes reading and encoding the csv files (1=no extra processes)
+    :param index_workers: int the amount of threads sending the bulk requests
+    :param rollups: bool compute the hourly and daily rollups of the files (indexed into <index>_rollup_YYYY-MM)
+    :param bulk_load: bool switch the filled indices into the bulk load mode during the run (see luftdaten_bulk_load)
+    :param force_merge: bool force merge the filled indices after the run (only in bulk load mode)
     """
+    ingest_job = create_ingest_job(index_name, max_csv_file_index_per_day, file_filters, sensor_ids_filter, truncate_index)
     
-    if file_filters is None:
-        file_filters = []
+    index_jobs([ingest_job], directory, max_bulk_bytes=max_bulk_bytes, max_bulk_docs=max_bulk_docs, chunk_size=chunk_size, parse_workers=parse_workers,
+               index_workers=index_workers, rollups=rollups, bulk_load=bulk_load, force_merge=force_merge)
+
+
+def load_indexed_files(ingest_jobs, checkpoints):
+    """
+        fetches the files of the ingest jobs, which have already been imported (the checkpoints of the truncated jobs
+        are deleted, the file index of Elastic Search is taken over by existing deployments)
+    :param ingest_jobs: list of the ingest jobs
+    :param checkpoints: sqlite3.Connection the checkpoint store
+    :return: dict index name => file date => set of the file ids
+    """
+    indexed_files = {}
     
-    if sensor_ids_filter is None:
-        sensor_ids_filter = []
+    for ingest_job in ingest_jobs:
+        index_name = ingest_job['index_name']
         
-        ###
+        if ingest_job['truncate_index']:
+            message = "Checkpoints of '{}' will be deleted (truncate_index=True)".format(index_name)
+            print("    " + message)
+            delete_indexed_files(checkpoints, index_name)
+            unseal_indices(es, index_name)
+            
+            # the outdated file index of previous versions (it is never imported again, see luftdaten_checkpoint)
+            es.indices.delete(index="{}_file_index".format(index_name), ignore=404)
+        
+        elif not is_file_index_imported(checkpoints, index_name) and count_indexed_files(checkpoints, index_name) == 0:
+            # existing deployments: take over the import status of the Elastic Search file index (only once)
+            import_file_index(checkpoints, es, index_name)
+        
+        indexed_files[index_name] = get_indexed_files(checkpoints, index_name)
+    
+    return indexed_files
+
+
+def index_jobs(ingest_jobs, directory, max_bulk_bytes=BULK_MAX_BYTES, max_bulk_docs=BULK_MAX_DOCS, chunk_size=8 * 1024, parse_workers=PARSE_WORKERS, index_workers=INDEX_WORKERS,
+               rollups=INDEX_ROLLUPS, bulk_load=BULK_LOAD, force_merge=False, dates=None, seal=SEAL_INDICES, shrink=SEAL_SHRINK):
+    """
+        indexes the csv files of several ingest jobs with a single walk through the local data: each csv file is read
+        and encoded once and its documents are sent to the indices of all jobs accepting the file
+        (each job keeps track of its own progress, see index_csv_files)
+    :param ingest_jobs: list of the ingest jobs (see create_ingest_job)
+    :param directory: str the directories where the csv files are stored
+    :param dates: list optional days (YYYY-MM-DD), only their files are indexed (e.g. a work item, see luftdaten_queue)
+    :param seal: bool seal the indices of the completely indexed months after the run (see luftdaten_seal)
+    :param shrink: bool shrink the sealed indices into one shard
+    :return: int the amount of indexed documents
+    """
+    index_names = [ingest_job['index_name'] for ingest_job in ingest_jobs]
+    
+    if len(set(index_names)) != len(index_names):
+        raise ValueError("The index names of the ingest jobs have to be unique: {}".format(", ".join(index_names)))
+    
+    ###
     # check if any data has been previously imported
     ##
     message = "Continuing the indexing process"
     print(message)
     
-    index_files_name = "{}_file_index".format(index_name)
-    prepare_file_index(index_files_name, truncate_index)
+    checkpoints = connect_checkpoints()
+    sensors = connect_sensors()
+    
+    # all files of each job, which have already been imported (index name => file date => file ids)
+    indexed_files = load_indexed_files(ingest_jobs, checkpoints)
+    
+    # convert the csv files downloaded by previous versions into the original format of the archive (only once)
+    migrate_csv_directory(directory)
     
     date_directories = glob.glob('%s/**' % directory)
     
     # order the date directories by the most recent first
     date_directories = sorted(date_directories, reverse=True)
     
+    if dates is not None:
+        date_directories = [date_directory for date_directory in date_directories if date_directory.rstrip('/').split('/')[-1] in dates]
+    
     indexes_truncated = []
     
-    for date_directory in date_directories:
-        
-        file_date = date_directory.split('/')[-1]
+    # the indices in bulk load mode, their settings are restored after the run
+    bulk_loaded_indices = [] if bulk_load else None
+    
+    # the months of the sealed indices are skipped
+    sealed_indices = read_sealed_indices()
+    
+    start_time = time()
+    documents_count = 0
+    
+    # the process pool of the parse stage is shared by all days
+    executor = ProcessPoolExecutor(max_workers=parse_workers) if parse_workers > 1 else None
+    
+    try:
+        for date_directory in date_directories:
+            documents_count += index_date_directory(ingest_jobs, directory, date_directory, checkpoints, sensors, indexed_files, indexes_truncated,
+                                                    max_bulk_bytes, max_bulk_docs, chunk_size, executor, index_workers, rollups, bulk_loaded_indices, sealed_indices,
+                                                    parse_workers)
+            
+            # the metrics are written at most once per METRICS_INTERVAL while the run is in progress
+            flush_metrics()
+    finally:
+        if executor is not None:
+            executor.shutdown()
         
-        # ignore files and directories not complying to the date structure
-        if os.path.isfile(date_directory) or len(file_date.split('-')) != 3:
-            continue
+        if bulk_load:
+            end_bulk_load(es, bulk_loaded_indices, force_merge=force_merge)
         
-        last_imported_file_id = None
+        flush_metrics(force=True)
+    
+    record_run(indexes_truncated, documents_count, time() - start_time, bulk_load)
+    
+    if seal:
+        seal_completed_months(ingest_jobs, checkpoints, shrink=shrink)
+    
+    return documents_count
+
+
+def prepare_job_indices(ingest_job, index_data_name, indexes_truncated, rollups=False, bulk_loaded_indices=None):
+    """
+        creates the indices of a job for a month (only once per run)
+    :param ingest_job: dict the ingest job (see create_ingest_job)
+    :param index_data_name: str the index of the month
+    :param indexes_truncated: list the indices, which have already been prepared in this run
+    :param rollups: bool also create the rollup index
+    :param bulk_loaded_indices: list the indices in bulk load mode (None=bulk load mode disabled)
+    """
+    # truncate the indexes only once per run
+    if index_data_name in indexes_truncated:
+        return
+    
+    file_filters = ingest_job['file_filters']
+    
+    # the mapping only contains the measurements of the sensor types of the file filters (if they are sensor types)
+    sensor_types = file_filters if file_filters and all(file_filter.lower() in SENSOR_TYPE_FIELDS for file_filter in file_filters) else None
+    
+    prepare_data_index(index_data_name, ingest_job['truncate_index'], get_data_mapping(sensor_types))
+    
+    if rollups:
+        prepare_data_index(get_rollup_index_name(index_data_name), ingest_job['truncate_index'], get_rollup_mapping(sensor_types))
+    
+    if bulk_loaded_indices is not None:
+        for bulk_load_index_name in [index_data_name, get_rollup_index_name(index_data_name)] if rollups else [index_data_name]:
+            begin_bulk_load(es, bulk_load_index_name)
+            bulk_loaded_indices.append(bulk_load_index_name)
+    
+    indexes_truncated.append(index_data_name)
+
+
+def index_date_directory(ingest_jobs, directory, date_directory, checkpoints, sensors, indexed_files, indexes_truncated,
+                         max_bulk_bytes, max_bulk_docs, chunk_size, executor, index_workers, rollups=False, bulk_loaded_indices=None, sealed_indices=None,
+                         parse_workers=PARSE_WORKERS):
+    """
+        indexes the csv files of a day directory into the indices of the ingest jobs (see index_jobs)
+    :param indexed_files: dict index name => file date => set of the file ids, which have already been imported
+    :param executor: concurrent.futures.ProcessPoolExecutor the parse stage (None=the files are parsed serially)
+    :param parse_workers: int the amount of processes of the executor
+    :param bulk_loaded_indices: list the indices in bulk load mode (None=bulk load mode disabled)
+    :param sealed_indices: dict the sealed indices, their days are skipped (see luftdaten_seal)
+    :return: int the amount of indexed documents
+    """
+    file_date = date_directory.split('/')[-1]
+    
+    # ignore files and directories not complying to the date structure
+    if os.path.isfile(date_directory) or len(file_date.split('-')) != 3:
+        return 0
+    
+    if sealed_indices:
+        ingest_jobs = get_unsealed_jobs(ingest_jobs, file_date, sealed_indices)
         
-        # create a unique index for each month in the format YYYY-MM (2018-01)
-        date_year_month = "-".join(file_date.split('-')[:2])
-        index_data_name = "{}_{}".format(index_name, date_year_month)
+        if not ingest_jobs:
+            return 0
+    
+    csv_files = glob.glob('%s%s/*.csv' % (directory, file_date))
+    
+    # order the files by the filename index
+    csv_files = sorted(csv_files, key=lambda name: int(name.split('.')[-2].split('_')[-1]))
+    
+    # the targets of each accepted file: (file date, file id) => list of (index name of the job, index name of the month)
+    file_routes = {}
+    files = []
+    
+    for ingest_job in ingest_jobs:
+        index_name = ingest_job['index_name']
         
-        # truncate the indexes only once per run
-        if index_data_name not in indexes_truncated:
-            prepare_data_index(index_data_name, truncate_index)
-            indexes_truncated.append(index_data_name)
+        # the files of the day, which have already been imported (to be able to return on the import where it was last)
+        indexed_file_ids = indexed_files[index_name].get(file_date, set())
         
-        ##
-        # get the id last imported file id of the imported directory
-        # (to be able to return on the import where it was last)
-        ##
-        files_indexed_day_count = 0
+        if len(indexed_file_ids) > 0:
+            message = "{} csv files for the date {} have already been imported into '{}'".format(len(indexed_file_ids), file_date, index_name)
+            print(message)
         
-        if es.indices.exists(index_files_name) and es.count(index_files_name).get('count') > 0:
-            
-            # get one result with the newest timestamp (descendant ordering)
-            doc = {
-                'query': dict(match=dict(file_date=file_date)),
-                'sort': dict(timestamp=dict(order="desc")),
-                'size': 1
-            }
-            
-            items = es.search(index=index_files_name, doc_type="indexed", body=doc)
+        for index_data_name, csv_file, csv_file_date, file_id in iter_csv_files_to_index(index_name, csv_files, indexed_file_ids, ingest_job['max_files_per_day'],
+                                                                                          ingest_job['file_filters'], ingest_job['sensor_ids_filter']):
+            prepare_job_indices(ingest_job, index_data_name, indexes_truncated, rollups, bulk_loaded_indices)
             
-            hits = items.get('hits')
+            # the file is encoded for its first target and sent to the other targets as it is
+            if (csv_file_date, file_id) not in file_routes:
+                file_routes[(csv_file_date, file_id)] = []
+                files.append((index_data_name, csv_file, csv_file_date, file_id))
             
-            imported_files = hits.get('total')
-            
-            if len(hits) > 0:
-                records = hits.get('hits')
-                
-                # get the id of the last imported file
-                if len(records) > 0:
-                    message = "{} csv files for the date {} have already been imported".format(imported_files, file_date)
-                    files_indexed_day_count = imported_files
-                    print(message)
-                    
-                    last_imported_file_id = records[-1].get('_source').get('file_id')
-                    message = "The last imported id for the date {} was {}".format(file_date, last_imported_file_id)
-                    print(message)
+            file_routes[(csv_file_date, file_id)].append((index_name, index_data_name))
+    
+    if not files:
+        return 0
+    
+    # keep the order of the file ids
+    files = sorted(files, key=lambda file: file[3])
+    
+    # the locations of the sensors are taken over from the first row of their most recent csv file (only of the files
+    # indexed by the jobs, the other files are not opened)
+    register_csv_files(sensors, [csv_file for _, csv_file, _, _ in files])
+    
+    # the files are read chunk by chunk and streamed into bulk requests, which are limited by bytes and documents
+    # the documents have deterministic ids (file date, file id, row): the documents of a file, which has been
+    # partially indexed by an aborted run, are overwritten (no cleanup of the index needed)
+    if executor is not None:
+        chunks = iter_file_chunks_parallel(files, executor, chunk_size=min(chunk_size, max_bulk_docs), rollups=rollups, parse_workers=parse_workers)
+    else:
+        chunks = iter_file_chunks(files, chunk_size=min(chunk_size, max_bulk_docs), rollups=rollups)
+    
+    chunks = iter_routed_chunks(chunks, file_routes, rollups)
+    
+    # once all items of a file have been indexed, save the import status of the job to the checkpoint store (in batches)
+    files_done = {}
+    
+    def on_file_done(done_index_name, done_file_date, done_file_id):
+        job_files_done = files_done.setdefault(done_index_name, [])
+        job_files_done.append((done_file_date, done_file_id))
+        
+        if len(job_files_done) >= CHECKPOINT_BATCH_SIZE:
+            mark_files_indexed(checkpoints, done_index_name, job_files_done)
+            del job_files_done[:]
+    
+    index_data_names = sorted(set(index_data_name for targets in file_routes.values() for _, index_data_name in targets))
+    
+    message = "Indexing data of day {} into indices: {}".format(file_date, ", ".join(index_data_names))
+    print(" " + message)
+    
+    try:
+        indexed_count, _, _ = stream_bulk(es, chunks, max_bytes=max_bulk_bytes, max_docs=max_bulk_docs, on_file_done=on_file_done, index_workers=index_workers)
+    finally:
+        for done_index_name, job_files_done in files_done.items():
+            mark_files_indexed(checkpoints, done_index_name, job_files_done)
+    
+    message = "Files for day: {} have been indexed".format(file_date)
+    print("    " + message)
+    print("")
+    
+    return indexed_count
+
+
+def get_final_listing(listings, url, listing_date):
+    """
+        the cached listing of a directory, which is revalidated (one conditional request), if it has been fetched
+        before the listing of the day became immutable (see luftdaten_listing.is_final_listing)
+    :param listings: sqlite3.Connection the listing store
+    :param url: str the url of the directory
+    :param listing_date: date the day, after which the listing does not change anymore
+    :return: dict the listing or None if it could not be fetched
+    """
+    listing = get_cached_listing(listings, url)
+    
+    if listing is not None and is_final_listing(listing, listing_date):
+        return listing
+    
+    try:
+        get_links(listings, url)
+    except OSError as e:
+        message = "Error in revalidating the listing '{}'. Details:\n  {}".format(url, e)
+        print("  " + message)
+        return None
+    
+    return get_cached_listing(listings, url)
+
+
+def is_month_complete(ingest_job, month, indexed_files, listings, today=None):
+    """
+        checks if all files of a month, which are accepted by an ingest job, have been indexed
+        (the days of the month and their files are taken of the listings of the archive in the listing store, the
+        listings fetched before their day became immutable are revalidated first)
+    :param ingest_job: dict the ingest job (see create_ingest_job)
+    :param month: str the month (YYYY-MM)
+    :param indexed_files: dict file date => set of the file ids indexed by the job
+    :param listings: sqlite3.Connection the listing store
+    :param today: date the current day
+    :return: bool
+    """
+    year, month_number = int(month[:4]), int(month[5:7])
+    last_day = date(year, month_number, calendar.monthrange(year, month_number)[1])
+    
+    # the month is over and the listings of its days do not change anymore
+    if not is_immutable_listing(target_url + last_day.isoformat() + '/', today):
+        return False
+    
+    root_listing = get_final_listing(listings, target_url, last_day)
+    
+    if root_listing is None:
+        return False
+    
+    file_dates = [link.rstrip('/') for link in root_listing.get('links') if link.startswith(month + '-') and link[-1] == '/']
+    
+    if not file_dates:
+        return False
+    
+    for file_date in file_dates:
+        listing = get_final_listing(listings, target_url + file_date + '/', date.fromisoformat(file_date))
         
-        last_imported_id_found = False
-        csv_files = glob.glob('%s%s/*.csv' % (directory, file_date))
+        if listing is None:
+            return False
         
-        # order the files by the filename index
-        csv_files = sorted(csv_files, key=lambda name: int(name.split('.')[-2].split('_')[-1]))
+        csv_urls = [link for link in listing.get('links') if os.path.splitext(link)[1].lower() == '.csv']
+        accepted_urls = filter_csv_urls(csv_urls, ingest_job['max_files_per_day'], ingest_job['file_filters'], ingest_job['sensor_ids_filter'], verbose=False)
         
-        bucket_records = []
-        bucket_size = 0
-        bucket_collection_data = []
+        # the limited jobs index the first files found locally, which are not necessarily the first ones of the listing
+        if len(indexed_files.get(file_date, ())) < len(accepted_urls):
+            return False
+    
+    return True
+
+
+def seal_completed_months(ingest_jobs, checkpoints, shrink=SEAL_SHRINK, today=None):
+    """
+        seals the monthly indices (and their rollup indices) of the ingest jobs, once all files of their month have been
+        indexed (see luftdaten_seal), the sealed months are skipped by the following runs (the jobs truncating their
+        indices are not sealed)
+    :param ingest_jobs: list of the ingest jobs
+    :param checkpoints: sqlite3.Connection the checkpoint store
+    :param shrink: bool shrink the sealed indices into one shard
+    :param today: date the current day
+    :return: list of the sealed indices
+    """
+    listings = connect_listings()
+    sealed_indices = read_sealed_indices()
+    
+    sealed = []
+    
+    for ingest_job in ingest_jobs:
+        # the indices of a truncated job are deleted by each run, they are never sealed
+        if ingest_job['truncate_index']:
+            continue
         
-        # iterate over each filter
-        if file_filters == [] or len(file_filters) > 0:
+        indexed_files = get_indexed_files(checkpoints, ingest_job['index_name'])
+        
+        for month in sorted(set(file_date[:7] for file_date in indexed_files)):
+            index_data_name = "{}_{}".format(ingest_job['index_name'], month)
             
-            # iterate over all csv files and check
-            for csv_file in csv_files:
-                
-                accept_file = True
-                if file_filters:
-                    accept_file = False
-                    for file_filter in file_filters:
-                        if csv_file.find(file_filter) > -1:
-                            accept_file = True
-                
-                if sensor_ids_filter:
-                    accept_file = False
-                    
-                    file_id = int(csv_file.split('.')[-2].split('_')[-1])
-                    if file_id in sensor_ids_filter:
-                        accept_file = True
-                
-                if accept_file:
-                    
-                    if max_csv_file_index_per_day == 0 or files_indexed_day_count < max_csv_file_index_per_day:
-                        file_id = int(csv_file.split('.')[-2].split('_')[-1])
-                        file_date = csv_file.split('.')[-2].split('_')[1]
-                        
-                        # create a unique index for each month in the format YYYY-MM (2018-01)
-                        date_year_month = "-".join(file_date.split('-')[:2])
-                        index_data_name = "{}_{}".format(index_name, date_year_month)
-                        
-                        if file_id == last_imported_file_id:
-                            last_imported_id_found = True
-                        elif last_imported_file_id is None or last_imported_id_found:
-                            
-                            if files_indexed_day_count > 0:
-                                if max_csv_file_index_per_day > 0:
-                                    message = '{}/{} (limited) files have been queued for indexing'.format(files_indexed_day_count, max_csv_file_index_per_day)
-                                else:
-                                    message = '{}/{} files have been queued for indexing'.format(files_indexed_day_count, len(csv_files))
-                                print("    " + message)
-                            
-                            # cleanup the index:
-                            # delete items related items towards the file_id and the file_date, if the previous indexing process was aborted
-                            prepare_and_cleanup_index(index_data_name, file_id, file_date)
-                            
-                            # read multiple the csv files into a record list and then only index it
-                            # when the bucket
-                            bucket_records.extend(collect_csv_data(index_data_name, csv_file, file_id))
-                            
-                            bucket_collection_data.append({'file_id': file_id, 'file_date': file_date})
-                            bucket_size += 1
-                            files_indexed_day_count += 1
-                
-                # when the bucket is full, index
-                if bucket_size > max_bucket_size:
-                    message = "Indexing data of bucket list into index: {}".format(index_data_name)
-                    print(" " + message)
-                    index_csv_data(index_data_name, index_files_name, bucket_records, bucket_collection_data)
-                    bucket_size = 0
-                    print("")
-        
-        # when the bucket was filled, all files of the day considered
-        if len(bucket_records) > 0:
-            message = "Indexing data of bucket list into index: {}".format(index_data_name)
-            print(" " + message)
-            index_csv_data(index_data_name, index_files_name, bucket_records, bucket_collection_data)
-            print("")
-        
-        message = "Files for day: {} have been indexed".format(file_date)
-        print("    " + message)
-        print("")
+            if index_data_name in sealed_indices or not is_month_complete(ingest_job, month, indexed_files, listings, today):
+                continue
+            
+            try:
+                for seal_index_name in [index_data_name, get_rollup_index_name(index_data_name)]:
+                    if es.indices.exists(seal_index_name):
+                        seal_index(es, seal_index_name, shrink=shrink)
+                        sealed.append(seal_index_name)
+            except Exception as e:
+                message = "Error in sealing the index '{}'. Details:\n  {}".format(index_data_name, e)
+                print("  " + message)
+    
+    return sealed
 
 
 def download_and_index(index_name, max_csv_file_index_per_day, last_days, file_filters=None, sensor_ids_filter=None, truncate_index=False, download=True, index=True):
-    # step 1. download the csv files for the sensors with the type containing the dust values
+    ingest_job = create_ingest_job(index_name, max_csv_file_index_per_day, file_filters, sensor_ids_filter, truncate_index)
+    
+    download_and_index_jobs([ingest_job], last_days, download=download, index=index)
+
+
+def download_and_index_jobs(ingest_jobs, last_days, download=True, index=True):
+    """
+        downloads and indexes the csv files of several ingest jobs with a single walk through the archive and the local
+        data (see create_ingest_job)
+    :param ingest_jobs: list of the ingest jobs
+    :param last_days: int the amount of days back the files should be fetched
+    """
+    # step 1. download the csv files of all jobs
     if download:
-        download_resources(target_url, data_directory, last_days=last_days, max_files_per_day=max_csv_file_index_per_day,
-                           file_filters=file_filters, sensor_ids_filter=sensor_ids_filter)
+        download_resources(target_url, data_directory, last_days=last_days, ingest_jobs=ingest_jobs)
     
-    # step 3. index the csv files into elastic search
+    # step 3. index the csv files into elastic search (each file is read once for all jobs)
     if index:
-        index_csv_files(index_name, data_directory, truncate_index=truncate_index, max_csv_file_index_per_day=max_csv_file_index_per_day, file_filters=file_filters, sensor_ids_filter=sensor_ids_filter)
+        index_jobs(ingest_jobs, data_directory)
 
 
-def main():
-    
+def get_ingest_jobs():
+    """
+        the ingest jobs of the script (shared by main and the workers of luftdaten_queue)
+    :return: list of the ingest jobs (see create_ingest_job)
+    """
     sensor_types = {
         'weather_conditions': [
             'dht22',  # values: temperature, humidity
@@ -634,37 +937,33 @@ def main():
         ],
     }
     
+    return [
+        # Sensor ids for the area of stuttgart south for the sensors with fine dust values:
+        create_ingest_job("luftdaten_stuttgart_weather",
+                          sensor_ids_filter=[219, 430, 549, 671, 673, 723, 751, 757, 1364, 2199, 2820, 8289],
+                          truncate_index=True),
+        # Sensor ids for the area of stuttgart south for the sensors with weather values:
+        create_ingest_job("luftdaten_stuttgart__fine_dust",
+                          sensor_ids_filter=[431, 550, 672, 674, 724, 752, 758, 1365, 2200, 2821, 8290, 11462, 12323],
+                          truncate_index=True),
+        # get the sensor data of a certain sensor type (of weather conditions) over the defined last days
+        create_ingest_job("luftdaten_weather", max_files_per_day=100,
+                          file_filters=[sensor_types.get('weather_conditions')[0]]),
+        # get the sensor data of a certain sensor type (of fine dust conditions) over the defined last days
+        create_ingest_job("luftdaten_fine_dust", max_files_per_day=100,
+                          file_filters=[sensor_types.get('fine_dust_conditions')[0]]),
+    ]
+
+
+def main():
+    
+    if METRICS_PORT is not None:
+        start_metrics_server(METRICS_PORT)
+    
     last_days = int(365.25 * 4)
 
-    truncate_index = True
-    max_index_count_per_day = 0
-    
-    # Sensor ids for the area of stuttgart south for the sensors with fine dust values:
-    sensor_ids_filter = [219, 430, 549, 671, 673, 723, 751, 757, 1364, 2199, 2820, 8289]
-    
-    download_and_index("luftdaten_stuttgart_weather", max_index_count_per_day, last_days,
-                       sensor_ids_filter=sensor_ids_filter,
-                       truncate_index=truncate_index)
-    # Sensor ids for the area of stuttgart south for the sensors with weather values:
-    sensor_ids_filter = [431, 550, 672, 674, 724, 752, 758, 1365, 2200, 2821, 8290, 11462, 12323]
-    
-    download_and_index("luftdaten_stuttgart__fine_dust", max_index_count_per_day, last_days,
-                       sensor_ids_filter=sensor_ids_filter,
-                       truncate_index=truncate_index
-                       )
-
-    truncate_index = False
-    # get the sensor data of a certain sensor type (of weather conditions) over the defined last days
-    max_index_count_per_day = 100
-    download_and_index("luftdaten_weather", max_index_count_per_day, last_days,
-                       file_filters=[sensor_types.get('weather_conditions')[0]],
-                       truncate_index=truncate_index)
-
-    # get the sensor data of a certain sensor type (of fine dust conditions) over the defined last days
-    download_and_index("luftdaten_fine_dust", max_index_count_per_day, last_days,
-                       file_filters=[sensor_types.get('fine_dust_conditions')[0]],
-                       truncate_index=truncate_index
-                       )
+    # the archive and the local data are walked through only once for all jobs
+    download_and_index_jobs(get_ingest_jobs(), last_days)
 
 
 if __name__ == "__main__":
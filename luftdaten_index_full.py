@@ -13,10 +13,11 @@ __version__ = "0.0.7"
 
 import glob
 import os
-from time import time
-import pandas as pd
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+
+from luftdaten_download import migrate_csv_directory
+from luftdaten_bulk import iter_file_chunks, stream_bulk
+from luftdaten_mapping import get_data_mapping, get_index_settings
 
 # define the initial values
 target_url = "http://archive.luftdaten.info/"
@@ -57,119 +58,36 @@ def prepare_index(index_name, truncate=False):
             "mappings": {}
         }
         
-        # added the mapping
-        mapping["mappings"][es_doc_type] = {
-            "properties": {
-                "geo_location": {
-                    "type": "geo_point",
-                }
-            }
-        }
+        # added the mapping (typed fields, see luftdaten_mapping)
+        mapping["mappings"][es_doc_type] = get_data_mapping()
         
         if ELASTICSEARCH_SINGLE_HOST:
             # if this is a once node cluster only create 1 shard and no replicas
-            mapping["settings"] = {"number_of_replicas": 0}
+            mapping["settings"] = get_index_settings({"number_of_replicas": 0})
+        else:
+            mapping["settings"] = get_index_settings()
         
         es.indices.create(index_name, body=mapping)
 
 
-def index_csv_data(index_name, records):
-    """
-        indexes a given csv file into ElasticSearch
-    :param index_name: str the index name
-    :param records: list the data to index
-    """
-    start_time = time()
-    
-    items_count = len(records)
-    
-    # index the records
-    try:
-        bulk(es, records)
-        duration = time() - start_time
-        speed = items_count / duration
-        message = "Indexing of bucket done. Wrote %s items into %s in %.3fs. Speed (%s items/s)." % (items_count, index_name, duration, round(speed, 2))
-        print("    " + message)
-    except Exception as e:
-        import_message = "Error in indexing. Used [index:'{}'] [doc_type:{}]. Details:\n  {}".format(index_name, es_doc_type, e)
-        print("  " + import_message)
-    
-    return items_count
-
-
-def collect_csv_data(index_name, csv_file, current_id, chunk_size=8 * 1024):
-    # open csv file
-    fp = open(csv_file)  # read csv
-    
-    # parse csv with pandas # todo add: parse_dates=True, index_col='DateTime',
-    csv_data = pd.read_csv(fp, iterator=True, chunksize=chunk_size, parse_dates=True)
-    
-    # start indexing
-    message = "Collecting csv data for bucket list. Reading file '{}'".format(csv_file)
-    print("      " + message)
-    
-    file_date = os.path.split(csv_file)[0].split(os.path.sep)[-1]
-    
-    list_records = []
-    for i, df in enumerate(csv_data):
-        df['timestamp'] = pd.to_datetime(df['timestamp'])
-        df.drop('Unnamed: 0', axis=1, inplace=True)
-        
-        # fetch the data frame records
-        records = df.where(pd.notnull(df), None).T.to_dict()
-        
-        # enrich index entry with meta data
-        for df_index in records:
-            record = records[df_index]
-            
-            # related import directory (date)
-            record['file_date'] = file_date
-            
-            # related import file
-            record['file_id'] = current_id
-            
-            # prepare the geo data (array representation with [lon,lat])
-            # see @url https://www.elastic.co/guide/en/elasticsearch/guide/current/lat-lon-formats.html
-            record['geo_location'] = [record['lon'], record['lat']]
-            
-            del record['lat']
-            del record['lon']
-            
-            record.update({
-                "_index": index_name,
-                "_type": es_doc_type,
-            })
-            
-            list_records.append(record)
-    
-    return list_records
-
-
 def main():
+    # convert the csv files downloaded by previous versions into the original format of the archive (only once)
+    migrate_csv_directory('data/luftdaten_full/')
+    
     csv_files = glob.glob('data/luftdaten_full/2018-05-07/*.csv')
     
     index_data_name = "luftdate_full_2018-05-07"
     
     prepare_index(index_data_name, truncate=True)
     
-    start_time = time()
-    
-    bucket = []
-    items_count = 0
+    files = []
     for csv_file in csv_files:
         file_id = int(csv_file.split('.')[-2].split('_')[-1])
-        bucket.extend(collect_csv_data(index_data_name, csv_file, file_id))
-        
-        if len(bucket) > 2000:
-            items_count += index_csv_data(index_data_name, bucket)
-            bucket = []
-        
-        duration = time() - start_time
-        speed = items_count / duration
-        message = "Overall speed: Wrote %s items into %s in %.3fs. Speed (%s items/s)." % (items_count, index_data_name, duration, round(speed, 2))
-        print("  " + message)
+        file_date = os.path.split(csv_file)[0].split(os.path.sep)[-1]
+        files.append((index_data_name, csv_file, file_date, file_id))
     
-    index_csv_data(index_data_name, bucket)
+    # the files are read chunk by chunk and streamed into bulk requests, which are limited by bytes and documents
+    stream_bulk(es, iter_file_chunks(files))
 
 
 if __name__ == "__main__":
@@ -13,9 +13,12 @@ __version__ = "0.0.7"
 
 import os
 
-import pandas as pd
 from elasticsearch import Elasticsearch
 
+from luftdaten_search import msearch
+from luftdaten_sensors import connect as connect_sensors, load_sensors
+from luftdaten_spatial import build_spatial_index, query_polygon
+
 # define the initial values
 target_url = "http://archive.luftdaten.info/"
 data_directory = 'data/luftdaten/'
@@ -41,19 +44,32 @@ es = Elasticsearch('http://%s:%s/' % (ELASTICSEARCH_HOST, ELASTICSEARCH_PORT), h
 es_index_name = 'luftdate_full_2018-05-07'
 es_doc_type = "sensor_data"
 
+# the amount of sensor ids fetched per request
+COMPOSITE_PAGE_SIZE = int(os.environ.get("COMPOSITE_PAGE_SIZE")) if 'COMPOSITE_PAGE_SIZE' in os.environ else 1000
+
 
-def get_unique_sensor_ids_around_geo_location(geo_shape, filter_by_sensor_types=None):
+def get_area_query(geo_shape, filter_by_sensor_types=None, page_size=COMPOSITE_PAGE_SIZE):
+    """
+        the search request of the distinct sensor ids of the sensor data within the polygon
+        (no documents are fetched, the sensor ids are paged through with a composite aggregation)
+    :param geo_shape: list the points of the polygon
+    :param filter_by_sensor_types: list optional sensor types
+    :param page_size: int the amount of sensor ids per request
+    :return: dict the body of the search request
+    """
     if filter_by_sensor_types is None:
         filter_by_sensor_types = []
     
-    size = 1000
     search_query = {
-        "size": size,
+        "size": 0,
         "query": {"bool": {}},
         "aggs": {
             "unique_sensor_ids": {
-                "terms": {
-                    "field": "sensor_id"
+                "composite": {
+                    "size": page_size,
+                    "sources": [
+                        {"sensor_id": {"terms": {"field": "sensor_id"}}}
+                    ]
                 }
             }
         }
@@ -77,53 +93,100 @@ def get_unique_sensor_ids_around_geo_location(geo_shape, filter_by_sensor_types=
             }
         }
     
-    # query the results and pass a param: scroll=1m
-    response = es.search(index=es_index_name, doc_type=es_doc_type, body=search_query, params={'scroll': '1m'})
+    return search_query
+
+
+def get_next_area_query(search_query, aggregation, page_size=COMPOSITE_PAGE_SIZE):
+    """
+        the search request of the next page of the sensor ids
+    :return: dict the body of the search request or None if all sensor ids have been fetched
+    """
+    buckets = aggregation.get('buckets')
     
-    # get the scroll id
-    scroll_id = response.get('_scroll_id')
-    total_results = response['hits']['total']
+    if len(buckets) < page_size:
+        return None
     
-    scroll_size = total_results
+    # continue after the last sensor id (after_key is only returned by Elastic Search >= 6.3)
+    search_query["aggs"]["unique_sensor_ids"]["composite"]["after"] = aggregation.get('after_key', buckets[-1].get('key'))
     
-    from pandasticsearch import Select
-    df = Select.from_dict(response).to_pandas()
+    return search_query
+
+
+def get_unique_sensor_ids_around_geo_location(geo_shape, filter_by_sensor_types=None, page_size=COMPOSITE_PAGE_SIZE):
+    """
+        fetches the distinct sensor ids of the sensor data within the polygon
+    :param geo_shape: list the points of the polygon
+    :param filter_by_sensor_types: list optional sensor types
+    :param page_size: int the amount of sensor ids per request
+    :return: list of the sorted sensor ids
+    """
+    search_query = get_area_query(geo_shape, filter_by_sensor_types, page_size)
     
-    results_fetched = size
+    unique_sensor_ids = []
     
-    while scroll_size > 0:
-        page = es.scroll(scroll_id=scroll_id, scroll='2m')
+    while search_query is not None:
+        response = es.search(index=es_index_name, doc_type=es_doc_type, body=search_query)
         
-        # Update the scroll ID
-        scroll_id = page.get('_scroll_id')
+        aggregation = response.get('aggregations').get('unique_sensor_ids')
+        buckets = aggregation.get('buckets')
         
-        # Get the number of results that we returned in the last scroll
-        scroll_size = len(page['hits']['hits'])
+        unique_sensor_ids.extend(int(bucket.get('key').get('sensor_id')) for bucket in buckets)
         
-        message = "Fetching {}/{} results ({}%)".format(results_fetched, total_results,
-                                                        round((results_fetched / total_results) * 100, 2))
+        message = "Fetched {} sensor ids".format(len(unique_sensor_ids))
         print(message)
         
-        # Do something with the obtained page
-        df_page_next = Select.from_dict(page).to_pandas()
+        search_query = get_next_area_query(search_query, aggregation, page_size)
+    
+    # the buckets are ordered by the sensor id
+    return unique_sensor_ids
+
+
+def get_unique_sensor_ids_of_areas(areas, page_size=COMPOSITE_PAGE_SIZE):
+    """
+        fetches the distinct sensor ids of many areas at once (the pages of all areas are sent as one multi search request)
+    :param areas: dict key => tuple (geo shape, sensor types)
+    :param page_size: int the amount of sensor ids per request
+    :return: dict key => list of the sorted sensor ids (failed areas are left out)
+    """
+    search_queries = {key: get_area_query(geo_shape, sensor_types, page_size) for key, (geo_shape, sensor_types) in areas.items()}
+    unique_sensor_ids = {key: [] for key in areas}
+    
+    while search_queries:
+        responses = msearch(es, search_queries, es_index_name, es_doc_type)
         
-        df = pd.concat([df, df_page_next], ignore_index=True)
+        next_search_queries = {}
         
-        results_fetched += scroll_size
+        for key, search_query in search_queries.items():
+            if key not in responses:
+                unique_sensor_ids.pop(key)
+                continue
+            
+            aggregation = responses.get(key).get('aggregations').get('unique_sensor_ids')
+            unique_sensor_ids[key].extend(int(bucket.get('key').get('sensor_id')) for bucket in aggregation.get('buckets'))
+            
+            search_query = get_next_area_query(search_query, aggregation, page_size)
+            if search_query is not None:
+                next_search_queries[key] = search_query
         
-        print("")
-    
-    # get the unique sensor_id
-    df_sensor_ids = df['sensor_id'].unique()
-    
-    # sort the ids
-    df_sensor_ids.sort()
-    
-    unique_sensor_ids = list(df_sensor_ids)
+        search_queries = next_search_queries
     
     return unique_sensor_ids
 
 
+def get_unique_sensor_ids_from_registry(geo_shape, filter_by_sensor_types=None, spatial_index=None):
+    """
+        looks up the sensor ids within the polygon in the sensor registry (instead of scrolling through the sensor data)
+    :param geo_shape: list the points of the polygon
+    :param filter_by_sensor_types: list optional sensor types
+    :param spatial_index: dict the spatial index of the registered sensors (built from the registry if not set)
+    :return: list of the sorted sensor ids
+    """
+    if spatial_index is None:
+        spatial_index = build_spatial_index(load_sensors(connect_sensors()))
+    
+    return query_polygon(spatial_index, geo_shape, sensor_types=filter_by_sensor_types)
+
+
 def main():
     geo_shapes = {
         "Stuttgart": {
@@ -168,35 +231,23 @@ def main():
         ],
     }
     
-    def get_sensor_ids_from_area(city, region, sensor_types, sensor_type_str):
-        geo_shape = geo_shapes.get(city).get(region)
-        
-        sensor_ids = get_unique_sensor_ids_around_geo_location(geo_shape, filter_by_sensor_types=sensor_types)
-        
-        message = 'Sensor ids for the area of {} {} for the sensors with {} values: {} ({} locations) '.format(city.casefold(), region, sensor_type_str, sensor_ids, len(sensor_ids))
-        return sensor_ids, message
+    # all areas are looked up at once: (city, region, sensor type str) => (geo shape, sensor types)
+    areas = {}
+    for region in ['south', 'west', 'east']:
+        areas[('Stuttgart', region, 'fine dust')] = (geo_shapes.get('Stuttgart').get(region), sensor_types.get('fine_dust_conditions'))
+        areas[('Stuttgart', region, 'weather')] = (geo_shapes.get('Stuttgart').get(region), sensor_types.get('weather_conditions'))
     
-    messages = []
-    sensor_ids, message = get_sensor_ids_from_area('stuttgart', 'south', sensor_types.get('fine_dust_conditions'), 'fine dust')
-    messages.append(message)
+    # the sensors are loaded once from the registry and looked up in the spatial index
+    spatial_index = build_spatial_index(load_sensors(connect_sensors()))
     
-    sensor_ids, message = get_sensor_ids_from_area('Stuttgart', 'south', sensor_types.get('weather_conditions'), 'weather')
-    messages.append(message)
+    if len(spatial_index.get('sensor_ids')) > 0:
+        sensor_ids_of_areas = {key: get_unique_sensor_ids_from_registry(geo_shape, filter_by_sensor_types=area_sensor_types, spatial_index=spatial_index)
+                               for key, (geo_shape, area_sensor_types) in areas.items()}
+    else:
+        sensor_ids_of_areas = get_unique_sensor_ids_of_areas(areas)
     
-    sensor_ids, message = get_sensor_ids_from_area('Stuttgart', 'west', sensor_types.get('fine_dust_conditions'), 'fine dust')
-    messages.append(message)
-    
-    sensor_ids, message = get_sensor_ids_from_area('Stuttgart', 'west', sensor_types.get('weather_conditions'), 'weather')
-    messages.append(message)
-    
-    sensor_ids, message = get_sensor_ids_from_area('Stuttgart', 'east', sensor_types.get('fine_dust_conditions'), 'fine dust')
-    messages.append(message)
-    
-    sensor_ids, message = get_sensor_ids_from_area('Stuttgart', 'east', sensor_types.get('weather_conditions'), 'weather')
-    
-    messages.append(message)
-    
-    for message in messages:
+    for (city, region, sensor_type_str), sensor_ids in sensor_ids_of_areas.items():
+        message = 'Sensor ids for the area of {} {} for the sensors with {} values: {} ({} locations) '.format(city.casefold(), region, sensor_type_str, sensor_ids, len(sensor_ids))
         print(message)
 
 
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+####
+# cached directory listings of the archive of luftdaten.info
+#
+# 1. the links are extracted while the index page is read (no DOM is built)
+# 2. all listings are kept in one store (SQLite) instead of one pickle file per day directory
+# 3. the listings of past days never change and are only fetched once, the listings of the root directory and of the
+#    recent days are revalidated with conditional requests (ETag / Last-Modified), a listing of a day fetched while
+#    the day was still recent is revalidated once more after the day became immutable
+###
+
+__author__ = 'Martin Andreas Woerz'
+__email__ = 'm.woerz@ieservices.de'
+__copyright__ = "Copyright 2018, Martin Woerz"
+__version__ = "0.0.7"
+
+import html
+import os
+import re
+import sqlite3
+import urllib.error
+import urllib.request
+from datetime import date, datetime, timedelta
+
+LISTING_DATABASE = os.environ.get("LISTING_DATABASE") if 'LISTING_DATABASE' in os.environ else 'data/luftdaten_listings.sqlite'
+
+# the listings of the day directories of the last days are revalidated, older ones are treated as immutable
+LISTING_RECENT_DAYS = int(os.environ.get("LISTING_RECENT_DAYS")) if 'LISTING_RECENT_DAYS' in os.environ else 2
+
+LISTING_CHUNK_SIZE = 64 * 1024
+
+# the links of the index pages: <a href="2018-05-09_bme280_sensor_113.csv">
+LINK_PATTERN = re.compile(rb'<a\s[^>]*?href\s*=\s*["\']([^"\']+)["\']', re.IGNORECASE)
+
+# the longest tag, which could be split over two chunks
+MAX_TAG_LENGTH = 4096
+
+DATE_DIRECTORY_PATTERN = re.compile(r'(\d{4}-\d{2}-\d{2})/?$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    fetched_at TEXT NOT NULL,
+    links TEXT NOT NULL
+)
+"""
+
+
+def connect(database=LISTING_DATABASE):
+    """
+        opens (and creates) the listing store
+    :param database: str the SQLite database file
+    :return: sqlite3.Connection
+    """
+    directory = os.path.dirname(database)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    
+    connection = sqlite3.connect(database)
+    connection.execute(SCHEMA)
+    connection.commit()
+    
+    return connection
+
+
+def extract_links(chunks):
+    """
+        extracts the links of an HTML document while it is read
+    :param chunks: iterable of bytes the HTML document
+    :return: list of urls
+    """
+    links = []
+    buffer = b''
+    
+    for chunk in chunks:
+        buffer += chunk
+        position = 0
+        
+        for match in LINK_PATTERN.finditer(buffer):
+            links.append(html.unescape(match.group(1).decode('utf-8', 'replace')))
+            position = match.end()
+        
+        # keep the rest of the buffer, which could contain the beginning of a tag
+        rest = buffer[position:]
+        tag_start = rest.rfind(b'<')
+        buffer = rest[tag_start:][-MAX_TAG_LENGTH:] if tag_start > -1 else b''
+    
+    return links
+
+
+def iter_response_chunks(response, chunk_size=LISTING_CHUNK_SIZE):
+    chunk = response.read(chunk_size)
+    while chunk:
+        yield chunk
+        chunk = response.read(chunk_size)
+
+
+def get_listing_date(url):
+    """
+        the day of a day directory
+    :param url: str the url of the directory
+    :return: date or None if the url is not a day directory
+    """
+    match = DATE_DIRECTORY_PATTERN.search(url)
+    
+    if match is None:
+        return None
+    
+    try:
+        return datetime.strptime(match.group(1), '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+
+def is_immutable_listing(url, today=None):
+    """
+        checks if the listing of the url will not change anymore (day directories older than LISTING_RECENT_DAYS)
+    :param url: str the url of the directory
+    :param today: date the current day
+    :return: bool
+    """
+    listing_date = get_listing_date(url)
+    
+    if listing_date is None:
+        return False
+    
+    if today is None:
+        today = date.today()
+    
+    return listing_date < today - timedelta(days=LISTING_RECENT_DAYS)
+
+
+def is_final_listing(cached, listing_date):
+    """
+        checks if a cached listing has been fetched after the listing of the day became immutable (a listing fetched
+        while the day was still recent can miss the files added later by the archive)
+    :param cached: dict the cached listing (see get_cached_listing)
+    :param listing_date: date the day of the listing
+    :return: bool
+    """
+    fetched_at = datetime.fromisoformat(cached.get('fetched_at')).date()
+    
+    return fetched_at > listing_date + timedelta(days=LISTING_RECENT_DAYS)
+
+
+def get_cached_listing(connection, url):
+    row = connection.execute('SELECT etag, last_modified, fetched_at, links FROM listings WHERE url = ?', (url,)).fetchone()
+    
+    if row is None:
+        return None
+    
+    etag, last_modified, fetched_at, links = row
+    return {'etag': etag, 'last_modified': last_modified, 'fetched_at': fetched_at, 'links': links.split('\n') if links else []}
+
+
+def save_listing(connection, url, links, etag=None, last_modified=None, fetched_at=None):
+    if fetched_at is None:
+        fetched_at = datetime.now()
+    
+    with connection:
+        connection.execute('INSERT OR REPLACE INTO listings (url, etag, last_modified, fetched_at, links) VALUES (?, ?, ?, ?, ?)',
+                           (url, etag, last_modified, fetched_at.isoformat(), '\n'.join(links)))
+
+
+def touch_listing(connection, url):
+    """
+        marks a cached listing as fetched now (after it has been revalidated without changes)
+    """
+    with connection:
+        connection.execute('UPDATE listings SET fetched_at = ? WHERE url = ?', (datetime.now().isoformat(), url))
+
+
+def import_pickle_listing(connection, url, pickle_path):
+    """
+        takes over the listing of a day, which has been cached by previous versions (urls.pickle)
+    :return: list of urls or None if no listing has been cached
+    """
+    if not os.path.exists(pickle_path):
+        return None
+    
+    import pandas as pd
+    
+    links = list(pd.read_pickle(pickle_path)['url'])
+    
+    # the listing has been fetched when the pickle file was written
+    save_listing(connection, url, links, fetched_at=datetime.fromtimestamp(os.path.getmtime(pickle_path)))
+    
+    return links
+
+
+def get_links(connection, url, pickle_path=None, today=None):
+    """
+        fetches all links of a directory listing of the archive
+    :param connection: sqlite3.Connection the listing store
+    :param url: str the url of the directory
+    :param pickle_path: str optional listing cached by previous versions
+    :param today: date the current day
+    :return: list of urls
+    """
+    cached = get_cached_listing(connection, url)
+    
+    if cached is None and pickle_path is not None and import_pickle_listing(connection, url, pickle_path) is not None:
+        cached = get_cached_listing(connection, url)
+    
+    # the listing of a past day is only taken as it is, if it has been fetched after the day became immutable,
+    # otherwise it is revalidated (once)
+    if cached is not None and is_immutable_listing(url, today) and is_final_listing(cached, get_listing_date(url)):
+        return cached.get('links')
+    
+    headers = {}
+    if cached is not None:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached.get('etag')
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached.get('last_modified')
+    
+    try:
+        response = urllib.request.urlopen(urllib.request.Request(url, headers=headers))
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and cached is not None:
+            # the listing has not been changed
+            touch_listing(connection, url)
+            return cached.get('links')
+        raise
+    
+    links = extract_links(iter_response_chunks(response))
+    
+    save_listing(connection, url, links, etag=response.getheader('ETag'), last_modified=response.getheader('Last-Modified'))
+    
+    return links
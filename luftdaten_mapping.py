@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+####
+# explicit mappings of the indices of the sensor data
+#
+# 1. the ids of the sensors and locations are integers (sorted numerically), the file id and the sensor type are
+#    keywords (no text + keyword pairs), the sensor type is lowercased (normalizer), it is matched as by the text
+#    mapping before (e.g. the filter sds011 matches the value SDS011 of the csv files)
+# 2. the measurements are stored as scaled floats (2 decimals as in the csv files of the archive), the durations of
+#    the ppd42ns (durP1, durP2 in microseconds, exceeding the range of half floats) as floats, its ratios as half floats
+# 3. the timestamps have a fixed format
+# 4. the fields of unknown columns are mapped as keywords without norms (strings) and floats (numbers)
+#
+# the mapping of an index contains the measurements of its sensor types (see SENSOR_TYPE_FIELDS)
+###
+
+__author__ = 'Martin Andreas Woerz'
+__email__ = 'm.woerz@ieservices.de'
+__copyright__ = "Copyright 2018, Martin Woerz"
+__version__ = "0.0.7"
+
+TIMESTAMP_FORMAT = "strict_date_hour_minute_second||strict_date_time_no_millis||strict_date_time"
+
+# the settings of the analysis of the indices (the normalizer of the sensor type)
+ANALYSIS_SETTINGS = {
+    "normalizer": {
+        "lowercase": {"type": "custom", "filter": ["lowercase"]}
+    }
+}
+
+COMMON_PROPERTIES = {
+    "sensor_id": {"type": "integer"},
+    "sensor_type": {"type": "keyword", "normalizer": "lowercase"},
+    "location": {"type": "integer"},
+    "geo_location": {"type": "geo_point"},
+    "timestamp": {"type": "date", "format": TIMESTAMP_FORMAT},
+    "file_date": {"type": "date", "format": "strict_date"},
+    "file_id": {"type": "keyword"},
+    # the row of the document in its csv file (with file_date and file_id the unique tiebreaker of the sort order)
+    "row": {"type": "integer"},
+}
+
+MEASUREMENT_PROPERTIES = {
+    "P1": {"type": "scaled_float", "scaling_factor": 100},
+    "P2": {"type": "scaled_float", "scaling_factor": 100},
+    "durP1": {"type": "float"},
+    "ratioP1": {"type": "half_float"},
+    "durP2": {"type": "float"},
+    "ratioP2": {"type": "half_float"},
+    "temperature": {"type": "scaled_float", "scaling_factor": 100},
+    "humidity": {"type": "scaled_float", "scaling_factor": 100},
+    "pressure": {"type": "scaled_float", "scaling_factor": 100},
+    "altitude": {"type": "scaled_float", "scaling_factor": 100},
+    "pressure_sealevel": {"type": "scaled_float", "scaling_factor": 100},
+}
+
+# the measurements of the sensor types of the archive
+SENSOR_TYPE_FIELDS = {
+    'sds011': ['P1', 'P2'],
+    'pms3003': ['P1', 'P2'],
+    'pms5003': ['P1', 'P2'],
+    'pms7003': ['P1', 'P2'],
+    'hpm': ['P1', 'P2'],
+    'ppd42ns': ['P1', 'P2', 'durP1', 'ratioP1', 'durP2', 'ratioP2'],
+    'dht22': ['temperature', 'humidity'],
+    'bme280': ['temperature', 'humidity', 'pressure', 'altitude', 'pressure_sealevel'],
+    'bmp180': ['temperature', 'pressure', 'altitude', 'pressure_sealevel'],
+    'bmp280': ['temperature', 'pressure', 'altitude', 'pressure_sealevel'],
+}
+
+DYNAMIC_TEMPLATES = [
+    {"strings": {"match_mapping_type": "string", "mapping": {"type": "keyword", "norms": False}}},
+    {"floats": {"match_mapping_type": "double", "mapping": {"type": "float"}}},
+]
+
+# the statistics of the rollups (see luftdaten_rollup)
+ROLLUP_STATISTICS_PROPERTIES = {
+    "count": {"type": "integer"},
+    "mean": {"type": "float"},
+    "min": {"type": "float"},
+    "max": {"type": "float"},
+    "p5": {"type": "float"},
+    "p50": {"type": "float"},
+    "p95": {"type": "float"},
+}
+
+
+def get_measurement_fields(sensor_types=None):
+    """
+        the measurements of the sensor types
+    :param sensor_types: list the sensor types (None=all sensor types)
+    :return: list of the fields
+    """
+    if not sensor_types:
+        return list(MEASUREMENT_PROPERTIES.keys())
+    
+    fields = []
+    for sensor_type in sensor_types:
+        for field in SENSOR_TYPE_FIELDS.get(sensor_type.lower(), MEASUREMENT_PROPERTIES.keys()):
+            if field not in fields:
+                fields.append(field)
+    
+    return fields
+
+
+def get_index_settings(settings=None):
+    """
+        the settings of an index of the sensor data or the rollups (the mappings refer to its normalizer)
+    :param settings: dict further settings of the index (e.g. number_of_replicas)
+    :return: dict
+    """
+    index_settings = dict(settings) if settings else {}
+    index_settings["analysis"] = ANALYSIS_SETTINGS
+    
+    return index_settings
+
+
+def get_data_mapping(sensor_types=None):
+    """
+        the mapping of the document type of the sensor data
+    :param sensor_types: list the sensor types of the index (None=all sensor types)
+    :return: dict
+    """
+    properties = dict(COMMON_PROPERTIES)
+    
+    for field in get_measurement_fields(sensor_types):
+        properties[field] = MEASUREMENT_PROPERTIES.get(field)
+    
+    return {
+        "dynamic_templates": DYNAMIC_TEMPLATES,
+        "properties": properties,
+    }
+
+
+def get_rollup_mapping(sensor_types=None):
+    """
+        the mapping of the document type of the rollups
+    :param sensor_types: list the sensor types of the index (None=all sensor types)
+    :return: dict
+    """
+    properties = {
+        "sensor_id": COMMON_PROPERTIES["sensor_id"],
+        "sensor_type": COMMON_PROPERTIES["sensor_type"],
+        "location": COMMON_PROPERTIES["location"],
+        "geo_location": {"type": "geo_point"},
+        "interval": {"type": "keyword"},
+        "timestamp": {"type": "date", "format": TIMESTAMP_FORMAT},
+    }
+    
+    for field in get_measurement_fields(sensor_types):
+        properties[field] = {"properties": ROLLUP_STATISTICS_PROPERTIES}
+    
+    return {
+        "dynamic_templates": DYNAMIC_TEMPLATES,
+        "properties": properties,
+    }
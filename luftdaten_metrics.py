@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+####
+# metrics of the stages of the ingest (listing, download, parse, bulk)
+#
+# 1. counters: files listed, files downloaded, bytes, rows parsed, documents sent, rejected and failed, ...
+# 2. histograms of the latencies: download of a file, bulk request (and in full mode the parsing of a file)
+# 3. the metrics are written as a json run report and as Prometheus text file (e.g. for the textfile collector of
+#    the node exporter), optionally they are served by a http endpoint: set env METRICS_PORT=9108
+#
+# the mode is set by env METRICS_MODE:
+#   low: (default) only counters and the histograms of the requests, low overhead for an always on usage
+#   full: also the time of each file spent in parsing and encoding
+#   off: no metrics
+#
+# the metrics of the processes of the parse stage are merged into the metrics of the main process
+###
+
+__author__ = 'Martin Andreas Woerz'
+__email__ = 'm.woerz@ieservices.de'
+__copyright__ = "Copyright 2018, Martin Woerz"
+__version__ = "0.0.7"
+
+import json
+import os
+import threading
+from bisect import bisect_left
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import time
+
+METRICS_MODE = os.environ.get("METRICS_MODE") if 'METRICS_MODE' in os.environ else 'low'
+
+METRICS_REPORT = os.environ.get("METRICS_REPORT") if 'METRICS_REPORT' in os.environ else 'data/luftdaten_metrics.json'
+METRICS_PROMETHEUS = os.environ.get("METRICS_PROMETHEUS") if 'METRICS_PROMETHEUS' in os.environ else 'data/luftdaten_metrics.prom'
+
+# the port of the http endpoint (disabled if not set)
+METRICS_PORT = int(os.environ.get("METRICS_PORT")) if 'METRICS_PORT' in os.environ else None
+
+# the minimum interval in seconds between two writes of the report (while the ingest is running)
+METRICS_INTERVAL = float(os.environ.get("METRICS_INTERVAL")) if 'METRICS_INTERVAL' in os.environ else 60
+
+METRICS_PREFIX = 'luftdaten_ingest'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+COUNTERS = {
+    'listing_days_total': 'day directories listed',
+    'files_listed_total': 'csv files found in the listings',
+    'files_downloaded_total': 'downloaded csv files',
+    'files_download_failed_total': 'csv files, which could not be downloaded',
+    'download_bytes_total': 'downloaded bytes',
+    'download_retries_total': 'retried download requests',
+    'files_parsed_total': 'parsed csv files',
+    'files_parse_failed_total': 'csv files, which could not be parsed',
+    'rows_parsed_total': 'parsed rows of the csv files',
+    'rollup_documents_total': 'encoded rollup documents',
+    'encoded_bytes_total': 'bytes of the encoded bulk requests',
+    'bulk_requests_total': 'sent bulk requests (including retries)',
+    'bulk_bytes_total': 'bytes of the sent bulk requests',
+    'documents_sent_total': 'documents sent in bulk requests (including retries)',
+    'documents_indexed_total': 'documents acknowledged by the cluster',
+    'documents_rejected_total': 'documents rejected by the cluster (429), which are retried',
+    'documents_failed_total': 'documents, which could not be indexed',
+}
+
+HISTOGRAMS = {
+    'download_seconds': ('duration of the download of a csv file', LATENCY_BUCKETS),
+    'bulk_request_seconds': ('duration of a bulk request', LATENCY_BUCKETS),
+    'parse_seconds': ('duration of the parsing and encoding of a csv file (full mode)', LATENCY_BUCKETS),
+}
+
+# the metrics of the process (see get_metrics)
+default_metrics = None
+
+
+def create_metrics(mode=METRICS_MODE):
+    """
+        creates a registry of the metrics
+    :param mode: str low, full or off
+    :return: dict the registry
+    """
+    return {
+        'mode': mode,
+        'started_at': time(),
+        'flushed_at': 0,
+        'counters': {name: 0 for name in COUNTERS},
+        'histograms': {name: {'buckets': buckets, 'counts': [0] * (len(buckets) + 1), 'sum': 0.0, 'count': 0} for name, (_, buckets) in HISTOGRAMS.items()},
+        'lock': threading.Lock(),
+    }
+
+
+def get_metrics():
+    global default_metrics
+    
+    if default_metrics is None:
+        default_metrics = create_metrics()
+    
+    return default_metrics
+
+
+def reset_metrics(mode=None):
+    """
+        replaces the metrics of the process by an empty registry
+    :param mode: str the mode (default: the mode of the current registry)
+    :return: dict the new registry
+    """
+    global default_metrics
+    
+    default_metrics = create_metrics(mode or get_metrics().get('mode'))
+    
+    return default_metrics
+
+
+def is_enabled(metrics=None):
+    return (metrics or get_metrics()).get('mode') != 'off'
+
+
+def is_detailed(metrics=None):
+    return (metrics or get_metrics()).get('mode') == 'full'
+
+
+def increment(name, value=1, metrics=None):
+    """
+        increments a counter
+    :param name: str the counter (see COUNTERS)
+    :param value: int the increment
+    """
+    if metrics is None:
+        metrics = get_metrics()
+    
+    if metrics.get('mode') == 'off':
+        return
+    
+    with metrics.get('lock'):
+        metrics['counters'][name] += value
+
+
+def observe(name, value, metrics=None):
+    """
+        adds a value to a histogram
+    :param name: str the histogram (see HISTOGRAMS)
+    :param value: float the value (e.g. seconds)
+    """
+    if metrics is None:
+        metrics = get_metrics()
+    
+    if metrics.get('mode') == 'off':
+        return
+    
+    histogram = metrics['histograms'][name]
+    position = bisect_left(histogram.get('buckets'), value)
+    
+    with metrics.get('lock'):
+        histogram['counts'][position] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+def snapshot_metrics(metrics=None):
+    """
+        the values of the metrics (without the lock, to be returned by the processes of the parse stage)
+    :return: dict
+    """
+    if metrics is None:
+        metrics = get_metrics()
+    
+    with metrics.get('lock'):
+        return {
+            'counters': dict(metrics.get('counters')),
+            'histograms': {name: {'counts': list(histogram.get('counts')), 'sum': histogram.get('sum'), 'count': histogram.get('count')}
+                           for name, histogram in metrics.get('histograms').items()},
+        }
+
+
+def merge_metrics(snapshot, metrics=None):
+    """
+        adds the values of a snapshot (of another process) to the metrics
+    :param snapshot: dict see snapshot_metrics
+    """
+    if metrics is None:
+        metrics = get_metrics()
+    
+    if not snapshot or metrics.get('mode') == 'off':
+        return
+    
+    with metrics.get('lock'):
+        for name, value in snapshot.get('counters').items():
+            metrics['counters'][name] += value
+        
+        for name, values in snapshot.get('histograms').items():
+            histogram = metrics['histograms'][name]
+            histogram['counts'] = [count + other for count, other in zip(histogram.get('counts'), values.get('counts'))]
+            histogram['sum'] += values.get('sum')
+            histogram['count'] += values.get('count')
+
+
+def get_quantile(histogram, quantile):
+    """
+        the upper bound of the bucket containing the quantile
+    :return: float or None if the histogram is empty (inf if the quantile is above the largest bucket)
+    """
+    if histogram.get('count') == 0:
+        return None
+    
+    rank = quantile * histogram.get('count')
+    cumulative = 0
+    
+    for bound, count in zip(list(histogram.get('buckets')) + [float('inf')], histogram.get('counts')):
+        cumulative += count
+        if cumulative >= rank:
+            return bound
+    
+    return float('inf')
+
+
+def get_report(metrics=None):
+    """
+        the run report: counters, histograms (with approximated percentiles) and the rates of the run
+    :return: dict
+    """
+    if metrics is None:
+        metrics = get_metrics()
+    
+    snapshot = snapshot_metrics(metrics)
+    seconds = time() - metrics.get('started_at')
+    counters = snapshot.get('counters')
+    
+    histograms = {}
+    for name, values in snapshot.get('histograms').items():
+        histogram = dict(values, buckets=metrics['histograms'][name].get('buckets'))
+        
+        histograms[name] = {
+            'count': histogram.get('count'),
+            'sum': round(histogram.get('sum'), 3),
+            'mean': round(histogram.get('sum') / histogram.get('count'), 4) if histogram.get('count') else None,
+            'p50': get_quantile(histogram, 0.5),
+            'p95': get_quantile(histogram, 0.95),
+            'p99': get_quantile(histogram, 0.99),
+        }
+    
+    return {
+        'mode': metrics.get('mode'),
+        'started_at': datetime.fromtimestamp(metrics.get('started_at')).isoformat(),
+        'updated_at': datetime.now().isoformat(),
+        'seconds': round(seconds, 3),
+        'counters': counters,
+        'histograms': histograms,
+        'rates': {
+            'files_downloaded_per_second': round(counters.get('files_downloaded_total') / seconds, 2) if seconds > 0 else 0,
+            'rows_parsed_per_second': round(counters.get('rows_parsed_total') / seconds, 2) if seconds > 0 else 0,
+            'documents_indexed_per_second': round(counters.get('documents_indexed_total') / seconds, 2) if seconds > 0 else 0,
+        },
+    }
+
+
+def format_prometheus(metrics=None):
+    """
+        the metrics in the Prometheus text format
+    :return: str
+    """
+    if metrics is None:
+        metrics = get_metrics()
+    
+    snapshot = snapshot_metrics(metrics)
+    lines = []
+    
+    for name, value in snapshot.get('counters').items():
+        metric_name = "{}_{}".format(METRICS_PREFIX, name)
+        lines.append("# HELP {} {}".format(metric_name, COUNTERS.get(name)))
+        lines.append("# TYPE {} counter".format(metric_name))
+        lines.append("{} {}".format(metric_name, value))
+    
+    for name, values in snapshot.get('histograms').items():
+        metric_name = "{}_{}".format(METRICS_PREFIX, name)
+        lines.append("# HELP {} {}".format(metric_name, HISTOGRAMS.get(name)[0]))
+        lines.append("# TYPE {} histogram".format(metric_name))
+        
+        # the buckets of the text format are cumulative
+        cumulative = 0
+        for bound, count in zip(list(HISTOGRAMS.get(name)[1]) + ['+Inf'], values.get('counts')):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(metric_name, bound, cumulative))
+        
+        lines.append("{}_sum {}".format(metric_name, values.get('sum')))
+        lines.append("{}_count {}".format(metric_name, values.get('count')))
+    
+    return '\n'.join(lines) + '\n'
+
+
+def write_file(filename, content):
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    
+    # the file is replaced at once (the readers never see a partially written file)
+    temp_filename = filename + '.part'
+    
+    with open(temp_filename, 'w') as fp:
+        fp.write(content)
+    os.replace(temp_filename, filename)
+
+
+def flush_metrics(force=False, report_file=METRICS_REPORT, prometheus_file=METRICS_PROMETHEUS, interval=METRICS_INTERVAL, metrics=None):
+    """
+        writes the run report and the Prometheus text file, at most once per interval (unless forced)
+    :param force: bool write the files, also if the interval has not passed yet (e.g. at the end of the run)
+    :param report_file: str the json run report (None=not written)
+    :param prometheus_file: str the Prometheus text file (None=not written)
+    :param interval: float the minimum interval in seconds between two writes
+    :return: bool the files have been written
+    """
+    if metrics is None:
+        metrics = get_metrics()
+    
+    if metrics.get('mode') == 'off' or not force and time() - metrics.get('flushed_at') < interval:
+        return False
+    
+    metrics['flushed_at'] = time()
+    
+    if report_file:
+        write_file(report_file, json.dumps(get_report(metrics), indent=1, sort_keys=True))
+    
+    if prometheus_file:
+        write_file(prometheus_file, format_prometheus(metrics))
+    
+    return True
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+        serves the metrics: /metrics (Prometheus text format) and /report (json run report)
+    """
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        
+        if path == '/metrics':
+            body, content_type = format_prometheus().encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8'
+        elif path == '/report':
+            body, content_type = json.dumps(get_report(), sort_keys=True).encode('utf-8'), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(port=METRICS_PORT, host=''):
+    """
+        serves the metrics of the process in a background thread
+    :param port: int the port
+    :param host: str the interface (default: all interfaces)
+    :return: ThreadingHTTPServer
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    
+    message = "Metrics are served on port {} (/metrics, /report)".format(server.server_port)
+    print(message)
+    
+    return server
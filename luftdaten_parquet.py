@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+####
+# converts the downloaded csv files into a local parquet dataset
+#
+# 1. the csv files of a day directory (data/luftdaten/YYYY-MM-DD/) are compacted into one parquet file per sensor type
+# 2. the dataset is partitioned by date and sensor type: data/luftdaten_parquet/date=YYYY-MM-DD/sensor_type=sds011/
+# 3. the columns are typed (ids as integers, measurements as float32, timestamps as datetime), the sensor type is
+#    only stored as partition key
+# 4. the conversion is incremental: a manifest keeps track of the converted day directories, only new or changed
+#    day directories are converted again
+#
+# the dataset can be read with column pruning and predicate pushdown, e.g.:
+#   read_measurements(columns=['sensor_id', 'timestamp', 'P1'], filters=[('sensor_type', '=', 'sds011'), ('date', '>=', '2018-01-01')])
+#
+# requires pyarrow
+###
+
+__author__ = 'Martin Andreas Woerz'
+__email__ = 'm.woerz@ieservices.de'
+__copyright__ = "Copyright 2018, Martin Woerz"
+__version__ = "0.0.7"
+
+import glob
+import json
+import os
+import shutil
+
+import pandas as pd
+
+from luftdaten_csv import read_csv_file
+from luftdaten_sensors import parse_csv_filename
+
+data_directory = 'data/luftdaten/'
+PARQUET_DIRECTORY = os.environ.get("PARQUET_DIRECTORY") if 'PARQUET_DIRECTORY' in os.environ else 'data/luftdaten_parquet/'
+
+MANIFEST_FILENAME = '_manifest.json'
+
+# the types of the columns of the csv files, all parquet files share the same columns (the dataset has one schema
+# over all sensor types), the values of columns not provided by a sensor type are empty
+ID_COLUMNS = ['sensor_id', 'location']
+COORDINATE_COLUMNS = ['lat', 'lon']
+MEASUREMENT_COLUMNS = ['P1', 'P2', 'durP1', 'ratioP1', 'durP2', 'ratioP2', 'temperature', 'humidity', 'pressure', 'altitude', 'pressure_sealevel']
+COLUMNS = ID_COLUMNS + COORDINATE_COLUMNS + ['timestamp'] + MEASUREMENT_COLUMNS
+
+
+def get_sensor_type(csv_file):
+    """
+        extracts the sensor type of the filename: YYYY-MM-DD_<sensor type>_sensor_<id>[_indoor].csv
+    :param csv_file: str the csv file
+    :return: str the sensor type (lower case) or None if the filename does not match (see luftdaten_sensors)
+    """
+    sensor = parse_csv_filename(csv_file)
+    
+    return sensor[1] if sensor is not None else None
+
+
+def get_day_signature(csv_files):
+    """
+        the signature of a day directory changes as soon as a csv file is added, removed or changed
+    :param csv_files: list the csv files of the day
+    :return: dict
+    """
+    stats = [os.stat(csv_file) for csv_file in csv_files]
+    return {
+        'files': len(stats),
+        'bytes': sum(stat.st_size for stat in stats),
+        'modified': max([stat.st_mtime for stat in stats] or [0]),
+    }
+
+
+def read_manifest(parquet_directory=PARQUET_DIRECTORY):
+    manifest_filename = os.path.join(parquet_directory, MANIFEST_FILENAME)
+    
+    if not os.path.exists(manifest_filename):
+        return {}
+    
+    with open(manifest_filename) as fp:
+        return json.load(fp)
+
+
+def write_manifest(manifest, parquet_directory=PARQUET_DIRECTORY):
+    manifest_filename = os.path.join(parquet_directory, MANIFEST_FILENAME)
+    temp_filename = manifest_filename + '.part'
+    
+    with open(temp_filename, 'w') as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    os.replace(temp_filename, manifest_filename)
+
+
+def convert_types(df):
+    """
+        converts the columns of the sensor data into their types
+    :param df: pd.DataFrame the sensor data
+    :return: pd.DataFrame with the columns COLUMNS
+    """
+    df = df.reindex(columns=COLUMNS)
+    
+    for column in ID_COLUMNS:
+        df[column] = pd.to_numeric(df[column], errors='coerce').astype('Int32')
+    
+    for column in COORDINATE_COLUMNS:
+        df[column] = pd.to_numeric(df[column], errors='coerce').astype('float64')
+    
+    for column in MEASUREMENT_COLUMNS:
+        df[column] = pd.to_numeric(df[column], errors='coerce').astype('float32')
+    
+    df['timestamp'] = pd.to_datetime(df['timestamp'], format='%Y-%m-%dT%H:%M:%S', errors='coerce')
+    
+    return df
+
+
+def convert_day_directory(date_directory, parquet_directory=PARQUET_DIRECTORY):
+    """
+        compacts the csv files of a day into one parquet file per sensor type
+    :param date_directory: str the day directory (data/luftdaten/YYYY-MM-DD)
+    :param parquet_directory: str the parquet dataset
+    :return: int the amount of converted rows
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    file_date = os.path.basename(os.path.normpath(date_directory))
+    
+    csv_files_by_sensor_type = {}
+    for csv_file in sorted(glob.glob(os.path.join(date_directory, '*.csv'))):
+        sensor_type = get_sensor_type(csv_file)
+        
+        # the files of the day, which are not sensor data of the archive, have no partition
+        if sensor_type is not None:
+            csv_files_by_sensor_type.setdefault(sensor_type, []).append(csv_file)
+    
+    # the partition of the day is written into a temporary directory and replaces the previous partition once complete
+    # (directories starting with '_' are ignored by the readers of the dataset)
+    partition_directory = os.path.join(parquet_directory, 'date={}'.format(file_date))
+    temp_directory = os.path.join(parquet_directory, '_date={}.part'.format(file_date))
+    
+    if os.path.exists(temp_directory):
+        shutil.rmtree(temp_directory)
+    
+    rows = 0
+    
+    for sensor_type, csv_files in sorted(csv_files_by_sensor_type.items()):
+        data_frames = [read_csv_file(csv_file) for csv_file in csv_files]
+        data_frames = [df for df in data_frames if len(df) > 0]
+        
+        if not data_frames:
+            continue
+        
+        df = convert_types(pd.concat(data_frames, ignore_index=True, sort=False))
+        
+        sensor_type_directory = os.path.join(temp_directory, 'sensor_type={}'.format(sensor_type))
+        os.makedirs(sensor_type_directory)
+        
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), os.path.join(sensor_type_directory, 'part-0.parquet'), compression='snappy')
+        rows += len(df)
+    
+    if os.path.exists(partition_directory):
+        shutil.rmtree(partition_directory)
+    
+    if os.path.exists(temp_directory):
+        os.rename(temp_directory, partition_directory)
+    
+    return rows
+
+
+def convert_data_directory(directory=data_directory, parquet_directory=PARQUET_DIRECTORY):
+    """
+        converts all new or changed day directories into the parquet dataset
+    :param directory: str the data directory containing the day directories (YYYY-MM-DD)
+    :param parquet_directory: str the parquet dataset
+    :return: int the amount of converted day directories
+    """
+    if not os.path.exists(parquet_directory):
+        os.makedirs(parquet_directory)
+    
+    manifest = read_manifest(parquet_directory)
+    
+    converted_count = 0
+    
+    for date_directory in sorted(glob.glob(os.path.join(directory, '*')), reverse=True):
+        file_date = os.path.basename(date_directory)
+        
+        # ignore files and directories not complying to the date structure
+        if not os.path.isdir(date_directory) or len(file_date.split('-')) != 3:
+            continue
+        
+        signature = get_day_signature(glob.glob(os.path.join(date_directory, '*.csv')))
+        
+        if manifest.get(file_date) == signature:
+            continue
+        
+        message = "Converting the csv files of day {} ({} files)".format(file_date, signature.get('files'))
+        print("  " + message)
+        
+        rows = convert_day_directory(date_directory, parquet_directory)
+        
+        manifest[file_date] = signature
+        write_manifest(manifest, parquet_directory)
+        converted_count += 1
+        
+        message = "{} rows of day {} have been converted".format(rows, file_date)
+        print("    " + message)
+    
+    message = "{} day directories have been converted into '{}'".format(converted_count, parquet_directory)
+    print(message)
+    
+    return converted_count
+
+
+def read_measurements(columns=None, filters=None, parquet_directory=PARQUET_DIRECTORY):
+    """
+        reads the sensor data of the parquet dataset (only the requested columns and partitions are read)
+    :param columns: list the columns (None=all)
+    :param filters: list of (column, operator, value) tuples, e.g. [('sensor_type', '=', 'sds011'), ('date', '>=', '2018-01-01')]
+    :param parquet_directory: str the parquet dataset
+    :return: pd.DataFrame
+    """
+    return pd.read_parquet(parquet_directory, engine='pyarrow', columns=columns, filters=filters)
+
+
+def main():
+    convert_data_directory()
+
+
+if __name__ == "__main__":
+    main()
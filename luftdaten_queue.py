@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+####
+# distributed ingest: the days of the archive are work items of a queue, which are claimed by workers on several machines
+#
+# 1. the coordinator fills the queue with the days of the archive (newest first)
+# 2. each worker claims a day with a lease, downloads and indexes its files (all ingest jobs of luftdaten_index) and
+#    marks the day as done, the lease is renewed while the day is processed
+# 3. the lease of a crashed worker expires and the day is claimed again by another worker (at most QUEUE_MAX_ATTEMPTS
+#    times), a day indexed twice overwrites its documents (deterministic ids)
+# 4. the progress of all workers (days, documents, throughput) is aggregated from the queue
+#
+# the reference implementation of the queue is a SQLite database, which has to be shared by the workers (e.g. on a
+# network file system): set env QUEUE_DATABASE=/mnt/shared/luftdaten_queue.sqlite
+#   python luftdaten_queue.py enqueue [--last-days 1461]
+#   python luftdaten_queue.py work
+#   python luftdaten_queue.py status
+#
+# the workers do not truncate, seal or switch the indices into the bulk load mode (the indices are shared by all
+# workers), the checkpoints of the files are kept by each worker in its local checkpoint store
+###
+
+__author__ = 'Martin Andreas Woerz'
+__email__ = 'm.woerz@ieservices.de'
+__copyright__ = "Copyright 2018, Martin Woerz"
+__version__ = "0.0.7"
+
+import argparse
+import os
+import socket
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from time import sleep, time
+
+QUEUE_DATABASE = os.environ.get("QUEUE_DATABASE") if 'QUEUE_DATABASE' in os.environ else 'data/luftdaten_queue.sqlite'
+QUEUE_NAME = os.environ.get("QUEUE_NAME") if 'QUEUE_NAME' in os.environ else 'ingest'
+
+# the duration of a lease in seconds, a lease is renewed after a third of its duration
+QUEUE_LEASE_SECONDS = float(os.environ.get("QUEUE_LEASE_SECONDS")) if 'QUEUE_LEASE_SECONDS' in os.environ else 900
+
+# the amount of claims of an item, before it is marked as failed
+QUEUE_MAX_ATTEMPTS = int(os.environ.get("QUEUE_MAX_ATTEMPTS")) if 'QUEUE_MAX_ATTEMPTS' in os.environ else 3
+
+# the interval in seconds a worker waits for the items leased by other workers (they could be reclaimed)
+QUEUE_POLL_SECONDS = float(os.environ.get("QUEUE_POLL_SECONDS")) if 'QUEUE_POLL_SECONDS' in os.environ else 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS work_items (
+    queue_name TEXT NOT NULL,
+    item TEXT NOT NULL,
+    status TEXT NOT NULL,
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    leased_at REAL,
+    lease_expires_at REAL,
+    finished_at REAL,
+    documents INTEGER NOT NULL DEFAULT 0,
+    seconds REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    PRIMARY KEY (queue_name, item)
+)
+"""
+
+
+def connect(database=QUEUE_DATABASE):
+    """
+        opens (and creates) the queue
+    :param database: str the SQLite database file (shared by the workers)
+    :return: sqlite3.Connection
+    """
+    directory = os.path.dirname(database)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    
+    # the transactions are started explicitly (the claims lock the database, see claim_item)
+    # the default journal is kept, the WAL mode does not work on network file systems
+    connection = sqlite3.connect(database, timeout=60, isolation_level=None)
+    connection.execute(SCHEMA)
+    
+    return connection
+
+
+def get_worker_name():
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+def enqueue_items(connection, items, queue_name=QUEUE_NAME, requeue_failed=False):
+    """
+        adds work items to the queue (the items, which are already queued, are kept as they are)
+    :param connection: sqlite3.Connection the queue
+    :param items: list of str the items (days YYYY-MM-DD)
+    :param queue_name: str the queue
+    :param requeue_failed: bool queue the failed items again
+    :return: int the amount of added items
+    """
+    connection.execute('BEGIN IMMEDIATE')
+    
+    try:
+        added_count = 0
+        
+        for item in items:
+            cursor = connection.execute("INSERT OR IGNORE INTO work_items (queue_name, item, status) VALUES (?, ?, 'pending')", (queue_name, item))
+            added_count += cursor.rowcount
+        
+        if requeue_failed:
+            connection.execute("UPDATE work_items SET status = 'pending', attempts = 0, error = NULL WHERE queue_name = ? AND status = 'failed'", (queue_name,))
+        
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+    
+    return added_count
+
+
+def claim_item(connection, worker, queue_name=QUEUE_NAME, lease_seconds=QUEUE_LEASE_SECONDS, max_attempts=QUEUE_MAX_ATTEMPTS):
+    """
+        claims the next pending item (or an item with an expired lease) with a lease
+    :param connection: sqlite3.Connection the queue
+    :param worker: str the name of the worker
+    :param queue_name: str the queue
+    :param lease_seconds: float the duration of the lease
+    :param max_attempts: int the amount of claims of an item, before it is marked as failed
+    :return: str the item or None if no item can be claimed
+    """
+    now = time()
+    
+    # the claim is serialized by the lock of the database
+    connection.execute('BEGIN IMMEDIATE')
+    
+    try:
+        # the items of workers, which have crashed too often on them
+        connection.execute("UPDATE work_items SET status = 'failed', error = 'lease expired after ' || attempts || ' attempts' "
+                           "WHERE queue_name = ? AND status = 'leased' AND lease_expires_at < ? AND attempts >= ?", (queue_name, now, max_attempts))
+        
+        row = connection.execute("SELECT item FROM work_items WHERE queue_name = ? AND (status = 'pending' OR (status = 'leased' AND lease_expires_at < ?)) "
+                                 "ORDER BY item DESC LIMIT 1", (queue_name, now)).fetchone()
+        
+        if row is not None:
+            connection.execute("UPDATE work_items SET status = 'leased', worker = ?, attempts = attempts + 1, leased_at = ?, lease_expires_at = ? "
+                               "WHERE queue_name = ? AND item = ?", (worker, now, now + lease_seconds, queue_name, row[0]))
+        
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+    
+    return row[0] if row is not None else None
+
+
+def renew_lease(connection, item, worker, queue_name=QUEUE_NAME, lease_seconds=QUEUE_LEASE_SECONDS):
+    """
+        extends the lease of a claimed item
+    :return: bool the lease is still held by the worker (False: the lease has expired and the item has been claimed again)
+    """
+    cursor = connection.execute("UPDATE work_items SET lease_expires_at = ? WHERE queue_name = ? AND item = ? AND worker = ? AND status = 'leased'",
+                                (time() + lease_seconds, queue_name, item, worker))
+    
+    return cursor.rowcount == 1
+
+
+def complete_item(connection, item, worker, documents=0, seconds=0, queue_name=QUEUE_NAME):
+    """
+        marks a claimed item as done
+    :param documents: int the amount of indexed documents
+    :param seconds: float the duration of the processing
+    :return: bool the item has been marked as done (False: the lease has been lost)
+    """
+    cursor = connection.execute("UPDATE work_items SET status = 'done', finished_at = ?, documents = ?, seconds = ?, error = NULL "
+                                "WHERE queue_name = ? AND item = ? AND worker = ? AND status = 'leased'", (time(), documents, seconds, queue_name, item, worker))
+    
+    return cursor.rowcount == 1
+
+
+def fail_item(connection, item, worker, error, queue_name=QUEUE_NAME, max_attempts=QUEUE_MAX_ATTEMPTS):
+    """
+        releases a claimed item after an error, the item is queued again until it has been claimed max_attempts times
+    :param error: str the error
+    """
+    connection.execute("UPDATE work_items SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, lease_expires_at = NULL, error = ? "
+                       "WHERE queue_name = ? AND item = ? AND worker = ? AND status = 'leased'", (max_attempts, str(error), queue_name, item, worker))
+
+
+def get_progress(connection, queue_name=QUEUE_NAME):
+    """
+        the aggregated progress of all workers
+    :return: dict
+    """
+    now = time()
+    
+    progress = {'queue_name': queue_name, 'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+    
+    for status, count in connection.execute('SELECT status, COUNT(*) FROM work_items WHERE queue_name = ? GROUP BY status', (queue_name,)):
+        progress[status] = count
+    
+    documents, started_at, finished_at = connection.execute("SELECT SUM(documents), MIN(leased_at), MAX(finished_at) FROM work_items WHERE queue_name = ? AND status = 'done'",
+                                                            (queue_name,)).fetchone()
+    
+    workers = connection.execute("SELECT worker, COUNT(*), SUM(documents) FROM work_items WHERE queue_name = ? AND status = 'done' GROUP BY worker ORDER BY worker",
+                                 (queue_name,)).fetchall()
+    
+    active_workers = connection.execute("SELECT DISTINCT worker FROM work_items WHERE queue_name = ? AND status = 'leased' AND lease_expires_at >= ?",
+                                        (queue_name, now)).fetchall()
+    
+    seconds = finished_at - started_at if started_at is not None and finished_at is not None else 0
+    remaining_count = progress['pending'] + progress['leased']
+    
+    progress['documents'] = documents or 0
+    progress['documents_per_second'] = round(progress['documents'] / seconds, 2) if seconds > 0 else 0
+    progress['remaining_seconds'] = round(seconds / progress['done'] * remaining_count) if progress['done'] > 0 else None
+    progress['active_workers'] = [worker for worker, in active_workers]
+    progress['workers'] = {worker: {'items': items_count, 'documents': documents_count or 0} for worker, items_count, documents_count in workers}
+    
+    return progress
+
+
+def hold_lease(database, item, worker, queue_name=QUEUE_NAME, lease_seconds=QUEUE_LEASE_SECONDS):
+    """
+        renews the lease of an item in a background thread until the returned event is set
+    :return: threading.Event
+    """
+    stop = threading.Event()
+    
+    def renew():
+        # sqlite connections can not be shared between threads
+        connection = connect(database)
+        
+        try:
+            while not stop.wait(lease_seconds / 3):
+                if not renew_lease(connection, item, worker, queue_name, lease_seconds):
+                    message = "The lease of '{}' has been lost, the item is processed by another worker".format(item)
+                    print("  " + message)
+                    break
+        finally:
+            connection.close()
+    
+    threading.Thread(target=renew, daemon=True).start()
+    
+    return stop
+
+
+def open_worker(ingest_jobs, parse_workers=None):
+    """
+        opens the resources of a worker, which are shared by all of its items (the checkpoint store, the sensor
+        registry, the process pool of the parse stage)
+    :param ingest_jobs: list of the ingest jobs (see luftdaten_index.create_ingest_job)
+    :param parse_workers: int the amount of processes of the parse stage (default: PARSE_WORKERS of luftdaten_bulk)
+    :return: dict the state of the worker
+    """
+    import luftdaten_index
+    
+    if parse_workers is None:
+        parse_workers = luftdaten_index.PARSE_WORKERS
+    
+    checkpoints = luftdaten_index.connect_checkpoints()
+    
+    # convert the csv files downloaded by previous versions into the original format of the archive (only once)
+    luftdaten_index.migrate_csv_directory(luftdaten_index.data_directory)
+    
+    return {
+        'ingest_jobs': ingest_jobs,
+        'checkpoints': checkpoints,
+        'sensors': luftdaten_index.connect_sensors(),
+        'indexed_files': luftdaten_index.load_indexed_files(ingest_jobs, checkpoints),
+        'prepared_indices': [],
+        'executor': ProcessPoolExecutor(max_workers=parse_workers) if parse_workers > 1 else None,
+        'parse_workers': parse_workers,
+        'documents': 0,
+        'started_at': time(),
+    }
+
+
+def close_worker(state):
+    """
+        releases the resources of a worker and records its throughput
+    :param state: dict the state of the worker (see open_worker)
+    """
+    import luftdaten_index
+    
+    if state.get('executor') is not None:
+        state.get('executor').shutdown()
+    
+    luftdaten_index.record_run(state.get('prepared_indices'), state.get('documents'), time() - state.get('started_at'), False)
+    luftdaten_index.flush_metrics(force=True)
+    
+    state.get('checkpoints').close()
+
+
+def process_item(state, item):
+    """
+        downloads and indexes the files of a day for all ingest jobs
+    :param state: dict the state of the worker (see open_worker)
+    :param item: str the day (YYYY-MM-DD)
+    :return: int the amount of indexed documents
+    """
+    import luftdaten_index
+    
+    ingest_jobs = state.get('ingest_jobs')
+    directory = luftdaten_index.data_directory
+    
+    luftdaten_index.download_resources(luftdaten_index.target_url, directory, ingest_jobs=ingest_jobs, dates=[item])
+    
+    # only the directory of the day is indexed (no walk through the local data), the settings of the indices are
+    # shared by all workers (no bulk load mode), the months are not complete in the checkpoint store of a single
+    # worker (no sealing)
+    documents_count = luftdaten_index.index_date_directory(ingest_jobs, directory, directory + item, state.get('checkpoints'), state.get('sensors'),
+                                                           state.get('indexed_files'), state.get('prepared_indices'), luftdaten_index.BULK_MAX_BYTES,
+                                                           luftdaten_index.BULK_MAX_DOCS, 8 * 1024, state.get('executor'), luftdaten_index.INDEX_WORKERS,
+                                                           luftdaten_index.INDEX_ROLLUPS, parse_workers=state.get('parse_workers'))
+    
+    state['documents'] += documents_count
+    luftdaten_index.flush_metrics()
+    
+    return documents_count
+
+
+def run_worker(ingest_jobs, database=QUEUE_DATABASE, queue_name=QUEUE_NAME, worker=None, lease_seconds=QUEUE_LEASE_SECONDS, poll_seconds=QUEUE_POLL_SECONDS,
+               max_attempts=QUEUE_MAX_ATTEMPTS):
+    """
+        claims and processes the items of the queue until all items are done or failed
+    :param ingest_jobs: list of the ingest jobs (their indices are not truncated by the workers)
+    :param database: str the SQLite database of the queue
+    :param queue_name: str the queue
+    :param worker: str the name of the worker (default: host:pid)
+    :param lease_seconds: float the duration of the leases
+    :param poll_seconds: float the interval the worker waits for the items leased by other workers
+    :param max_attempts: int the amount of claims of an item, before it is marked as failed
+    :return: int the amount of processed items
+    """
+    if worker is None:
+        worker = get_worker_name()
+    
+    ingest_jobs = [dict(ingest_job, truncate_index=False) for ingest_job in ingest_jobs]
+    
+    connection = connect(database)
+    processed_count = 0
+    
+    state = open_worker(ingest_jobs)
+    
+    try:
+        while True:
+            item = claim_item(connection, worker, queue_name, lease_seconds, max_attempts)
+            
+            if item is None:
+                # the items leased by other workers are claimed again, if their workers die
+                if get_progress(connection, queue_name).get('leased') == 0:
+                    break
+                
+                sleep(poll_seconds)
+                continue
+            
+            message = "Worker {} claimed item '{}'".format(worker, item)
+            print(message)
+            
+            stop = hold_lease(database, item, worker, queue_name, lease_seconds)
+            start_time = time()
+            
+            try:
+                documents_count = process_item(state, item)
+            except Exception as e:
+                message = "Error in processing the item '{}'. Details:\n  {}".format(item, e)
+                print("  " + message)
+                fail_item(connection, item, worker, e, queue_name, max_attempts)
+                continue
+            finally:
+                stop.set()
+            
+            if not complete_item(connection, item, worker, documents_count, time() - start_time, queue_name):
+                message = "Item '{}' has been processed, but its lease has been lost".format(item)
+                print("  " + message)
+            
+            processed_count += 1
+    finally:
+        close_worker(state)
+    
+    message = "Worker {} is done. Processed {} items".format(worker, processed_count)
+    print(message)
+    
+    return processed_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Distributed ingest of the luftdaten.info archive')
+    parser.add_argument('--database', default=QUEUE_DATABASE)
+    parser.add_argument('--queue', default=QUEUE_NAME)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    
+    parser_enqueue = subparsers.add_parser('enqueue', help='queue the days of the archive')
+    parser_enqueue.add_argument('--last-days', type=int, default=int(365.25 * 4))
+    parser_enqueue.add_argument('--requeue-failed', action='store_true')
+    
+    parser_work = subparsers.add_parser('work', help='process the items of the queue')
+    parser_work.add_argument('--worker', default=None)
+    parser_work.add_argument('--lease-seconds', type=float, default=QUEUE_LEASE_SECONDS)
+    
+    subparsers.add_parser('status', help='the aggregated progress of the workers')
+    
+    args = parser.parse_args()
+    
+    connection = connect(args.database)
+    
+    if args.command == 'enqueue':
+        from luftdaten_index import fetch_date_directories
+        from luftdaten_listing import connect as connect_listings
+        
+        dates = [date_directory.rstrip('/') for date_directory in fetch_date_directories(args.last_days, connect_listings())]
+        added_count = enqueue_items(connection, dates, args.queue, args.requeue_failed)
+        
+        message = "{} of {} days have been queued".format(added_count, len(dates))
+        print(message)
+    elif args.command == 'work':
+        from luftdaten_index import get_ingest_jobs
+        
+        run_worker(get_ingest_jobs(), args.database, args.queue, args.worker, args.lease_seconds)
+    else:
+        progress = get_progress(connection, args.queue)
+        
+        message = "{queue_name}: {done} done, {leased} leased, {pending} pending, {failed} failed | {documents} documents ({documents_per_second} docs/s)".format(**progress)
+        print(message)
+        
+        if progress.get('remaining_seconds') is not None:
+            message = "Remaining: {}s".format(progress.get('remaining_seconds'))
+            print("  " + message)
+        
+        for worker, stats in progress.get('workers').items():
+            message = "{}: {} items, {} documents{}".format(worker, stats.get('items'), stats.get('documents'), " (active)" if worker in progress.get('active_workers') else "")
+            print("  " + message)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+####
+# rollups of the sensor data computed while the csv files are indexed
+#
+# 1. the values of the csv files (one sensor, one day) are aggregated per sensor and per hour and day: count, mean,
+#    min, max and percentiles of P1 (PM10), P2 (PM2.5), temperature and humidity
+# 2. the rollups of all files of a day are computed at once (one aggregation instead of one per file) and encoded
+#    column by column (see luftdaten_encoder)
+# 3. the rollups are indexed with the sensor data into the companion index <index>_rollup_YYYY-MM, the files of a
+#    day are only reported as done once their rollups have been indexed as well
+# 4. the rollups have deterministic ids (sensor, interval, start), indexing a file again overwrites its rollups
+#
+# the rollups are disabled by default (set env: INDEX_ROLLUPS=1 to compute the rollups while indexing)
+#
+# a query over a long time range reads the hourly or daily rollups instead of all measurements, e.g.:
+#   {"query": {"bool": {"filter": [{"term": {"interval": "day"}}, {"term": {"sensor_id": 2576}}]}}}
+# the statistics are sent as dotted fields ("P1.mean"), which are mapped as objects (see luftdaten_mapping)
+###
+
+__author__ = 'Martin Andreas Woerz'
+__email__ = 'm.woerz@ieservices.de'
+__copyright__ = "Copyright 2018, Martin Woerz"
+__version__ = "0.0.7"
+
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from luftdaten_encoder import encode_documents
+
+es_doc_type = "sensor_data"
+
+# compute the rollups while indexing (set env: INDEX_ROLLUPS=1 to enable the rollups)
+INDEX_ROLLUPS = os.environ.get("INDEX_ROLLUPS") == "1" if 'INDEX_ROLLUPS' in os.environ else False
+
+ROLLUP_VALUES = ['P1', 'P2', 'temperature', 'humidity']
+ROLLUP_STATISTICS = ['count', 'mean', 'min', 'max']
+ROLLUP_PERCENTILES = [0.05, 0.5, 0.95]
+ROLLUP_INTERVALS = {'hour': 'h', 'day': 'D'}
+
+# the columns of the sensor data, which are kept for the rollups of a file
+ROLLUP_COLUMNS = ['sensor_id', 'sensor_type', 'location', 'lat', 'lon', 'timestamp'] + ROLLUP_VALUES
+
+# the columns taken over from the first row of a sensor and interval
+ROLLUP_SENSOR_COLUMNS = ['sensor_type', 'location', 'lat', 'lon']
+
+MONTHLY_INDEX_PATTERN = re.compile(r'_(\d{4}-\d{2})$')
+
+
+def get_rollup_index_name(index_name):
+    """
+        the companion index of the rollups: <index>_YYYY-MM => <index>_rollup_YYYY-MM
+    :param index_name: str the index of the sensor data
+    :return: str
+    """
+    match = MONTHLY_INDEX_PATTERN.search(index_name)
+    
+    if match is None:
+        return "{}_rollup".format(index_name)
+    
+    return "{}_rollup_{}".format(index_name[:match.start()], match.group(1))
+
+
+def select_rollup_columns(df):
+    """
+        the columns of a chunk of the sensor data, which are kept for the rollups
+    :param df: pd.DataFrame the sensor data
+    :return: pd.DataFrame
+    """
+    return df[[column for column in ROLLUP_COLUMNS if column in df.columns]]
+
+
+def compute_rollups(df, interval='hour', keys=None):
+    """
+        aggregates the values of the sensor data per sensor and interval
+    :param df: pd.DataFrame the sensor data (e.g. all files of a day)
+    :param interval: str hour or day
+    :param keys: list optional further columns the rollups are grouped by (e.g. the file of the rows)
+    :return: pd.DataFrame a row per sensor and interval with the columns <value>.count, <value>.mean, <value>.min,
+             <value>.max and <value>.p<percentile> (the statistics of the values without measurements are empty)
+    """
+    keys = list(keys) if keys else []
+    value_columns = [column for column in ROLLUP_VALUES if column in df.columns]
+    
+    if len(df) == 0 or not value_columns:
+        return pd.DataFrame()
+    
+    start = pd.to_datetime(df['timestamp'], format='%Y-%m-%dT%H:%M:%S', errors='coerce').dt.floor(ROLLUP_INTERVALS.get(interval))
+    data = df.assign(start=start).dropna(subset=['start'])
+    
+    grouped = data.groupby(keys + ['sensor_id', 'start'], sort=True)
+    
+    aggregations = {column: (column, 'first') for column in ROLLUP_SENSOR_COLUMNS if column in data.columns}
+    for column in value_columns:
+        for stat in ROLLUP_STATISTICS:
+            aggregations["{}.{}".format(column, stat)] = (column, stat)
+    
+    rollups = grouped.agg(**aggregations)
+    
+    # a row per group and percentile => a column per value and percentile
+    percentiles = grouped[value_columns].quantile(ROLLUP_PERCENTILES).unstack()
+    percentiles.columns = ["{}.p{}".format(column, int(round(percentile * 100))) for column, percentile in percentiles.columns]
+    
+    rollups = pd.concat([rollups, percentiles], axis=1).reset_index()
+    
+    # the values without measurements are left out (the counts are empty instead of 0)
+    for column in value_columns:
+        counts = rollups["{}.count".format(column)]
+        rollups["{}.count".format(column)] = counts.where(counts > 0).astype('Int32')
+    
+    if 'location' in rollups.columns and not pd.api.types.is_integer_dtype(rollups['location']):
+        rollups['location'] = rollups['location'].astype('Int32')
+    
+    return rollups
+
+
+def encode_rollup_lines(rollups, index_name, interval, doc_type=es_doc_type):
+    """
+        encodes the rollups into the lines of a bulk request (NDJSON)
+    :param rollups: pd.DataFrame the rollups (see compute_rollups)
+    :param index_name: str the rollup index
+    :param interval: str hour or day
+    :param doc_type: str the document type
+    :return: np.array of str the action and the document of each rollup
+    """
+    starts = np.datetime_as_string(rollups['start'].values, unit='s').astype(object)
+    
+    # the keys of the groups (e.g. the file) are not part of the documents
+    columns = ['sensor_id'] + [column for column in ROLLUP_SENSOR_COLUMNS if column in rollups.columns] + [column for column in rollups.columns if '.' in column]
+    
+    documents = encode_documents(rollups[columns].assign(timestamp=rollups['start'].values), {'interval': interval})
+    
+    document_ids = rollups['sensor_id'].astype(str).values.astype(object) + "_{}_".format(interval) + starts
+    
+    action = json.dumps({"index": {"_index": index_name, "_type": doc_type}}, separators=(',', ':'))
+    
+    # {"index":{"_index":"...","_type":"...","_id":"..."}}
+    actions = action[:-2] + ',"_id":"' + document_ids + '"}}'
+    
+    return actions + '\n' + documents + '\n'
+
+
+def encode_rollups(df, index_name, key=None):
+    """
+        computes and encodes the hourly and daily rollups of the sensor data
+    :param df: pd.DataFrame the sensor data (all rows of the files)
+    :param index_name: str the rollup index
+    :param key: str optional column of the files of the rows, the rollups are encoded per file
+    :return: dict value of the key => tuple (bytes the body of the bulk request, int the amount of documents), the
+             rollups of all rows are returned with the key None
+    """
+    file_lines = {}
+    
+    for interval in ROLLUP_INTERVALS:
+        rollups = compute_rollups(df, interval, [key] if key else None)
+        
+        if len(rollups) == 0:
+            continue
+        
+        lines = encode_rollup_lines(rollups, index_name, interval)
+        
+        if not key:
+            file_lines.setdefault(None, []).append(lines)
+            continue
+        
+        # the rollups are sorted by the key, the lines of each file are consecutive
+        file_keys, starts = np.unique(rollups[key].values, return_index=True)
+        ends = list(starts[1:]) + [len(rollups)]
+        
+        for file_key, start, end in zip(file_keys.tolist(), starts, ends):
+            file_lines.setdefault(file_key, []).append(lines[start:end])
+    
+    return {file_key: (''.join(np.concatenate(lines_list).tolist()).encode('utf-8'), sum(len(lines) for lines in lines_list))
+            for file_key, lines_list in file_lines.items()}
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+####
+# seals the monthly indices (<index>_YYYY-MM), once all files of their month have been indexed
+#
+# 1. the index is set read-only (write block) and force merged into one segment
+# 2. optionally the index is shrunk into one shard (set env: SEAL_SHRINK=1), the shrunk index <index>_YYYY-MM_shrunk
+#    replaces the index and is reachable by its name (alias)
+# 3. the sealed indices are recorded in a local state file, the ingest runs skip their months without any lookups of
+#    Elastic Search (no listings, no downloads, no globbing of the day directories)
+#
+# the completeness of the months is checked by the ingest (see luftdaten_index.seal_completed_months), the sealed
+# indices are listed by:
+#   python luftdaten_seal.py list
+###
+
+__author__ = 'Martin Andreas Woerz'
+__email__ = 'm.woerz@ieservices.de'
+__copyright__ = "Copyright 2018, Martin Woerz"
+__version__ = "0.0.7"
+
+import argparse
+import json
+import os
+import re
+from datetime import datetime
+
+# seal the completed monthly indices after an ingest run (set env: SEAL_INDICES=0 to disable)
+SEAL_INDICES = not os.environ.get("SEAL_INDICES") == "0" if 'SEAL_INDICES' in os.environ else True
+
+# shrink the sealed indices into one shard (set env: SEAL_SHRINK=1)
+SEAL_SHRINK = os.environ.get("SEAL_SHRINK") == "1" if 'SEAL_SHRINK' in os.environ else False
+
+SEAL_STATE = os.environ.get("SEAL_STATE") if 'SEAL_STATE' in os.environ else 'data/luftdaten_sealed.json'
+
+SEAL_MAX_NUM_SEGMENTS = int(os.environ.get("SEAL_MAX_NUM_SEGMENTS")) if 'SEAL_MAX_NUM_SEGMENTS' in os.environ else 1
+
+SHRUNK_INDEX_SUFFIX = '_shrunk'
+
+
+def read_state(state_file=SEAL_STATE):
+    """
+        the sealed indices
+    :return: dict index name => dict the record of the seal
+    """
+    if not os.path.exists(state_file):
+        return {}
+    
+    with open(state_file) as fp:
+        return json.load(fp)
+
+
+def write_state(state, state_file=SEAL_STATE):
+    directory = os.path.dirname(state_file)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    
+    temp_filename = state_file + '.part'
+    
+    with open(temp_filename, 'w') as fp:
+        json.dump(state, fp, indent=1, sort_keys=True)
+    os.replace(temp_filename, state_file)
+
+
+def shrink_index(es, index_name):
+    """
+        shrinks an index (with a write block) into one shard, the shrunk index replaces the index (alias)
+    :param es: Elasticsearch the client
+    :param index_name: str the index name
+    :return: str the shrunk index or None if the index has only one shard
+    """
+    settings = es.indices.get_settings(index=index_name, name='index.number_of_shards', flat_settings=True)
+    
+    if int(settings.get(index_name, {}).get('settings', {}).get('index.number_of_shards', 1)) <= 1:
+        return None
+    
+    # a copy of each shard has to be located on the same node
+    shards = es.cat.shards(index=index_name, format='json')
+    node = [shard.get('node') for shard in shards if shard.get('prirep') == 'p' and shard.get('node')][0]
+    
+    es.indices.put_settings(index=index_name, body={"index.routing.allocation.require._name": node})
+    es.cluster.health(index=index_name, wait_for_no_relocating_shards=True, timeout='30m', request_timeout=1800)
+    
+    shrunk_index_name = index_name + SHRUNK_INDEX_SUFFIX
+    
+    es.indices.shrink(index=index_name, target=shrunk_index_name, body={
+        "settings": {
+            "index.number_of_shards": 1,
+            "index.routing.allocation.require._name": None,
+            "index.blocks.write": True,
+        }
+    })
+    es.cluster.health(index=shrunk_index_name, wait_for_status='yellow', timeout='30m', request_timeout=1800)
+    
+    # the index is replaced by the shrunk index at once
+    es.indices.update_aliases(body={"actions": [
+        {"remove_index": {"index": index_name}},
+        {"add": {"index": shrunk_index_name, "alias": index_name}},
+    ]})
+    
+    return shrunk_index_name
+
+
+def seal_index(es, index_name, max_num_segments=SEAL_MAX_NUM_SEGMENTS, shrink=SEAL_SHRINK, state_file=SEAL_STATE):
+    """
+        sets an index read-only, optionally shrinks it and force merges it, the index is recorded as sealed
+    :param es: Elasticsearch the client
+    :param index_name: str the index name
+    :param max_num_segments: int the amount of segments of the force merge
+    :param shrink: bool shrink the index into one shard
+    :param state_file: str the local state file
+    :return: dict the record of the seal
+    """
+    es.indices.refresh(index=index_name)
+    es.indices.put_settings(index=index_name, body={"index.blocks.write": True})
+    
+    shrunk_index_name = shrink_index(es, index_name) if shrink else None
+    
+    es.indices.forcemerge(index=shrunk_index_name or index_name, max_num_segments=max_num_segments, request_timeout=3600)
+    
+    record = {'sealed_at': datetime.now().isoformat(), 'max_num_segments': max_num_segments}
+    if shrunk_index_name is not None:
+        record['shrunk_index'] = shrunk_index_name
+    
+    state = read_state(state_file)
+    state[index_name] = record
+    write_state(state, state_file)
+    
+    message = "Index '{}' has been sealed (read-only, {} segment(s){})".format(index_name, max_num_segments, ", shrunk" if shrunk_index_name else "")
+    print("    " + message)
+    
+    return record
+
+
+def unseal_indices(es, index_name, state_file=SEAL_STATE):
+    """
+        forgets the sealed monthly indices of an index (before they are truncated), the shrunk indices are deleted
+        (their aliases can not be deleted by the name of the month), the write block of the other indices is removed
+        (a month, which is not created again by the run, accepts the documents of the following runs)
+    :param es: Elasticsearch the client
+    :param index_name: str the index name (without the month)
+    :param state_file: str the local state file
+    :return: list of the unsealed indices
+    """
+    state = read_state(state_file)
+    
+    # <index>_YYYY-MM and <index>_rollup_YYYY-MM
+    pattern = re.compile(r'^{}_(rollup_)?\d{{4}}-\d{{2}}$'.format(re.escape(index_name)))
+    unsealed = sorted(sealed_index_name for sealed_index_name in state if pattern.match(sealed_index_name))
+    
+    for sealed_index_name in unsealed:
+        record = state.get(sealed_index_name)
+        
+        if record.get('shrunk_index'):
+            es.indices.delete(index=record.get('shrunk_index'), ignore=404)
+        else:
+            es.indices.put_settings(index=sealed_index_name, body={"index.blocks.write": None}, ignore=404)
+        
+        # the seal is only forgotten once the index accepts documents again
+        del state[sealed_index_name]
+        write_state(state, state_file)
+    
+    return unsealed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sealed monthly indices of the luftdaten.info data')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    
+    subparsers.add_parser('list', help='the sealed indices')
+    
+    parser_seal = subparsers.add_parser('seal', help='seal an index manually')
+    parser_seal.add_argument('index_name')
+    parser_seal.add_argument('--shrink', action='store_true')
+    parser_seal.add_argument('--max-num-segments', type=int, default=SEAL_MAX_NUM_SEGMENTS)
+    
+    args = parser.parse_args()
+    
+    if args.command == 'seal':
+        from luftdaten_index import es
+        
+        seal_index(es, args.index_name, max_num_segments=args.max_num_segments, shrink=args.shrink)
+    else:
+        for index_name, record in sorted(read_state().items()):
+            print("{} {}".format(index_name, json.dumps(record, sort_keys=True)))
+
+
+if __name__ == "__main__":
+    main()
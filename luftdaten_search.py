@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+####
+# batch execution of search requests
+#
+# many search requests (e.g. one per area or location) are sent as one multi search request (_msearch) instead of one
+# request after another, the responses are returned by the keys of the requests
+###
+
+__author__ = 'Martin Andreas Woerz'
+__email__ = 'm.woerz@ieservices.de'
+__copyright__ = "Copyright 2018, Martin Woerz"
+__version__ = "0.0.7"
+
+import os
+
+# the maximum amount of searches of one multi search request
+MSEARCH_MAX_SEARCHES = int(os.environ.get("MSEARCH_MAX_SEARCHES")) if 'MSEARCH_MAX_SEARCHES' in os.environ else 100
+
+
+def msearch(es, search_queries, index, doc_type=None, max_searches=MSEARCH_MAX_SEARCHES):
+    """
+        sends the search requests as multi search requests
+    :param es: Elasticsearch the client
+    :param search_queries: dict key => the body of the search request
+    :param index: str the index
+    :param doc_type: str the document type
+    :param max_searches: int the maximum amount of searches of one multi search request
+    :return: dict key => the response of the search request (failed searches are left out)
+    """
+    responses = {}
+    keys = list(search_queries.keys())
+    
+    for start in range(0, len(keys), max_searches):
+        batch_keys = keys[start:start + max_searches]
+        
+        body = []
+        for key in batch_keys:
+            header = {"index": index}
+            if doc_type:
+                header["type"] = doc_type
+            body.append(header)
+            body.append(search_queries.get(key))
+        
+        response = es.msearch(body=body)
+        
+        for key, search_response in zip(batch_keys, response.get('responses')):
+            if 'error' in search_response:
+                message = "Error in searching {}. Details:\n  {}".format(key, search_response.get('error'))
+                print("  " + message)
+                continue
+            
+            responses[key] = search_response
+    
+    return responses
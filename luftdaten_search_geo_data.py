@@ -23,7 +23,12 @@ __version__ = "0.0.7"
 import os
 from datetime import datetime
 
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, TransportError
+
+from luftdaten_cache import cached_search
+from luftdaten_search import msearch
+from luftdaten_sensors import connect as connect_sensors, load_sensors
+from luftdaten_spatial import build_spatial_index, query_radius
 
 target_url = "http://archive.luftdaten.info/"
 data_directory = 'data/luftdaten'
@@ -45,8 +50,144 @@ es_doc_type = "sensor_data"
 
 index_name = "luftdaten"
 
+# the amount of documents per page and how long the point in time is kept open between two pages
+SEARCH_PAGE_SIZE = int(os.environ.get("SEARCH_PAGE_SIZE")) if 'SEARCH_PAGE_SIZE' in os.environ else 1000
+SEARCH_KEEP_ALIVE = os.environ.get("SEARCH_KEEP_ALIVE") if 'SEARCH_KEEP_ALIVE' in os.environ else "1m"
+
+# a document is unique by its file and its row in the file (see luftdaten_encoder), the fields are sorted by their doc
+# values (the _id is not, sorting by it is deprecated), indices without the fields are sorted as if they were missing
+SORT_TIEBREAKER = [
+    {"file_date": {"order": "asc", "unmapped_type": "date"}},
+    {"file_id": {"order": "asc", "unmapped_type": "keyword"}},
+    {"row": {"order": "asc", "unmapped_type": "integer"}},
+]
+
+# the amount of hits of a search without a size (as Elastic Search)
+SEARCH_DEFAULT_SIZE = 10
+
+
+def open_point_in_time(index, keep_alive=SEARCH_KEEP_ALIVE):
+    """
+        opens a point in time of the index (Elastic Search >= 7.10)
+    :return: str the id of the point in time or None if it is not supported by the cluster
+    """
+    try:
+        response = es.transport.perform_request('POST', '/{}/_pit'.format(index), params={'keep_alive': keep_alive})
+    except TransportError:
+        return None
+    
+    return response.get('id')
+
+
+def close_point_in_time(pit_id):
+    try:
+        es.transport.perform_request('DELETE', '/_pit', body={'id': pit_id})
+    except TransportError:
+        pass
+
+
+def get_sort(sort=None):
+    """
+        the sort order with the tiebreaker, which makes the sort order unique (needed by search_after)
+    :param sort: list or dict the sort order (default: timestamp descending)
+    :return: list
+    """
+    if sort is None:
+        sort = [{"timestamp": {"order": "desc"}}]
+    elif isinstance(sort, dict):
+        sort = [sort]
+    
+    return list(sort) + SORT_TIEBREAKER
+
+
+def search_page(search_query, page=0, index=None, search_after=None):
+    """
+        fetches a page of a search with search_after instead of from/size: without a cursor the previous pages are
+        skipped by the sort values of their last hits, page N sends N + 1 searches one after another (each of them
+        only as expensive as the first page), callers paging forward pass the cursor of the previous page instead
+    :param search_query: dict the body of the search (with its size and sort order, the tiebreaker is added)
+    :param page: int the page (ignored if a cursor is passed)
+    :param index: str the index (default: index_name)
+    :param search_after: list optional cursor, the sort values of the last hit of the previous page
+    :return: dict the response of the page (a page after the last hit has no hits)
+    """
+    if index is None:
+        index = index_name
+    
+    search_query = dict(search_query, sort=get_sort(search_query.get('sort')))
+    search_query.setdefault("size", SEARCH_DEFAULT_SIZE)
+    
+    if search_after is not None:
+        search_query["search_after"] = search_after
+        return cached_search(es, index, search_query, doc_type=es_doc_type)
+    
+    # the aggregations are only requested with the page itself
+    skip_query = {key: value for key, value in search_query.items() if key != 'aggs'}
+    
+    for _ in range(page):
+        hits = cached_search(es, index, skip_query, doc_type=es_doc_type).get('hits').get('hits')
+        
+        if len(hits) < search_query.get('size'):
+            search_query["size"] = 0
+            break
+        
+        skip_query["search_after"] = search_query["search_after"] = hits[-1].get('sort')
+    
+    return cached_search(es, index, search_query, doc_type=es_doc_type)
+
 
-def get_geo_data(latitude, longitude, distance_in_km, limit=100, page=0):
+def iter_search_hits(query, index=None, sort=None, page_size=SEARCH_PAGE_SIZE, keep_alive=SEARCH_KEEP_ALIVE, point_in_time=True):
+    """
+        pages through all hits of a query with search_after (each page costs the same, independent of its position)
+    :param query: dict the query
+    :param index: str the index (default: index_name)
+    :param sort: list the sort order (default: timestamp descending)
+    :param page_size: int the amount of hits per request
+    :param keep_alive: str how long the point in time is kept open between two pages
+    :param point_in_time: bool page through a point in time of the index, if supported by the cluster
+    :return: generator of hits
+    """
+    if index is None:
+        index = index_name
+    
+    pit_id = open_point_in_time(index, keep_alive) if point_in_time else None
+    
+    # the tiebreaker is added in both cases (the point in time adds _shard_doc itself only from Elastic Search 7.12)
+    search_query = {
+        "query": query,
+        "size": page_size,
+        "sort": get_sort(sort),
+    }
+    
+    try:
+        while True:
+            if pit_id:
+                search_query["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+                response = es.transport.perform_request('POST', '/_search', body=search_query)
+                pit_id = response.get('pit_id', pit_id)
+            else:
+                response = es.search(index=index, doc_type=es_doc_type, body=search_query)
+            
+            hits = response.get('hits').get('hits')
+            
+            for hit in hits:
+                yield hit
+            
+            if len(hits) < page_size:
+                break
+            
+            search_query["search_after"] = hits[-1].get('sort')
+    finally:
+        if pit_id:
+            close_point_in_time(pit_id)
+
+
+def get_geo_data(latitude, longitude, distance_in_km, limit=100, page=0, search_after=None):
+    """
+        fetches a page of the sensor data around a point (the most recent first)
+    :param search_after: list optional cursor to page forward, the 'sort' of the last hit of the previous page
+    :return: list of the hits
+    """
     distance = "{}km".format(float(distance_in_km))
     
     search_params = {
@@ -65,10 +206,9 @@ def get_geo_data(latitude, longitude, distance_in_km, limit=100, page=0):
         "query": search_params,
         "size": limit,
         'sort': {'timestamp': {'order': "desc"}},
-        "from": page * limit,
     }
     
-    response = es.search(index=index_name, doc_type=es_doc_type, body=search_query)
+    response = search_page(search_query, page, search_after=search_after)
     total_results = response.get('hits').get('total')
     pages = int(total_results / limit)
     message = "{} results ({} pages) have been found".format(total_results, pages)
@@ -78,6 +218,31 @@ def get_geo_data(latitude, longitude, distance_in_km, limit=100, page=0):
     return response.get('hits').get('hits')
 
 
+def iter_geo_data(latitude, longitude, distance_in_km, page_size=SEARCH_PAGE_SIZE):
+    """
+        pages through the sensor data around a point (the most recent first)
+    :param latitude: float
+    :param longitude: float
+    :param distance_in_km: float
+    :param page_size: int the amount of documents per request
+    :return: generator of the sensor data
+    """
+    search_params = {
+        "bool": {
+            "must": {"match_all": {}},
+            "filter": {
+                "geo_distance": {
+                    "distance": "{}km".format(float(distance_in_km)),
+                    "geo_location": {"lat": latitude, "lon": longitude}
+                }
+            }
+        }
+    }
+    
+    for hit in iter_search_hits(search_params, page_size=page_size):
+        yield hit.get('_source')
+
+
 def get_locations():
     search_query = {
         "aggs": {
@@ -87,7 +252,7 @@ def get_locations():
         }
     }
     
-    response = es.search(index=index_name, doc_type=es_doc_type, body=search_query)
+    response = cached_search(es, index_name, search_query, doc_type=es_doc_type)
     
     locations = response.get('aggregations').get('geo_locations').get('buckets')
     
@@ -126,7 +291,6 @@ def get_locations_nearby(latitude, longitude, distance_in_km, limit=100, page=0)
         "query": search_params,
         "size": limit,
         'sort': {'timestamp': {'order': "desc"}},
-        "from": page * limit,
         "aggs": {
             "locations": {
                 "terms": {"field": "location"}
@@ -134,7 +298,7 @@ def get_locations_nearby(latitude, longitude, distance_in_km, limit=100, page=0)
         }
     }
     
-    response = es.search(index=index_name, doc_type=es_doc_type, body=search_query)
+    response = search_page(search_query, page)
     
     locations = response.get('aggregations').get('locations').get('buckets')
     
@@ -146,12 +310,72 @@ def get_locations_nearby(latitude, longitude, distance_in_km, limit=100, page=0)
     return locations
 
 
+def get_locations_nearby_many(points, sensor_types=None, max_locations=10000):
+    """
+        fetches the locations near many points at once (as one multi search request)
+    :param points: dict key => tuple (latitude, longitude, distance in km)
+    :param sensor_types: list optional sensor types
+    :param max_locations: int the maximum amount of locations per point
+    :return: dict key => list of the location buckets (failed searches are left out)
+    """
+    search_queries = {}
+    
+    for key, (latitude, longitude, distance_in_km) in points.items():
+        search_params = {
+            "bool": {
+                "filter": [{
+                    "geo_distance": {
+                        "distance": "{}km".format(float(distance_in_km)),
+                        "geo_location": {"lat": latitude, "lon": longitude}
+                    }
+                }]
+            }
+        }
+        
+        if sensor_types:
+            search_params["bool"]["filter"].append({"terms": {"sensor_type": sensor_types}})
+        
+        search_queries[key] = {
+            "query": search_params,
+            "size": 0,
+            "aggs": {
+                "locations": {
+                    "terms": {"field": "location", "size": max_locations}
+                }
+            }
+        }
+    
+    responses = msearch(es, search_queries, index_name, es_doc_type)
+    
+    return {key: response.get('aggregations').get('locations').get('buckets') for key, response in responses.items()}
+
+
+def get_sensor_ids_nearby(latitude, longitude, distance_in_km, sensor_types=None, spatial_index=None):
+    """
+        looks up the sensors near a location in the sensor registry (without a query of the cluster)
+    :param latitude: float
+    :param longitude: float
+    :param distance_in_km: float
+    :param sensor_types: list optional sensor types
+    :param spatial_index: dict the spatial index of the registered sensors (built from the registry if not set)
+    :return: list of the sorted sensor ids (can be passed as sensor_ids_filter to luftdaten_index)
+    """
+    if spatial_index is None:
+        spatial_index = build_spatial_index(load_sensors(connect_sensors()))
+    
+    sensor_ids = query_radius(spatial_index, latitude, longitude, distance_in_km, sensor_types=sensor_types)
+    
+    message = "{} sensors found {}km near ({}, {})".format(len(sensor_ids), distance_in_km, latitude, longitude)
+    print(message)
+    
+    return sensor_ids
+
+
 def get_sensor_data(location, limit=1000, page=0):
     search_query = {
         "query": {"match": {"location": location}},
         "size": limit,
         'sort': {'timestamp': {'order': "desc"}},
-        "from": page * limit,
         "aggs": {
             "days": {
                 "date_histogram": {
@@ -162,7 +386,7 @@ def get_sensor_data(location, limit=1000, page=0):
         }
     }
     
-    response = es.search(index=index_name, doc_type=es_doc_type, body=search_query)
+    response = search_page(search_query, page)
     
     results = response.get('hits').get('hits')
     
@@ -181,6 +405,17 @@ def get_sensor_data(location, limit=1000, page=0):
     return [result.get('_source') for result in results]
 
 
+def iter_sensor_data(location, page_size=SEARCH_PAGE_SIZE):
+    """
+        pages through the complete history of a location (the most recent first)
+    :param location: int the location id
+    :param page_size: int the amount of documents per request
+    :return: generator of the sensor data
+    """
+    for hit in iter_search_hits({"match": {"location": location}}, page_size=page_size):
+        yield hit.get('_source')
+
+
 def main():
     # get the geo data around a certain point (here Stuttgart)
     latitude = 48.76490
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+####
+# registry of the sensors of the archive of luftdaten.info
+#
+# 1. the sensors (id, type, first and last day) are registered from the filenames of the listings of the archive
+# 2. the location of a sensor (location id, lat, lon) is taken over from the first row of its most recent csv file
+# 3. all sensors are kept in one store (SQLite) and are looked up in memory by the spatial index, e.g. the sensors
+#    within an area (see luftdaten_spatial):
+#   query_polygon(build_spatial_index(load_sensors(connect())), geo_shape, sensor_types=['sds011'])
+###
+
+__author__ = 'Martin Andreas Woerz'
+__email__ = 'm.woerz@ieservices.de'
+__copyright__ = "Copyright 2018, Martin Woerz"
+__version__ = "0.0.7"
+
+import csv
+import os
+import re
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+SENSOR_DATABASE = os.environ.get("SENSOR_DATABASE") if 'SENSOR_DATABASE' in os.environ else 'data/luftdaten_sensors.sqlite'
+
+# the csv files of the archive: [archive.luftdaten.info_YYYY-MM-DD_]YYYY-MM-DD_<sensor type>_sensor_<id>[_indoor].csv
+CSV_FILENAME_PATTERN = re.compile(r'(\d{4}-\d{2}-\d{2})_([^_/]+)_sensor_(\d+)(?:_indoor)?\.csv$', re.IGNORECASE)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sensors (
+    sensor_id INTEGER PRIMARY KEY,
+    sensor_type TEXT NOT NULL,
+    location INTEGER,
+    lat REAL,
+    lon REAL,
+    location_date TEXT,
+    first_seen TEXT NOT NULL,
+    last_seen TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS registered_days (
+    file_date TEXT PRIMARY KEY,
+    files INTEGER NOT NULL
+);
+"""
+
+# the first and the last day of a sensor are extended, the type is taken from the most recent file
+UPSERT_SENSOR = """
+INSERT INTO sensors (sensor_id, sensor_type, first_seen, last_seen) VALUES (?, ?, ?, ?)
+ON CONFLICT (sensor_id) DO UPDATE SET
+    sensor_type = CASE WHEN excluded.last_seen >= last_seen THEN excluded.sensor_type ELSE sensor_type END,
+    first_seen = MIN(first_seen, excluded.first_seen),
+    last_seen = MAX(last_seen, excluded.last_seen)
+"""
+
+# the location is only replaced by the location of a more recent file (sensors can be moved)
+UPDATE_LOCATION = """
+UPDATE sensors SET location = ?, lat = ?, lon = ?, location_date = ?
+WHERE sensor_id = ? AND (location_date IS NULL OR location_date < ?)
+"""
+
+# the amount of sensor ids per query of their location dates (below the limit of the parameters of SQLite)
+QUERY_BATCH_SIZE = 500
+
+
+def connect(database=SENSOR_DATABASE):
+    """
+        opens (and creates) the sensor registry
+    :param database: str the SQLite database file
+    :return: sqlite3.Connection
+    """
+    directory = os.path.dirname(database)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    
+    connection = sqlite3.connect(database, check_same_thread=False)
+    connection.executescript(SCHEMA)
+    connection.commit()
+    
+    return connection
+
+
+def parse_csv_filename(csv_file):
+    """
+        extracts the day, the sensor type and the sensor id of the filename of a csv file
+    :param csv_file: str the filename or url of the csv file
+    :return: tuple (file date, sensor type, sensor id) or None if the filename does not match
+    """
+    match = CSV_FILENAME_PATTERN.search(csv_file)
+    
+    if match is None:
+        return None
+    
+    return match.group(1), match.group(2).lower(), int(match.group(3))
+
+
+def register_listing(connection, file_date, csv_urls, immutable=False):
+    """
+        registers the sensors of the listing of a day
+    :param connection: sqlite3.Connection the sensor registry
+    :param file_date: str the day of the listing
+    :param csv_urls: list the csv files of the day
+    :param immutable: bool the listing of the day does not change anymore (it is only registered once)
+    :return: int the amount of registered sensors
+    """
+    if immutable:
+        row = connection.execute('SELECT files FROM registered_days WHERE file_date = ?', (file_date,)).fetchone()
+        if row is not None and row[0] == len(csv_urls):
+            return 0
+    
+    sensors = []
+    for csv_url in csv_urls:
+        sensor = parse_csv_filename(csv_url)
+        if sensor is not None:
+            sensor_date, sensor_type, sensor_id = sensor
+            sensors.append((sensor_id, sensor_type, sensor_date, sensor_date))
+    
+    with connection:
+        connection.executemany(UPSERT_SENSOR, sensors)
+        connection.execute('INSERT OR REPLACE INTO registered_days (file_date, files) VALUES (?, ?)', (file_date, len(csv_urls)))
+    
+    return len(sensors)
+
+
+def read_csv_location(csv_file):
+    """
+        reads the location of the sensor of the first row of a csv file (the rest of the file is not read)
+    :param csv_file: str the csv file
+    :return: tuple (location id, lat, lon) or None if the file has no rows
+    """
+    with open(csv_file, newline='', encoding='utf-8') as fp:
+        reader = csv.reader(fp, delimiter=';')
+        header = next(reader, None)
+        row = next(reader, None)
+    
+    if not header or not row:
+        return None
+    
+    values = dict(zip(header, row))
+    
+    def to_number(value, number_type):
+        try:
+            return number_type(value)
+        except (TypeError, ValueError):
+            return None
+    
+    return to_number(values.get('location'), int), to_number(values.get('lat'), float), to_number(values.get('lon'), float)
+
+
+def get_location_dates(connection, sensor_ids):
+    """
+        the days of the known locations of the sensors
+    :param connection: sqlite3.Connection the sensor registry
+    :param sensor_ids: list the sensor ids
+    :return: dict sensor id => location date (the sensors without a location are left out)
+    """
+    sensor_ids = sorted(set(sensor_ids))
+    location_dates = {}
+    
+    for start in range(0, len(sensor_ids), QUERY_BATCH_SIZE):
+        batch = sensor_ids[start:start + QUERY_BATCH_SIZE]
+        query = 'SELECT sensor_id, location_date FROM sensors WHERE location_date IS NOT NULL AND sensor_id IN ({})'.format(','.join('?' * len(batch)))
+        location_dates.update(connection.execute(query, batch))
+    
+    return location_dates
+
+
+def register_csv_files(connection, csv_files):
+    """
+        registers the sensors of downloaded csv files, the first row of a file is only read if the file is more recent
+        than the location known for the sensor
+    :param connection: sqlite3.Connection the sensor registry
+    :param csv_files: list the csv files
+    :return: int the amount of read csv files
+    """
+    sensors = []
+    for csv_file in csv_files:
+        sensor = parse_csv_filename(csv_file)
+        if sensor is not None:
+            sensors.append((csv_file,) + sensor)
+    
+    if not sensors:
+        return 0
+    
+    with connection:
+        connection.executemany(UPSERT_SENSOR, [(sensor_id, sensor_type, file_date, file_date) for _, file_date, sensor_type, sensor_id in sensors])
+    
+    location_dates = get_location_dates(connection, [sensor_id for _, _, _, sensor_id in sensors])
+    
+    locations = []
+    for csv_file, file_date, sensor_type, sensor_id in sensors:
+        location_date = location_dates.get(sensor_id)
+        
+        if location_date is not None and location_date >= file_date:
+            continue
+        
+        try:
+            location = read_csv_location(csv_file)
+        except (OSError, UnicodeDecodeError, csv.Error) as e:
+            message = "Error in reading the location of the file '{}'. Details:\n  {}".format(csv_file, e)
+            print("      " + message)
+            continue
+        
+        if location is not None:
+            locations.append(location + (file_date, sensor_id, file_date))
+    
+    with connection:
+        connection.executemany(UPDATE_LOCATION, locations)
+    
+    return len(locations)
+
+
+def load_sensors(connection, sensor_types=None):
+    """
+        loads the registered sensors into memory
+    :param connection: sqlite3.Connection the sensor registry
+    :param sensor_types: list optional sensor types
+    :return: pd.DataFrame with the columns sensor_id, sensor_type, location, lat, lon, first_seen, last_seen
+    """
+    df = pd.read_sql_query('SELECT sensor_id, sensor_type, location, lat, lon, first_seen, last_seen FROM sensors ORDER BY sensor_id', connection)
+    
+    if sensor_types:
+        df = df[df['sensor_type'].isin([sensor_type.lower() for sensor_type in sensor_types])].reset_index(drop=True)
+    
+    return df
+
+
+def points_in_polygon(lats, lons, geo_shape):
+    """
+        checks which points are within a polygon (ray casting)
+    :param lats: np.array the latitudes of the points
+    :param lons: np.array the longitudes of the points
+    :param geo_shape: list the points of the polygon [{"lat": 48.76, "lon": 9.16}, ...]
+    :return: np.array of bool
+    """
+    lats = np.asarray(lats, dtype='float64')
+    lons = np.asarray(lons, dtype='float64')
+    
+    polygon_lats = np.array([point.get('lat') for point in geo_shape], dtype='float64')
+    polygon_lons = np.array([point.get('lon') for point in geo_shape], dtype='float64')
+    
+    inside = np.zeros(len(lats), dtype=bool)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for lat_1, lon_1, lat_2, lon_2 in zip(polygon_lats, polygon_lons, np.roll(polygon_lats, 1), np.roll(polygon_lons, 1)):
+            crosses = ((lat_1 > lats) != (lat_2 > lats)) & (lons < (lon_2 - lon_1) * (lats - lat_1) / (lat_2 - lat_1) + lon_1)
+            inside ^= crosses
+    
+    return inside
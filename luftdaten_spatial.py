@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+####
+# in-process spatial index of the locations of the sensors (replaces the geo queries sent to Elastic Search)
+#
+# the sensors are sorted into the cells of a regular grid (lat/lon degrees), a query only checks the sensors of the
+# cells covering its bounding box:
+# 1. polygon: the sensors within a polygon (as geo_polygon)
+# 2. radius: the sensors within a distance of a point (as geo_distance)
+# 3. nearest: the k nearest sensors of a point
+#
+# all queries return the sorted sensor ids, which can be passed as sensor_ids_filter to luftdaten_index, e.g.:
+#   spatial_index = build_spatial_index(load_sensors(connect()))
+#   sensor_ids_filter = query_polygon(spatial_index, geo_shape, sensor_types=['sds011'])
+###
+
+__author__ = 'Martin Andreas Woerz'
+__email__ = 'm.woerz@ieservices.de'
+__copyright__ = "Copyright 2018, Martin Woerz"
+__version__ = "0.0.7"
+
+import numpy as np
+
+from luftdaten_sensors import points_in_polygon
+
+# the size of a cell of the grid in degrees (~5.5km in latitude)
+SPATIAL_CELL_SIZE = 0.05
+
+# the mean radius of the earth (as used by Elastic Search)
+EARTH_RADIUS_KM = 6371.0088
+
+KM_PER_DEGREE = np.pi * EARTH_RADIUS_KM / 180
+
+# the columns are combined into one cell key: row * CELL_COLUMNS + column
+CELL_COLUMNS = 2 ** 32
+
+
+def build_spatial_index(sensors, cell_size=SPATIAL_CELL_SIZE):
+    """
+        builds the spatial index of the sensors (sensors without a location are left out)
+    :param sensors: pd.DataFrame the registered sensors (see luftdaten_sensors.load_sensors)
+    :param cell_size: float the size of a cell of the grid in degrees
+    :return: dict the spatial index
+    """
+    sensors = sensors[sensors['lat'].notnull() & sensors['lon'].notnull()]
+    
+    lats = sensors['lat'].values.astype('float64')
+    lons = sensors['lon'].values.astype('float64')
+    keys = get_cell_keys(lats, lons, cell_size)
+    
+    order = np.argsort(keys, kind='stable')
+    
+    return {
+        'cell_size': cell_size,
+        'keys': keys[order],
+        'lats': lats[order],
+        'lons': lons[order],
+        'sensor_ids': sensors['sensor_id'].values.astype('int64')[order],
+        'sensor_types': sensors['sensor_type'].values.astype(str)[order],
+    }
+
+
+def get_cell_keys(lats, lons, cell_size):
+    rows = np.floor((np.asarray(lats) + 90) / cell_size).astype('int64')
+    columns = np.floor((np.asarray(lons) + 180) / cell_size).astype('int64')
+    return rows * CELL_COLUMNS + columns
+
+
+def get_candidates(spatial_index, min_lat, min_lon, max_lat, max_lon):
+    """
+        collects the positions of the sensors within the cells covering a bounding box
+    :return: np.array of positions in the spatial index
+    """
+    cell_size = spatial_index.get('cell_size')
+    keys = spatial_index.get('keys')
+    
+    min_lon, max_lon = max(min_lon, -180.0), min(max_lon, 180.0)
+    
+    rows = np.arange(np.floor((min_lat + 90) / cell_size), np.floor((max_lat + 90) / cell_size) + 1).astype('int64')
+    min_column = int(np.floor((min_lon + 180) / cell_size))
+    max_column = int(np.floor((max_lon + 180) / cell_size))
+    
+    # the cells of a row of the grid are contiguous in the sorted keys
+    starts = np.searchsorted(keys, rows * CELL_COLUMNS + min_column, side='left')
+    ends = np.searchsorted(keys, rows * CELL_COLUMNS + max_column, side='right')
+    
+    ranges = [np.arange(start, end) for start, end in zip(starts, ends) if end > start]
+    
+    if not ranges:
+        return np.array([], dtype='int64')
+    
+    return np.concatenate(ranges)
+
+
+def filter_sensor_types(spatial_index, candidates, sensor_types=None):
+    if not sensor_types:
+        return candidates
+    
+    sensor_types = [sensor_type.lower() for sensor_type in sensor_types]
+    return candidates[np.isin(spatial_index.get('sensor_types')[candidates], sensor_types)]
+
+
+def get_distances(lats, lons, latitude, longitude):
+    """
+        calculates the distances of the points to a point (haversine)
+    :return: np.array distances in km
+    """
+    lats, lons = np.radians(lats), np.radians(lons)
+    latitude, longitude = np.radians(latitude), np.radians(longitude)
+    
+    a = np.sin((lats - latitude) / 2) ** 2 + np.cos(latitude) * np.cos(lats) * np.sin((lons - longitude) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def get_bounding_box(latitude, longitude, distance_in_km):
+    lat_delta = distance_in_km / KM_PER_DEGREE
+    
+    # close to the poles the bounding box covers all longitudes (bounding boxes are not wrapped around the antimeridian)
+    cos_lat = np.cos(np.radians(min(abs(latitude) + lat_delta, 90.0)))
+    lon_delta = distance_in_km / (KM_PER_DEGREE * cos_lat) if cos_lat > 1e-9 else 180.0
+    
+    return latitude - lat_delta, longitude - lon_delta, latitude + lat_delta, longitude + lon_delta
+
+
+def query_polygon(spatial_index, geo_shape, sensor_types=None):
+    """
+        looks up the sensors within a polygon
+    :param spatial_index: dict the spatial index (see build_spatial_index)
+    :param geo_shape: list the points of the polygon [{"lat": 48.76, "lon": 9.16}, ...]
+    :param sensor_types: list optional sensor types
+    :return: list of the sorted sensor ids
+    """
+    polygon_lats = [point.get('lat') for point in geo_shape]
+    polygon_lons = [point.get('lon') for point in geo_shape]
+    
+    candidates = get_candidates(spatial_index, min(polygon_lats), min(polygon_lons), max(polygon_lats), max(polygon_lons))
+    candidates = filter_sensor_types(spatial_index, candidates, sensor_types)
+    
+    inside = points_in_polygon(spatial_index.get('lats')[candidates], spatial_index.get('lons')[candidates], geo_shape)
+    
+    return sorted(set(spatial_index.get('sensor_ids')[candidates[inside]].tolist()))
+
+
+def query_radius(spatial_index, latitude, longitude, distance_in_km, sensor_types=None):
+    """
+        looks up the sensors within a distance of a point
+    :param spatial_index: dict the spatial index (see build_spatial_index)
+    :param latitude: float
+    :param longitude: float
+    :param distance_in_km: float
+    :param sensor_types: list optional sensor types
+    :return: list of the sorted sensor ids
+    """
+    candidates = get_candidates(spatial_index, *get_bounding_box(latitude, longitude, distance_in_km))
+    candidates = filter_sensor_types(spatial_index, candidates, sensor_types)
+    
+    distances = get_distances(spatial_index.get('lats')[candidates], spatial_index.get('lons')[candidates], latitude, longitude)
+    
+    return sorted(set(spatial_index.get('sensor_ids')[candidates[distances <= distance_in_km]].tolist()))
+
+
+def query_nearest(spatial_index, latitude, longitude, k=10, sensor_types=None):
+    """
+        looks up the k nearest sensors of a point
+    :param spatial_index: dict the spatial index (see build_spatial_index)
+    :param latitude: float
+    :param longitude: float
+    :param k: int the amount of sensors
+    :param sensor_types: list optional sensor types
+    :return: list of (sensor id, distance in km) tuples ordered by the distance
+    """
+    sensors_count = len(filter_sensor_types(spatial_index, np.arange(len(spatial_index.get('keys'))), sensor_types))
+    k = min(k, sensors_count)
+    
+    if k <= 0:
+        return []
+    
+    # the radius is doubled until it contains k sensors (all sensors within the radius are found)
+    distance_in_km = spatial_index.get('cell_size') * KM_PER_DEGREE
+    
+    while True:
+        candidates = get_candidates(spatial_index, *get_bounding_box(latitude, longitude, distance_in_km))
+        candidates = filter_sensor_types(spatial_index, candidates, sensor_types)
+        
+        distances = get_distances(spatial_index.get('lats')[candidates], spatial_index.get('lons')[candidates], latitude, longitude)
+        within = distances <= distance_in_km
+        
+        if within.sum() >= k or distance_in_km > np.pi * EARTH_RADIUS_KM:
+            break
+        
+        distance_in_km *= 2
+    
+    nearest = np.argsort(distances, kind='stable')[:k]
+    
+    return [(int(sensor_id), float(distance)) for sensor_id, distance in zip(spatial_index.get('sensor_ids')[candidates[nearest]], distances[nearest])]
+
+
+def query_polygons(spatial_index, geo_shapes, sensor_types=None):
+    """
+        looks up the sensors within each of the polygons
+    :param spatial_index: dict the spatial index (see build_spatial_index)
+    :param geo_shapes: list or dict of polygons
+    :param sensor_types: list optional sensor types
+    :return: list or dict (with the keys of geo_shapes) of the sorted sensor ids
+    """
+    if isinstance(geo_shapes, dict):
+        return {key: query_polygon(spatial_index, geo_shape, sensor_types) for key, geo_shape in geo_shapes.items()}
+    
+    return [query_polygon(spatial_index, geo_shape, sensor_types) for geo_shape in geo_shapes]
+
+
+def query_radii(spatial_index, points, distance_in_km, sensor_types=None):
+    """
+        looks up the sensors within a distance of each of the points
+    :param spatial_index: dict the spatial index (see build_spatial_index)
+    :param points: list of {"lat": 48.76, "lon": 9.16} points
+    :param distance_in_km: float
+    :param sensor_types: list optional sensor types
+    :return: list of the sorted sensor ids
+    """
+    return [query_radius(spatial_index, point.get('lat'), point.get('lon'), distance_in_km, sensor_types) for point in points]
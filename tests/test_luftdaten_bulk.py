@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+####
+# tests of the retries of the bulk requests and of the routing of the chunks to the indices of the ingest jobs
+#
+# the bulk api is replaced by a fake client, which answers the documents by their ids:
+#   python -m pytest tests
+###
+
+__author__ = 'Martin Andreas Woerz'
+__email__ = 'm.woerz@ieservices.de'
+__copyright__ = "Copyright 2018, Martin Woerz"
+__version__ = "0.0.7"
+
+import json
+import os
+import sys
+import unittest
+from contextlib import redirect_stdout
+from io import StringIO
+
+import pandas as pd
+from elasticsearch import TransportError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from luftdaten_bulk import iter_routed_chunks, send_batch, stream_bulk
+from luftdaten_encoder import encode_bulk_documents
+
+
+def create_chunk(index_name, file_date, file_id, rows, last_chunk=True):
+    df = pd.DataFrame({'sensor_id': [file_id] * rows, 'P1': [float(row) for row in range(rows)]})
+    return encode_bulk_documents(df, index_name, file_date, file_id), rows, (file_date, file_id), last_chunk
+
+
+def get_ids(payload):
+    lines = payload.split(b'\n')
+    return [json.loads(line).get('index').get('_id') for line in lines[0:len(lines) - 1:2]]
+
+
+class FakeBulkClient(object):
+    """
+        answers the bulk requests: the documents in rejected are rejected (429) the given amount of times, the
+        documents in failed always fail, the requests in transport_errors are rejected as a whole
+    """
+    
+    def __init__(self, rejected=None, failed=(), transport_errors=0):
+        self.rejected = dict(rejected or {})
+        self.failed = set(failed)
+        self.transport_errors = transport_errors
+        self.requests = []
+    
+    def bulk(self, body):
+        document_ids = get_ids(body)
+        self.requests.append(document_ids)
+        
+        if self.transport_errors > 0:
+            self.transport_errors -= 1
+            raise TransportError(429, 'rejected_execution_exception', {})
+        
+        items = []
+        
+        for document_id in document_ids:
+            if self.rejected.get(document_id, 0) > 0:
+                self.rejected[document_id] -= 1
+                items.append({'index': {'_id': document_id, 'status': 429, 'error': {'type': 'es_rejected_execution_exception'}}})
+            elif document_id in self.failed:
+                items.append({'index': {'_id': document_id, 'status': 400, 'error': {'type': 'mapper_parsing_exception'}}})
+            else:
+                items.append({'index': {'_id': document_id, 'status': 201}})
+        
+        return {'errors': any('error' in item.get('index') for item in items), 'items': items}
+
+
+class SendBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.batch = [create_chunk('a_2018-05', '2018-05-07', 1, 3), create_chunk('a_2018-05', '2018-05-07', 2, 2)]
+    
+    def send(self, es, retries=3):
+        with redirect_stdout(StringIO()):
+            return send_batch(es, self.batch, retries=retries, backoff=0)
+    
+    def test_all_documents_indexed(self):
+        es = FakeBulkClient()
+        
+        self.assertEqual(self.send(es), (5, [], set()))
+        self.assertEqual(len(es.requests), 1)
+    
+    def test_only_rejected_documents_are_retried(self):
+        es = FakeBulkClient(rejected={'2018-05-07_1_1': 2, '2018-05-07_2_0': 1})
+        
+        indexed_count, errors, failed_files = self.send(es)
+        
+        self.assertEqual((indexed_count, errors, failed_files), (5, [], set()))
+        self.assertEqual(es.requests[1], ['2018-05-07_1_1', '2018-05-07_2_0'])
+        self.assertEqual(es.requests[2], ['2018-05-07_1_1'])
+    
+    def test_permanent_error_fails_only_its_file(self):
+        es = FakeBulkClient(rejected={'2018-05-07_1_0': 1}, failed={'2018-05-07_2_1'})
+        
+        indexed_count, errors, failed_files = self.send(es)
+        
+        self.assertEqual(indexed_count, 4)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(failed_files, {('2018-05-07', 2)})
+        
+        # the failed document is not sent again
+        self.assertEqual(es.requests[1], ['2018-05-07_1_0'])
+    
+    def test_documents_rejected_after_the_last_retry_fail_their_file(self):
+        es = FakeBulkClient(rejected={'2018-05-07_2_0': 10})
+        
+        indexed_count, errors, failed_files = self.send(es, retries=2)
+        
+        self.assertEqual(indexed_count, 4)
+        self.assertEqual(failed_files, {('2018-05-07', 2)})
+        self.assertEqual(len(es.requests), 3)
+    
+    def test_rejected_request_is_retried(self):
+        es = FakeBulkClient(transport_errors=2)
+        
+        self.assertEqual(self.send(es), (5, [], set()))
+        self.assertEqual(len(es.requests), 3)
+
+
+class StreamBulkTest(unittest.TestCase):
+
+    def test_failed_files_are_not_reported_as_done(self):
+        chunks = [create_chunk('a_2018-05', '2018-05-07', file_id, 2) for file_id in range(1, 4)]
+        es = FakeBulkClient(rejected={'2018-05-07_1_1': 1}, failed={'2018-05-07_2_0'})
+        files_done = []
+        
+        with redirect_stdout(StringIO()):
+            indexed_count, failed_count, failed_files = stream_bulk(es, chunks, max_docs=3, on_file_done=lambda *file_key: files_done.append(file_key),
+                                                                     index_workers=1, adaptive=False)
+        
+        self.assertEqual((indexed_count, failed_count), (5, 1))
+        self.assertEqual(failed_files, [('2018-05-07', 2)])
+        self.assertEqual(files_done, [('2018-05-07', 1), ('2018-05-07', 3)])
+
+
+class RoutedChunksTest(unittest.TestCase):
+
+    def test_chunks_are_sent_to_all_targets(self):
+        chunk = create_chunk('a_2018-05', '2018-05-07', 1, 2)
+        file_routes = {('2018-05-07', 1): [('a', 'a_2018-05'), ('b', 'b_2018-05')]}
+        
+        routed = list(iter_routed_chunks([chunk], file_routes))
+        
+        self.assertEqual([routed_chunk[2] for routed_chunk in routed], [('a', '2018-05-07', 1), ('b', '2018-05-07', 1)])
+        self.assertEqual(routed[0][0], chunk[0])
+        
+        lines = routed[1][0].split(b'\n')
+        self.assertEqual([json.loads(line).get('index').get('_index') for line in lines[0:len(lines) - 1:2]], ['b_2018-05', 'b_2018-05'])
+        
+        # the documents are not changed
+        self.assertEqual(lines[1::2], chunk[0].split(b'\n')[1::2])
+    
+    def test_rollups_are_sent_to_the_rollup_indices(self):
+        chunk = create_chunk('a_rollup_2018-05', '2018-05-07', 1, 1)
+        file_routes = {('2018-05-07', 1): [('a', 'a_2018-05'), ('b', 'b_2018-05')]}
+        
+        routed = list(iter_routed_chunks([chunk], file_routes, rollups=True))
+        
+        self.assertEqual(json.loads(routed[1][0].split(b'\n')[0]).get('index').get('_index'), 'b_rollup_2018-05')
+    
+    def test_documents_mentioning_the_index_are_not_changed(self):
+        df = pd.DataFrame({'sensor_id': [1], 'note': ['{"index":{"_index":"a_2018-05",']})
+        chunk = encode_bulk_documents(df, 'a_2018-05', '2018-05-07', 1), 1, ('2018-05-07', 1), True
+        
+        routed = list(iter_routed_chunks([chunk], {('2018-05-07', 1): [('a', 'a_2018-05'), ('b', 'b_2018-05')]}))
+        
+        self.assertEqual(routed[1][0].split(b'\n')[1], chunk[0].split(b'\n')[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
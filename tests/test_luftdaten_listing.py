@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+# -*- coding: utf-8 -*-
+
+####
+# tests of the freshness rules of the cached listings of the archive
+#
+# the archive is replaced by a fake urlopen, which counts the requests:
+#   python -m pytest tests
+###
+
+__author__ = 'Martin Andreas Woerz'
+__email__ = 'm.woerz@ieservices.de'
+__copyright__ = "Copyright 2018, Martin Woerz"
+__version__ = "0.0.7"
+
+import os
+import sys
+import unittest
+import urllib.error
+from datetime import date, datetime, timedelta
+from io import BytesIO
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from luftdaten_listing import LISTING_RECENT_DAYS, connect, get_cached_listing, get_links, save_listing
+
+DAY = date(2018, 5, 7)
+URL = 'http://archive.luftdaten.info/2018-05-07/'
+
+
+class FakeResponse(BytesIO):
+
+    def __init__(self, links, etag=None):
+        super(FakeResponse, self).__init__(''.join('<a href="{}">{}</a>'.format(link, link) for link in links).encode('utf-8'))
+        self.headers = {'ETag': etag}
+    
+    def getheader(self, name):
+        return self.headers.get(name)
+
+
+class FakeArchive(object):
+    """
+        answers the requests of the listing with the given links (or with 304 if the ETag matches)
+    """
+    
+    def __init__(self, links, etag='"2"'):
+        self.links = links
+        self.etag = etag
+        self.requests = []
+    
+    def urlopen(self, request):
+        self.requests.append(request)
+        
+        if request.get_header('If-none-match') == self.etag:
+            raise urllib.error.HTTPError(request.full_url, 304, 'Not Modified', {}, None)
+        
+        return FakeResponse(self.links, self.etag)
+
+
+class GetLinksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = connect(':memory:')
+    
+    def get_links(self, archive, today):
+        with mock.patch('urllib.request.urlopen', archive.urlopen):
+            return get_links(self.connection, URL, today=today)
+    
+    def test_listing_fetched_while_recent_is_revalidated(self):
+        # fetched on the day itself, the archive adds a file later
+        save_listing(self.connection, URL, ['a.csv'], etag='"1"', fetched_at=datetime(2018, 5, 7, 12))
+        archive = FakeArchive(['a.csv', 'b.csv'])
+        
+        self.assertEqual(self.get_links(archive, DAY + timedelta(days=5)), ['a.csv', 'b.csv'])
+        self.assertEqual(len(archive.requests), 1)
+        self.assertEqual(archive.requests[0].get_header('If-none-match'), '"1"')
+        
+        # the listing is final now
+        self.assertEqual(self.get_links(archive, DAY + timedelta(days=6)), ['a.csv', 'b.csv'])
+        self.assertEqual(len(archive.requests), 1)
+    
+    def test_unchanged_listing_becomes_final(self):
+        save_listing(self.connection, URL, ['a.csv'], etag='"2"', fetched_at=datetime(2018, 5, 8))
+        archive = FakeArchive(['a.csv'])
+        
+        self.assertEqual(self.get_links(archive, DAY + timedelta(days=5)), ['a.csv'])
+        self.assertEqual(self.get_links(archive, DAY + timedelta(days=5)), ['a.csv'])
+        self.assertEqual(len(archive.requests), 1)
+        self.assertGreater(get_cached_listing(self.connection, URL).get('fetched_at'), '2018-05-08')
+    
+    def test_listing_fetched_after_the_day_became_immutable_is_not_requested(self):
+        save_listing(self.connection, URL, ['a.csv'], fetched_at=datetime.combine(DAY + timedelta(days=LISTING_RECENT_DAYS + 1), datetime.min.time()))
+        archive = FakeArchive(['a.csv', 'b.csv'])
+        
+        self.assertEqual(self.get_links(archive, DAY + timedelta(days=5)), ['a.csv'])
+        self.assertEqual(archive.requests, [])
+    
+    def test_recent_listing_is_revalidated(self):
+        save_listing(self.connection, URL, ['a.csv'], etag='"1"', fetched_at=datetime(2018, 5, 7, 12))
+        archive = FakeArchive(['a.csv', 'b.csv'])
+        
+        self.assertEqual(self.get_links(archive, DAY), ['a.csv', 'b.csv'])
+        self.assertEqual(len(archive.requests), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()